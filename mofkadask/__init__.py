@@ -0,0 +1,6 @@
+"""
+Helpers shared by the Mofka-Dask coupler plugins and consumers.
+
+The plugins in ``plugins/`` and ``nonBlockingPlugins/`` are preloaded by path,
+so they add the repository root to ``sys.path`` before importing from here.
+"""
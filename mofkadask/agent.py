@@ -0,0 +1,206 @@
+"""
+Node-local Mofka agent.
+
+Worker plugins started with ``--agent NAME`` do not connect to Mofka: they write
+their events into shared memory rings (see ``mofkadask.shmring``), and the agent
+of the same name running on their node pushes the events of all of them through
+one Mofka engine and producer. Start one agent per node, before the workers::
+
+    python -m mofkadask.agent --name dask --mofka-protocol cxi --group-file mofka.json
+
+The agent runs until it receives SIGINT or SIGTERM, then pushes the events left
+in the rings and flushes its producer.
+"""
+import os
+import time
+import pickle
+import signal
+import logging
+
+import click
+
+from mofkadask.connection import MofkaConnection
+from mofkadask.emitter import BatchingEmitter
+from mofkadask.partitioning import STRATEGIES
+from mofkadask.spool import Spool, spool_name
+from mofkadask.shmring import CLOSED, FLUSH_REQUEST, FLUSHED, HEAD, HEARTBEAT, ShmRing, list_rings
+from mofkadask.topics import LAYOUTS
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Agent():
+    """
+    Reads the rings of the workers of a node and hands their events to one BatchingEmitter.
+
+    Parameters
+    ----------
+    name :
+        Name of the agent, the workers use it to name their rings.
+    emitter :
+        The BatchingEmitter pushing the events to Mofka.
+    scan_interval :
+        Seconds between two looks for new rings in shared memory.
+    poll_interval :
+        Seconds the agent sleeps when the rings are empty.
+    """
+    def __init__(self, name, emitter, scan_interval=1.0, poll_interval=0.005):
+        self.name = name
+        self.emitter = emitter
+        self.scan_interval = scan_interval
+        self.poll_interval = poll_interval
+        self.rings = {}
+        # flushes in progress: ring -> (flush request of the ring, emitter flush done event)
+        self.flushes = {}
+        self.last_scan = 0.0
+        self.stopped = False
+        self.events = 0
+
+    def scan(self):
+        """Attach the rings created since the previous scan"""
+        self.last_scan = time.time()
+        for name in list_rings(self.name):
+            if name in self.rings:
+                continue
+            try:
+                ring = ShmRing.attach(name)
+            except (FileNotFoundError, ValueError):
+                # removed meanwhile, or not initialized yet
+                continue
+            ring.set(HEARTBEAT, time.time_ns())
+            self.rings[name] = ring
+            logging.info("Agent %s reads ring %s", self.name, name)
+
+    def drain(self, ring):
+        """Hand the events of a ring to the emitter, returns the number of events read"""
+        payloads = ring.take()
+        for payload in payloads:
+            try:
+                action, record = pickle.loads(payload)
+            except Exception:
+                logging.exception("Agent %s: unreadable event in ring %s", self.name, ring.name)
+                continue
+            self.emitter.emit(action, record)
+        self.events += len(payloads)
+        # the flush is acknowledged once done, the agent keeps reading the rings meanwhile
+        flush = self.flushes.get(ring)
+        if flush is not None and flush[1].is_set():
+            ring.set(FLUSHED, flush[0])
+            del self.flushes[ring]
+            flush = None
+        request = ring.get(FLUSH_REQUEST)
+        if flush is None and request > ring.get(FLUSHED) and ring.get(HEAD) >= request:
+            self.flushes[ring] = (request, self.emitter.request_flush())
+        return len(payloads)
+
+    def release(self, name, ring):
+        ring.unlink()
+        ring.close()
+        del self.rings[name]
+        self.flushes.pop(ring, None)
+        logging.info("Agent %s released ring %s", self.name, name)
+
+    def step(self):
+        """Read every ring once, returns the number of events read"""
+        if time.time() - self.last_scan > self.scan_interval:
+            self.scan()
+        now = time.time_ns()
+        n = 0
+        for name, ring in list(self.rings.items()):
+            ring.set(HEARTBEAT, now)
+            # read the closed flag first, the events written before it are read below
+            closed = ring.get(CLOSED) or not _alive(ring.pid)
+            n += self.drain(ring)
+            if closed:
+                self.release(name, ring)
+        return n
+
+    def run(self):
+        while not self.stopped:
+            if not self.step():
+                time.sleep(self.poll_interval)
+        self.step()
+        for name, ring in list(self.rings.items()):
+            ring.close()
+            del self.rings[name]
+        self.emitter.close()
+        logging.info("Agent %s stopped after %d events", self.name, self.events)
+
+    def stop(self, *args):
+        self.stopped = True
+
+
+@click.command()
+@click.option('--name',
+               type=str,
+               default="dask",
+               help="Agent name, given to the worker plugins with --agent")
+@click.option('--mofka-protocol',
+                type=str,
+                default="cxi",
+                help="Mofka protocol")
+@click.option('--group-file',
+               type=str,
+               default="mofka.json",
+               help="Mofka group file path")
+@click.option('--buffer-size',
+               type=int,
+               default=65536,
+               help="Maximum number of events the agent buffers before pushing them")
+@click.option('--batch-size',
+               type=int,
+               default=1024,
+               help="Maximum number of events pushed by the agent before waiting for them")
+@click.option('--partitions',
+               type=int,
+               default=1,
+               help="Number of partitions of the Dask topic, when the agent creates it")
+@click.option('--partition-by',
+               type=click.Choice(STRATEGIES),
+               default="worker",
+               help="Route events to the topic partitions by worker, task key or action")
+@click.option('--topic-layout',
+               type=click.Choice(LAYOUTS),
+               default="single",
+               help="Push all the events to the Dask topic (single) or every event class to its own topic (per-class)")
+@click.option('--spool-dir',
+               type=str,
+               default=None,
+               help="Directory where events are spooled while Mofka is slow or unavailable, no spool by default")
+@click.option('--spool-threshold',
+               type=float,
+               default=0.5,
+               help="Fraction of the buffer from which events are spooled")
+def main(name, mofka_protocol, group_file, buffer_size, batch_size, partitions, partition_by, topic_layout,
+         spool_dir, spool_threshold):
+    logging.basicConfig(filename=f"MofkaAgent-{name}-{os.uname().nodename}.log",
+                        format='%(asctime)s %(message)s',
+                        datefmt='%m/%d/%Y %I:%M:%S %p',
+                        level=logging.INFO)
+    # the workers can hand their events to the agent before it is connected to mofka
+    connection = MofkaConnection(mofka_protocol, group_file, "Dask_agent_producer",
+                                 topic_layout=topic_layout, partitions=partitions,
+                                 partition_by=partition_by)
+    emitter = BatchingEmitter(None,
+                              capacity=buffer_size,
+                              batch_size=batch_size,
+                              name="mofka-agent",
+                              connect=connection.connect,
+                              spool=Spool(spool_dir, spool_name(f"agent-{name}")) if spool_dir else None,
+                              spool_threshold=spool_threshold)
+    agent = Agent(name, emitter)
+    signal.signal(signal.SIGTERM, agent.stop)
+    signal.signal(signal.SIGINT, agent.stop)
+    agent.run()
+
+
+if __name__ == '__main__':
+    main()
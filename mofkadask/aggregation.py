@@ -0,0 +1,75 @@
+import math
+import time
+
+from mofkadask.encoding import DURATION_BINS
+
+# the first bin holds durations below 2**MIN_EXPONENT seconds (about 61 us),
+# every next bin doubles, the last one holds everything above
+MIN_EXPONENT = -14
+
+
+def duration_bin(seconds):
+    """Index of the log2 duration histogram bin of ``seconds``"""
+    if seconds <= 0:
+        return 0
+    # frexp(x) = (m, e) with x = m * 2**e and 0.5 <= m < 1
+    b = math.frexp(seconds)[1] - MIN_EXPONENT
+    return 0 if b < 0 else (DURATION_BINS - 1 if b >= DURATION_BINS else b)
+
+
+def duration_bin_edges():
+    """Upper bound in seconds of every duration histogram bin"""
+    return [2.0 ** (MIN_EXPONENT + i) for i in range(DURATION_BINS - 1)] + [math.inf]
+
+
+class WindowAggregator():
+    """
+    In-memory aggregates of task transitions over a time window.
+
+    Transitions are aggregated per (prefix, worker, start, finish): number of
+    transitions, erred tasks, compute durations (sum, max and log2 histogram)
+    and bytes produced. ``flush`` returns one ``transition_summary`` record per
+    key seen during the window and starts a new window, so the volume pushed to
+    Mofka is O(prefixes x windows) whatever the number of tasks.
+    """
+    def __init__(self):
+        self.window_start = time.time()
+        self.stats = {}
+
+    def add(self, prefix, worker, start, finish, duration=None, nbytes=None):
+        key = (prefix, worker, start, finish)
+        s = self.stats.get(key)
+        if s is None:
+            # count, duration sum, duration max, nbytes, histogram
+            s = self.stats[key] = [0, 0.0, 0.0, 0, [0] * DURATION_BINS]
+        s[0] += 1
+        if duration is not None:
+            s[1] += duration
+            if duration > s[2]:
+                s[2] = duration
+            s[4][duration_bin(duration)] += 1
+        if nbytes:
+            s[3] += nbytes
+
+    def flush(self):
+        """Return the summary records of the current window and start a new one"""
+        window_end = time.time()
+        records = []
+        for (prefix, worker, start, finish), s in self.stats.items():
+            record = {"window_start" : self.window_start,
+                      "window_end"   : window_end,
+                      "prefix"       : prefix,
+                      "worker"       : worker,
+                      "start"        : start,
+                      "finish"       : finish,
+                      "count"        : s[0],
+                      "errors"       : s[0] if finish == "erred" else 0,
+                      "duration_sum" : s[1],
+                      "duration_max" : s[2],
+                      "nbytes"       : s[3]}
+            for i, c in enumerate(s[4]):
+                record[f"duration_hist_{i}"] = c
+            records.append(record)
+        self.stats = {}
+        self.window_start = window_end
+        return records
@@ -0,0 +1,257 @@
+"""
+Publishing NumPy arrays and Dask array chunks to Mofka from inside Dask tasks.
+
+``publish`` pushes the memory of an array as the data of one Mofka event,
+without pickling it or copying it: C and Fortran contiguous arrays are handed
+to the producer as a flat byte view of their own buffer, only the other ones are
+made contiguous first. The event metadata describes the chunk::
+
+    {"action": "array_chunk", "array": name, "dtype": descr, "shape": [...],
+     "order": "C" or "F", "offset": [...], "global_shape": [...], "chunk": [...],
+     "key": task key, "nbytes": n, ...user metadata}
+
+``offset`` is the position of the chunk in the array ``name`` of shape
+``global_shape``, ``chunk`` its block index. ``publish_block`` fills them from the
+``block_info`` of ``dask.array.map_blocks``.
+
+On the consumer side, ArrayAssemblers rebuilds the arrays into buffers allocated
+once per array: its ``broker`` is given to the Mofka consumer as ``data_broker``,
+and returns the part of the array a chunk belongs to as the destination of its
+data whenever that part is made of a few contiguous segments, so Mofka writes the
+chunk in place. The other chunks land in a scratch buffer and are copied once.
+"""
+import json
+
+import numpy as np
+
+ACTION = "array_chunk"
+
+# chunks needing more segments than this are received in a scratch buffer
+MAX_SEGMENTS = 4096
+
+
+def task_key():
+    """Key of the Dask task running in this thread, None outside of a task"""
+    try:
+        from distributed.worker import thread_state
+    except ImportError:
+        return None
+    key = getattr(thread_state, "key", None)
+    return None if key is None else str(key)
+
+
+def byte_view(array):
+    """
+    Flat uint8 view of the memory of an array, and its order.
+
+    Returns
+    -------
+        The view, without copy when the array is C or Fortran contiguous, and
+        ``"C"`` or ``"F"``, the order of the elements in the view.
+    """
+    if array.dtype.hasobject:
+        raise TypeError(f"Arrays of {array.dtype} hold Python objects, they cannot be published")
+    if array.flags.c_contiguous:
+        order = "C"
+    elif array.flags.f_contiguous:
+        # the transpose of a Fortran array is C contiguous
+        array, order = array.T, "F"
+    else:
+        array, order = np.ascontiguousarray(array), "C"
+    return array.reshape(-1).view(np.uint8), order
+
+
+def chunk_metadata(array, name, order="C", offset=None, global_shape=None, chunk=None, metadata=None):
+    """Metadata of the ``array_chunk`` event of ``array``, see the module documentation"""
+    shape = [int(n) for n in array.shape]
+    event = dict(metadata or {})
+    event.update({"action"       : ACTION,
+                  "array"        : name,
+                  "dtype"        : np.lib.format.dtype_to_descr(array.dtype),
+                  "shape"        : shape,
+                  "order"        : order,
+                  "offset"       : [int(n) for n in offset] if offset is not None else [0] * len(shape),
+                  "global_shape" : [int(n) for n in global_shape] if global_shape is not None else shape,
+                  "chunk"        : [int(n) for n in chunk] if chunk is not None else [0] * len(shape),
+                  "key"          : task_key(),
+                  "nbytes"       : int(array.nbytes)})
+    return event
+
+
+def publish(producer, array, metadata=None, name="array", offset=None, global_shape=None, chunk=None, wait=True):
+    """
+    Push an array, or anything numpy can view as one, as one ``array_chunk`` event.
+
+    The producer reads the memory of the array itself: when ``wait`` is False,
+    the array must not be modified before the returned future completed or the
+    producer was flushed.
+
+    Parameters
+    ----------
+    producer :
+        The Mofka producer.
+    array :
+        The array, or an object exposing the buffer protocol.
+    metadata :
+        Optional dict of metadata added to the event.
+    name :
+        Name of the whole array the chunk belongs to.
+    offset, global_shape, chunk :
+        Position of the chunk in the whole array, shape of the whole array and
+        block index of the chunk. By default the array is the whole array.
+    wait :
+        Wait for the push to complete.
+
+    Returns
+    -------
+        The future of the push.
+    """
+    array = np.asarray(array)
+    data, order = byte_view(array)
+    f = producer.push(chunk_metadata(array, name, order, offset, global_shape, chunk, metadata), data)
+    if wait:
+        f.wait()
+    return f
+
+
+def block_location(block_info):
+    """Offset, global shape and block index of a ``map_blocks`` block, from its ``block_info``"""
+    info = block_info[None] if None in block_info else block_info[0]
+    location = info["array-location"]
+    return [start for start, _ in location], info["shape"], info["chunk-location"]
+
+
+def publish_block(producer, block, block_info=None, name="array", metadata=None, wait=True):
+    """
+    Publish a block of a Dask array from ``map_blocks``, and return it unchanged::
+
+        x.map_blocks(lambda b, block_info=None: publish_block(producer(), b, block_info, "x"))
+
+    Nothing is published without ``block_info``: Dask calls the function on an
+    empty array to infer the type of its result.
+    """
+    if block_info:
+        offset, global_shape, chunk = block_location(block_info)
+        publish(producer, block, metadata, name, offset, global_shape, chunk, wait)
+    return block
+
+
+def chunk_view(metadata, data):
+    """Array viewing the data of an ``array_chunk`` event, without copy"""
+    dtype = np.lib.format.descr_to_dtype(metadata["dtype"])
+    shape = tuple(metadata["shape"])
+    if metadata.get("order", "C") == "F":
+        return np.frombuffer(data, dtype=dtype).reshape(shape[::-1]).T
+    return np.frombuffer(data, dtype=dtype).reshape(shape)
+
+
+def _segments(region):
+    """Contiguous byte segments covering ``region`` in C order, None if there are too many"""
+    lead = 0
+    while not region[(0,) * lead + (Ellipsis,)].flags.c_contiguous:
+        lead += 1
+    count = int(np.prod(region.shape[:lead], dtype=np.int64))
+    if count > MAX_SEGMENTS:
+        return None
+    return [memoryview(region[index + (Ellipsis,)].reshape(-1).view(np.uint8))
+            for index in np.ndindex(*region.shape[:lead])]
+
+
+class ArrayAssembler():
+    """
+    One array rebuilt from its chunks into a preallocated buffer.
+
+    Parameters
+    ----------
+    name :
+        Name of the array.
+    shape, dtype :
+        Shape and dtype of the whole array.
+    out :
+        Optional preallocated array to fill, ``np.empty(shape, dtype)`` by default.
+    """
+    def __init__(self, name, shape, dtype, out=None):
+        self.name = name
+        self.array = np.empty(shape, dtype) if out is None else out
+        if self.array.shape != tuple(shape) or self.array.dtype != dtype:
+            raise ValueError(f"Buffer of {self.array.shape} {self.array.dtype} given for array "
+                             f"{name} of {tuple(shape)} {dtype}")
+        self.chunks = set()
+        # chunks whose data the broker placed directly in the array
+        self.placed = set()
+        self.received = 0
+        self.in_place = 0
+
+    def region(self, metadata):
+        return self.array[tuple(slice(o, o + n) for o, n in zip(metadata["offset"], metadata["shape"]))]
+
+    def target(self, metadata, size):
+        """Segments of the array the data of a chunk can be written to, None if it needs a scratch buffer"""
+        if metadata.get("order", "C") != "C":
+            return None
+        region = self.region(metadata)
+        if region.nbytes != size:
+            return None
+        segments = _segments(region)
+        if segments is not None:
+            self.placed.add(tuple(metadata["chunk"]))
+        return segments
+
+    def add(self, metadata, data):
+        """Account for a chunk received in place, or copy it to its place"""
+        chunk = tuple(metadata["chunk"])
+        if chunk in self.placed:
+            self.placed.discard(chunk)
+            self.in_place += 1
+        else:
+            self.region(metadata)[...] = chunk_view(metadata, data)
+        self.chunks.add(chunk)
+        self.received += int(metadata["nbytes"])
+
+    @property
+    def complete(self):
+        return self.received >= self.array.nbytes
+
+
+class ArrayAssemblers():
+    """
+    Arrays rebuilt by a consumer of ``array_chunk`` events, indexed by name.
+
+    Give ``broker`` to the Mofka consumer as its ``data_broker`` and call ``add``
+    with the metadata and data of every event pulled.
+
+    Parameters
+    ----------
+    allocate :
+        Optional ``allocate(name, shape, dtype) -> array`` giving the buffer of a new
+        array, to rebuild arrays into memory owned by the application.
+    """
+    def __init__(self, allocate=None):
+        self.allocate = allocate
+        self.arrays = {}
+
+    def assembler(self, metadata):
+        assembler = self.arrays.get(metadata["array"])
+        if assembler is None:
+            name = metadata["array"]
+            shape = tuple(metadata["global_shape"])
+            dtype = np.lib.format.descr_to_dtype(metadata["dtype"])
+            out = self.allocate(name, shape, dtype) if self.allocate is not None else None
+            assembler = self.arrays[name] = ArrayAssembler(name, shape, dtype, out)
+        return assembler
+
+    def broker(self, metadata, descriptor):
+        """Mofka data broker placing the chunks directly in their array when possible"""
+        if isinstance(metadata, str):
+            metadata = json.loads(metadata)
+        if metadata.get("action") == ACTION:
+            segments = self.assembler(metadata).target(metadata, descriptor.size)
+            if segments is not None:
+                return segments
+        return [bytearray(descriptor.size)]
+
+    def add(self, metadata, data):
+        """Add a pulled chunk, returns its ArrayAssembler"""
+        assembler = self.assembler(metadata)
+        assembler.add(metadata, data)
+        return assembler
@@ -0,0 +1,219 @@
+"""
+Columnar tables filled by the consumers.
+
+Appending every decoded batch to a DataFrame with ``pd.concat`` copies the whole
+table each time, which makes the ingest quadratic. A TableBuilder keeps one
+growable array per column instead: numeric columns are typed numpy arrays whose
+capacity doubles when full, and string columns hold int32 codes into a
+dictionary of the strings seen so far, since most of them (states, prefixes,
+workers) repeat. The DataFrame is only built by ``frame``, in O(rows), with the
+string columns as categoricals.
+"""
+import numpy as np
+
+# table (and CSV file) of the consumers every action is appended to
+TABLES = {"scheduler_transition" : "scheduler_transition",
+          "worker_transition"    : "worker_transition",
+          "worker_transfer"      : "worker_transfer",
+          "update_graph"         : "graph",
+          "worker_telemetry"     : "worker_telemetry",
+          "worker_spill"         : "worker_spill",
+          "memory_threshold"     : "memory_threshold",
+          "add_worker"           : "worker",
+          "remove_worker"        : "worker",
+          "add_client"           : "client",
+          "remove_client"        : "client",
+          "sampling_stats"       : "sampling",
+          "transition_summary"   : "transition_summary",
+          "latency_histogram"    : "latency_histogram",
+          "stall_report"         : "stall_report"}
+
+# a string column whose values are mostly unique is not worth a dictionary
+MIN_ROWS_FOR_RATIO = 1024
+MAX_CATEGORY_RATIO = 0.5
+
+
+def _as_array(values):
+    """1-d numpy array of a batch of values, numeric when all of them are numbers"""
+    if isinstance(values, np.ndarray) and values.ndim == 1:
+        return values
+    array = np.empty(len(values), dtype=object)
+    for i, v in enumerate(values):
+        array[i] = v
+    if len(array) and all(isinstance(v, (int, float)) for v in array):
+        return np.array(list(values))
+    return array
+
+
+def _is_strings(values):
+    return values.dtype == object and all(v is None or isinstance(v, str) for v in values[:64])
+
+
+class ColumnBuilder():
+    """
+    One growable column: a typed numpy array, int32 codes of strings, or Python objects.
+
+    The kind is chosen from the first values appended, and widened when later
+    values do not fit: integers become floats when values are missing or when
+    floats show up, and strings become objects when they stop repeating.
+    """
+    def __init__(self, capacity=1024):
+        self.data = None
+        self.kind = None
+        self.size = 0
+        self.capacity = capacity
+        # missing values before the first values, padded once the kind is known
+        self.leading = 0
+        # string -> code, and the strings by code, for the "category" kind
+        self.codes = None
+        self.categories = None
+
+    def __len__(self):
+        return self.size + self.leading
+
+    def _reserve(self, n):
+        needed = self.size + n
+        if needed <= len(self.data):
+            return
+        grown = np.empty(max(needed, 2 * len(self.data)), dtype=self.data.dtype)
+        grown[:self.size] = self.data[:self.size]
+        self.data = grown
+
+    def _start(self, values):
+        if _is_strings(values):
+            self.kind = "category"
+            self.codes = {}
+            self.categories = []
+            dtype = np.int32
+        elif values.dtype == object:
+            self.kind = "object"
+            dtype = object
+        else:
+            self.kind = "numeric"
+            dtype = values.dtype
+        self.data = np.empty(max(self.capacity, len(values)), dtype=dtype)
+
+    def _encode(self, values):
+        codes = self.codes
+        out = np.empty(len(values), dtype=np.int32)
+        for i, v in enumerate(values.tolist()):
+            if v is None:
+                out[i] = -1
+                continue
+            code = codes.get(v)
+            if code is None:
+                code = codes[v] = len(self.categories)
+                self.categories.append(v)
+            out[i] = code
+        return out
+
+    def _to_objects(self):
+        """Give up the dictionary of a string column"""
+        categories = np.array(self.categories + [None], dtype=object)
+        data = np.empty(len(self.data), dtype=object)
+        data[:self.size] = categories[self.data[:self.size]]
+        self.data = data
+        self.kind = "object"
+        self.codes = self.categories = None
+
+    def _widen(self, dtype):
+        if np.dtype(dtype) != self.data.dtype:
+            self.data = self.data.astype(dtype)
+
+    def append(self, values):
+        values = _as_array(values)
+        if self.kind is None:
+            self._start(values)
+            if self.leading:
+                leading, self.leading = self.leading, 0
+                self.pad(leading)
+        n = len(values)
+        if self.kind == "category":
+            if not _is_strings(values) or (self.size >= MIN_ROWS_FOR_RATIO and
+                                           len(self.categories) > MAX_CATEGORY_RATIO * self.size):
+                self._to_objects()
+            else:
+                values = self._encode(values)
+        if self.kind == "numeric":
+            if values.dtype == object:
+                self._widen(object)
+                self.kind = "object"
+            else:
+                self._widen(np.result_type(self.data.dtype, values.dtype))
+        self._reserve(n)
+        self.data[self.size:self.size + n] = values
+        self.size += n
+
+    def pad(self, n):
+        """Append ``n`` missing values"""
+        if self.kind is None:
+            self.leading += n
+            return
+        if self.kind == "numeric":
+            if self.data.dtype.kind in "biu":
+                self._widen(np.float64)
+            missing = np.nan if self.data.dtype.kind in "fc" else None
+            if missing is None:
+                self._widen(object)
+                self.kind = "object"
+        elif self.kind == "category":
+            missing = -1
+        else:
+            missing = None
+        self._reserve(n)
+        self.data[self.size:self.size + n] = missing
+        self.size += n
+
+    def values(self):
+        """The column as an array, a pandas Categorical for the string columns"""
+        if self.kind is None:
+            return np.full(self.leading, None, dtype=object)
+        data = self.data[:self.size]
+        if self.kind == "category":
+            import pandas as pd
+            return pd.Categorical.from_codes(data, self.categories)
+        return data
+
+
+class TableBuilder():
+    """
+    Rows of one table, appended by batches of columns.
+
+    ``append`` takes a dict mapping the column names to arrays or lists of the
+    same length. Columns missing from a batch are filled with missing values,
+    and a column showing up late is filled for the rows before it.
+    """
+    def __init__(self):
+        self.columns = {}
+        self.rows = 0
+        self.frame_cache = None
+
+    def __len__(self):
+        return self.rows
+
+    def append(self, columns):
+        n = None
+        for name, values in columns.items():
+            if n is None:
+                n = len(values)
+            column = self.columns.get(name)
+            if column is None:
+                column = self.columns[name] = ColumnBuilder()
+                if self.rows:
+                    column.pad(self.rows)
+            column.append(values)
+        if not n:
+            return
+        for name, column in self.columns.items():
+            if name not in columns:
+                column.pad(n)
+        self.rows += n
+        self.frame_cache = None
+
+    def frame(self):
+        """The table as a DataFrame, built once per batch of appends"""
+        import pandas as pd
+
+        if self.frame_cache is None:
+            self.frame_cache = pd.DataFrame({name: column.values() for name, column in self.columns.items()})
+        return self.frame_cache
@@ -0,0 +1,135 @@
+"""
+Background connection of the plugins to Mofka.
+
+Creating the Margo engine, reading the group file and opening (or creating) the
+topics takes time, and the group file may not even exist yet when Dask starts.
+The plugins do not do it in their constructor: they start a MofkaConnection,
+buffer their events meanwhile, and push them once it is ready. ``pymargo`` and
+``mochi.mofka.client`` are only imported by the connection thread, so
+preloading a plugin does not slow down the start of Dask.
+"""
+import os
+import time
+import logging
+import threading
+
+from mofkadask.encoding import BinaryEncoder
+from mofkadask.partitioning import PartitionSelector
+from mofkadask.topics import TopicProducers, action_topics, open_topics
+
+
+class MofkaConnection():
+    """
+    Mofka engine, driver, topics, producer and encoder of one plugin.
+
+    ``connect`` does the work and returns the producer and the encoder, ``start``
+    runs it in a background thread. ``ready`` is set once it finished, with
+    ``producer`` and ``encoder`` set, or ``error`` if it failed.
+
+    Parameters
+    ----------
+    mofka_protocol :
+        Margo protocol.
+    group_file :
+        Mofka group file, waited for if it does not exist yet.
+    producer_name :
+        Name of the producers.
+    topic_name, topic_layout, partitions, partition_by :
+        Topics to open and partition selection, see ``open_topics`` and PartitionSelector.
+    group_file_timeout :
+        Seconds to wait for the group file before giving up.
+    """
+    def __init__(self, mofka_protocol, group_file, producer_name, topic_name="Dask", topic_layout="single",
+                 partitions=1, partition_by="worker", group_file_timeout=600.0):
+        self.mofka_protocol = mofka_protocol
+        self.group_file = group_file
+        self.producer_name = producer_name
+        self.topic_name = topic_name
+        self.topic_layout = topic_layout
+        self.partitions = partitions
+        self.partition_by = partition_by
+        self.group_file_timeout = group_file_timeout
+        self.engine = None
+        self.driver = None
+        self.producer = None
+        self.encoder = None
+        self.error = None
+        self.ready = threading.Event()
+        self.thread = None
+
+    def wait_for_group_file(self, stopped=None):
+        deadline = time.time() + self.group_file_timeout
+        delay = 0.05
+        while not os.path.exists(self.group_file):
+            if time.time() > deadline:
+                raise TimeoutError(f"Mofka group file {self.group_file} not found "
+                                   f"after {self.group_file_timeout}s")
+            if stopped is not None and stopped():
+                raise RuntimeError(f"Stopped while waiting for the Mofka group file {self.group_file}")
+            time.sleep(delay)
+            delay = min(2 * delay, 1.0)
+
+    def connect(self, stopped=None):
+        """
+        Connect to Mofka, in the calling thread.
+
+        ``stopped()`` is polled while the group file does not exist, connecting
+        is abandoned once it returns True.
+
+        Returns
+        -------
+            The producer and the encoder of the events.
+        """
+        t0 = time.time()
+        self.wait_for_group_file(stopped)
+        from pymargo.core import Engine
+        import mochi.mofka.client as mofka
+
+        if self.engine is None:
+            self.engine = Engine(self.mofka_protocol, use_progress_thread=True)
+        if self.driver is None:
+            self.driver = mofka.MofkaDriver(self.group_file, self.engine)
+        topics, npartitions = open_topics(self.driver, self.topic_name, self.topic_layout, self.partitions)
+        selector = PartitionSelector(self.partition_by, npartitions) if npartitions > 1 else None
+        producer = TopicProducers(topics, self.producer_name, mofka.AdaptiveBatchSize,
+                                  mofka.ThreadPool(1), mofka.Ordering.Strict)
+        self.encoder = BinaryEncoder(selector=selector, topics=action_topics(self.topic_name, self.topic_layout))
+        # set last, the plugins check it to know if the connection is ready
+        self.producer = producer
+        logging.info("Mofka producer %s is created in %.3fs", self.producer_name, time.time() - t0)
+        return self.producer, self.encoder
+
+    def start(self, callback=None, retry_timeout=60.0):
+        """
+        Connect in a background thread, then call ``callback()`` from that thread.
+
+        A failed attempt (e.g. a topic being created by another component) is
+        retried with backoff for ``retry_timeout`` seconds before ``error`` is set.
+        """
+        def run():
+            deadline = time.time() + retry_timeout
+            delay = 0.5
+            while True:
+                try:
+                    self.connect()
+                    self.error = None
+                    break
+                except Exception as Argument:
+                    self.error = Argument
+                    if time.time() + delay > deadline:
+                        logging.exception("Mofka producer %s could not connect", self.producer_name)
+                        break
+                    logging.warning("Mofka producer %s could not connect (%s), retrying in %.1fs",
+                                    self.producer_name, Argument, delay)
+                    time.sleep(delay)
+                    delay = min(2 * delay, 10.0)
+            self.ready.set()
+            if callback is not None:
+                callback()
+        self.thread = threading.Thread(target=run, name=f"{self.producer_name}-connect", daemon=True)
+        self.thread.start()
+
+    def wait(self, timeout=None):
+        """Wait for the background connection, returns True if it succeeded"""
+        self.ready.wait(timeout)
+        return self.producer is not None
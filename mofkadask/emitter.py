@@ -0,0 +1,448 @@
+import time
+import logging
+import threading
+
+OVERFLOW_POLICIES = ("block", "drop-oldest", "sample")
+
+
+def encode_repr(action, records):
+    """Encode events the way the plugins always did: one event per repr of a record dict"""
+    return [({"action": action}, str(record).encode("utf-8")) for record in records]
+
+
+def split_runs(items):
+    """Split (action, record) pairs into runs of consecutive events of the same action, keeping their order"""
+    runs = []
+    for action, record in items:
+        if runs and runs[-1][0] == action:
+            runs[-1][1].append(record)
+        else:
+            runs.append((action, [record]))
+    return runs
+
+
+class RingBuffer():
+    """
+    Bounded in-process ring buffer between the Dask event loop and the drain thread.
+
+    Parameters
+    ----------
+    capacity :
+        Maximum number of events held in memory.
+    overflow :
+        What ``put`` does when the buffer is full. One of
+        ``block`` (wait for the drain thread to make room),
+        ``drop-oldest`` (overwrite the oldest event), or
+        ``sample`` (keep one new event out of ``sample_every``, overwriting
+        the oldest one, and drop the others).
+    sample_every :
+        Sampling stride used by the ``sample`` policy.
+    """
+    def __init__(self, capacity, overflow="block", sample_every=10):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow!r}, expected one of {OVERFLOW_POLICIES}")
+        self.capacity = capacity
+        self.overflow = overflow
+        self.sample_every = max(1, sample_every)
+        self.slots = [None] * capacity
+        self.head = 0
+        self.count = 0
+        self.dropped = 0
+        self.overflowed = 0
+        # events that left the buffer, taken or overwritten
+        self.removed = 0
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+    def __len__(self):
+        return self.count
+
+    def put(self, item, overflow=None):
+        """Enqueue one event, applying the overflow policy (``overflow`` if given) if the buffer is full"""
+        overflow = self.overflow if overflow is None else overflow
+        with self.lock:
+            if self.count == self.capacity:
+                self.overflowed += 1
+                if overflow == "block":
+                    while self.count == self.capacity:
+                        self.not_full.wait()
+                elif overflow == "sample" and self.overflowed % self.sample_every:
+                    self.dropped += 1
+                    return False
+                else:
+                    # overwrite the oldest event
+                    self.head = (self.head + 1) % self.capacity
+                    self.count -= 1
+                    self.dropped += 1
+                    self.removed += 1
+            self.slots[(self.head + self.count) % self.capacity] = item
+            self.count += 1
+            self.not_empty.notify()
+            return True
+
+    def take(self, max_items, timeout=None):
+        """Dequeue up to ``max_items`` events, waiting at most ``timeout`` seconds for the first one"""
+        with self.lock:
+            if not self.count:
+                self.not_empty.wait(timeout)
+            n = min(self.count, max_items)
+            items = []
+            for _ in range(n):
+                items.append(self.slots[self.head])
+                self.slots[self.head] = None
+                self.head = (self.head + 1) % self.capacity
+            self.count -= n
+            self.removed += n
+            if n:
+                self.not_full.notify_all()
+            return items
+
+    def mark(self):
+        """Value ``removed`` reaches once every event currently buffered left the buffer"""
+        with self.lock:
+            return self.removed + self.count
+
+    def wake(self):
+        with self.lock:
+            self.not_empty.notify_all()
+
+
+class BatchingEmitter():
+    """
+    BatchingEmitter moves Mofka pushes out of the Dask event loop.
+
+    Plugin hooks call ``emit`` which only enqueues the raw event into a bounded
+    ring buffer. A dedicated drain thread takes events out in batches, encodes
+    them, pushes them with the Mofka producer and waits for the batch futures,
+    so the scheduler (or worker) never waits on a Mofka round trip.
+
+    Parameters
+    ----------
+    producer :
+        The Mofka producer events are pushed with, None with ``connect``.
+    encode :
+        ``encode(action, records) -> [(metadata, data), ...]``, called on the drain
+        thread for every run of consecutive events of the same action.
+        If ``data`` is None, only the metadata is pushed. Events whose metadata has
+        a ``partition`` entry are pushed to that partition of the topic.
+    capacity :
+        Size of the ring buffer, in events.
+    batch_size :
+        Maximum number of events pushed before waiting on their futures.
+    overflow :
+        Overflow policy of the ring buffer: ``block``, ``drop-oldest`` or ``sample``.
+    sample_every :
+        Sampling stride of the ``sample`` overflow policy.
+    interval :
+        Maximum time in seconds the drain thread sleeps while the buffer is empty.
+    name :
+        Name of the drain thread, also used in log messages.
+    metrics :
+        Optional PluginMetrics observing the encode, push and flush times, and
+        counting the pushed events and bytes.
+    monitor :
+        Optional LoopMonitor told how long every ``emit`` took, since ``emit`` runs
+        on the event loop and blocks when the buffer is full with the ``block``
+        overflow policy.
+    connect :
+        Optional ``connect(stopped) -> (producer, encode)``, a MofkaConnection
+        ``connect`` for instance. It is called on the drain thread before the first
+        push, so the emitter buffers the events emitted until the producer is ready.
+        Failed attempts are retried until the emitter is closed, ``stopped()``
+        returns True once it is. Until the first connection succeeds, a full
+        buffer drops its oldest events (counted in ``dropped``) whatever the
+        overflow policy, so ``emit`` never blocks the event loop on a Mofka
+        that is not there yet.
+    spool :
+        Optional Spool (see ``mofkadask.spool``) the events go to instead of the
+        buffer when it is more than ``spool_threshold`` full, and the events whose
+        push failed. The drain thread replays them once the buffer is empty, with
+        the same backoff as ``connect`` after a failure, and every event goes
+        through the spool until it is replayed, the buffered ones included, so the
+        order is kept. Only the events of a batch pushed after one whose future
+        failed can overtake it. ``flush`` does not wait for the spooled events.
+    spool_threshold :
+        Fraction of the buffer capacity above which the events are spooled.
+    """
+    def __init__(self, producer, encode=encode_repr, capacity=65536, batch_size=1024,
+                 overflow="block", sample_every=10, interval=0.1, name="mofka-emitter", metrics=None,
+                 monitor=None, connect=None, spool=None, spool_threshold=0.5):
+        self.producer = producer
+        self.connect = connect
+        # the overflow policy applies once connected, before that the oldest events are dropped
+        self.connected = connect is None
+        self.encode = encode
+        self.batch_size = batch_size
+        self.interval = interval
+        self.name = name
+        self.metrics = metrics
+        self.monitor = monitor
+        self.buffer = RingBuffer(capacity, overflow, sample_every)
+        self.spool = spool
+        self.spool_limit = max(1, int(spool_threshold * capacity))
+        # appends to the spool from both threads keep the order of the events under spool_lock
+        self.spool_lock = threading.Lock()
+        # set when the buffered events must go to the spool before being pushed
+        self.spilling = False
+        self.pushed = 0
+        self.failed = 0
+        self.batches = 0
+        self.closed = False
+        # pending flush requests: [(buffer mark, threading.Event)]
+        self.flush_requests = []
+        self.flush_lock = threading.Lock()
+        self.thread = threading.Thread(target=self._drain, name=name, daemon=True)
+        self.thread.start()
+
+    def emit(self, action, record):
+        """Hand one event to the drain thread. This is the only cost paid on the hot path."""
+        if self.closed:
+            logging.warning("%s: %s event emitted after close is dropped", self.name, action)
+            return False
+        if self.monitor is None:
+            return self._put(action, record)
+        t0 = time.perf_counter()
+        queued = self._put(action, record)
+        self.monitor.pushed(action, time.perf_counter() - t0)
+        return queued
+
+    def _put(self, action, record):
+        spool = self.spool
+        if spool is not None and (spool.active or len(self.buffer) >= self.spool_limit):
+            # mofka is behind or failing, do not make the event loop wait for it
+            with self.spool_lock:
+                if not self.connected:
+                    # nothing drains the buffer yet, its events are spooled first
+                    self._spill(len(self.buffer))
+                if not len(self.buffer):
+                    spool.append(action, record)
+                    return True
+                # the drain thread spools the events buffered before this one first
+                self.spilling = True
+        if not self.connected:
+            return self.buffer.put((action, record), "drop-oldest")
+        return self.buffer.put((action, record))
+
+    def flush(self, timeout=None):
+        """
+        Block until every event emitted before this call is pushed and the
+        producer is flushed. Returns False if ``timeout`` expired first.
+        """
+        return self.request_flush().wait(timeout)
+
+    def request_flush(self):
+        """Non-blocking ``flush``, returns a threading.Event set once the flush is done"""
+        done = threading.Event()
+        if self.closed:
+            done.set()
+            return done
+        with self.flush_lock:
+            self.flush_requests.append((self.buffer.mark(), done))
+        self.buffer.wake()
+        return done
+
+    def _serve_flushes(self, force=False):
+        with self.flush_lock:
+            if not self.flush_requests:
+                return
+            removed = self.buffer.removed
+            ready = [r for r in self.flush_requests if force or r[0] <= removed]
+            if not ready:
+                return
+            self.flush_requests = [r for r in self.flush_requests if not (force or r[0] <= removed)]
+        t0 = time.perf_counter()
+        try:
+            if self.producer is not None:
+                self.producer.flush()
+        except Exception:
+            logging.exception("%s: exception while flushing the producer", self.name)
+        if self.metrics is not None:
+            self.metrics.observe("flush", time.perf_counter() - t0)
+        for _, done in ready:
+            done.set()
+
+    @property
+    def queued(self):
+        return len(self.buffer)
+
+    @property
+    def dropped(self):
+        return self.buffer.dropped
+
+    def stats(self):
+        """Delivery counters of this emitter"""
+        return {"queued"   : len(self.buffer),
+                "dropped"  : self.buffer.dropped,
+                "overflow" : self.buffer.overflowed,
+                "pushed"   : self.pushed,
+                "failed"   : self.failed,
+                "batches"  : self.batches,
+                "spooled"  : self.spool.appended if self.spool is not None else 0,
+                "spool"    : len(self.spool) if self.spool is not None else 0,
+                }
+
+    def _push_batch(self, items, replay=False):
+        """Push a batch and wait for it, returns False if some of its events failed"""
+        runs = split_runs(items)
+        # futures of the pushes, with the index of their run
+        futures = []
+        failed = set()
+        push_time = 0.0
+        nbytes = 0
+        for i, (action, records) in enumerate(runs):
+            if failed and self.spool is not None and not replay:
+                # spooled after the failed run, to keep the order
+                failed.add(i)
+                continue
+            try:
+                t0 = time.perf_counter()
+                events = self.encode(action, records)
+                t1 = time.perf_counter()
+            except Exception:
+                # pushing them again would not help, they are not spooled
+                self.failed += len(records)
+                if self.metrics is not None:
+                    self.metrics.failed += len(records)
+                logging.exception("%s: exception while encoding %d %s events", self.name, len(records), action)
+                continue
+            try:
+                for metadata, data in events:
+                    partition = metadata.get("partition")
+                    kwargs = {} if partition is None else {"partition": partition}
+                    if data is None:
+                        futures.append((i, self.producer.push(metadata, **kwargs)))
+                    else:
+                        futures.append((i, self.producer.push(metadata, data, **kwargs)))
+                        nbytes += len(data)
+                push_time += time.perf_counter() - t1
+                if self.metrics is not None:
+                    self.metrics.observe("encode", t1 - t0)
+            except Exception:
+                failed.add(i)
+                logging.exception("%s: exception while pushing %d %s events", self.name, len(records), action)
+        t0 = time.perf_counter()
+        pushed = 0
+        for i, f in futures:
+            try:
+                f.wait()
+                pushed += 1
+            except Exception:
+                failed.add(i)
+                logging.exception("%s: exception while waiting for a push", self.name)
+        self.pushed += pushed
+        self.batches += 1
+        if self.metrics is not None:
+            self.metrics.observe("push", push_time + time.perf_counter() - t0)
+            self.metrics.pushed(pushed, nbytes)
+        if failed:
+            self._push_failed([runs[i] for i in sorted(failed)], replay)
+        return not failed
+
+    def _push_failed(self, runs, replay):
+        """Spool the events of the runs that failed, or count them as lost"""
+        # a lost dictionary delta would make the next frames unreadable
+        resend = getattr(self.encode, "resend", None)
+        if resend is not None:
+            resend()
+        if self.spool is not None:
+            self.spool.backoff()
+        if replay:
+            # still in the spool, pushed again by the next replay
+            return
+        if self.spool is not None:
+            with self.spool_lock:
+                for action, records in runs:
+                    for record in records:
+                        self.spool.append(action, record)
+            return
+        for action, records in runs:
+            self.failed += len(records)
+            if self.metrics is not None:
+                self.metrics.failed += len(records)
+
+    def _spill(self, max_items):
+        """Move the oldest buffered events to the spool, called with ``spool_lock`` held"""
+        for action, record in self.buffer.take(max_items, 0):
+            self.spool.append(action, record)
+
+    def _replay(self):
+        """Push the next spooled events, forgetting them once their push succeeded"""
+        items = self.spool.take(self.batch_size)
+        if self._push_batch(items, replay=True):
+            self.spool.commit()
+            self.spool.replayed_ok()
+        else:
+            # the events pushed before the failure are pushed twice
+            self.spool.rewind()
+
+    def _connect(self):
+        """Call ``connect`` until it succeeds, returns False if the emitter was closed first"""
+        delay = 1.0
+        while True:
+            try:
+                self.producer, encode = self.connect(lambda: self.closed)
+                self.encode = encode
+                self.connected = True
+                if self.buffer.dropped:
+                    logging.warning("%s: %d events were dropped while connecting to Mofka", self.name,
+                                    self.buffer.dropped)
+                return True
+            except Exception:
+                logging.exception("%s: exception while connecting to Mofka", self.name)
+            retry = time.time() + delay
+            while time.time() < retry:
+                if self.closed:
+                    return False
+                time.sleep(0.1)
+            delay = min(2 * delay, 30.0)
+
+    def _drain(self):
+        if self.connect is not None and not self._connect():
+            if self.spool is not None:
+                with self.spool_lock:
+                    self._spill(len(self.buffer))
+                self.spool.close()
+                return
+            items = self.buffer.take(len(self.buffer))
+            self.failed += len(items)
+            logging.error("%s: closed before connecting to Mofka, %d events are lost", self.name, len(items))
+            return
+        while True:
+            replay = self.spool is not None and self.spool.due()
+            if self.spool is not None and (self.spool.active or self.spilling) and len(self.buffer):
+                # events spooled before the buffered ones are not pushed yet
+                with self.spool_lock:
+                    self._spill(self.batch_size)
+                    if not len(self.buffer):
+                        self.spilling = False
+                if replay:
+                    self._replay()
+                self._serve_flushes()
+                continue
+            items = self.buffer.take(self.batch_size, 0 if replay else self.interval)
+            if items:
+                self._push_batch(items)
+            elif replay:
+                self._replay()
+            elif self.closed:
+                break
+            self._serve_flushes()
+        if self.spool is not None:
+            # the events left are replayed by python -m mofkadask.spool
+            self.spool.close()
+
+    def close(self, timeout=None):
+        """Drain the remaining events, stop the drain thread and flush the producer"""
+        if self.closed:
+            return
+        self.closed = True
+        self.buffer.wake()
+        self.thread.join(timeout)
+        self._serve_flushes(force=True)
+        try:
+            if self.producer is not None:
+                self.producer.flush()
+        except Exception:
+            logging.exception("%s: exception while flushing the producer", self.name)
+        logging.info("%s closed: %s", self.name, self.stats())
@@ -0,0 +1,665 @@
+"""
+Versioned, schema driven binary encoding of the events pushed by the plugins.
+
+One frame holds ``count`` events of the same action, stored column by column::
+
+    header   : magic "MD", version (u8), schema id (u8), count (u32)
+    column   : flag (u8), validity bitmap if flag == 1, then the values
+      f64    : count little-endian float64
+      i64    : count little-endian int64
+      cat    : count little-endian uint32 dictionary ids
+      str    : count u32 lengths, then the concatenated utf-8 bytes
+      delta  : width (u8), then if count > 0 the first value (i64) and the
+               count - 1 differences between consecutive values, as
+               little-endian signed integers of ``width`` bytes (1, 2, 4 or 8)
+
+Nulls (None) are allowed in every column. Columns without nulls have no bitmap.
+Null values of ``delta`` columns repeat the previous value (a zero difference).
+
+``delta`` columns hold slowly varying integers sampled periodically (memory,
+counters), whose differences fit in one or two bytes most of the time.
+
+Repeated strings (task prefixes, groups, states, worker and scheduler addresses)
+are ``cat`` columns. Every producer keeps its own string dictionary and pushes a
+``dictionary_delta`` frame with the new (id, value) pairs right before the first
+frame that uses them. Events carry the producer dictionary name as ``source`` in
+their metadata so the consumer knows which dictionary to resolve ids with. On a
+multi-partition topic, or when event classes have their own topics, the
+dictionaries are per topic and partition, and events also carry their ``topic``
+and ``partition``: consumers key dictionaries on (source, topic, partition).
+
+Graphs submitted with ``update_graph`` are not frames: they are pushed as
+``graph_chunk`` events in the CSR chunk format of ``mofkadask.graph``, followed by
+an ``update_graph`` frame summarizing the graph.
+
+Frames of the older versions of the format (spooled events, producers not
+upgraded yet) are still decoded: ``LEGACY_FIELDS`` holds the fields of the
+schemas that changed since, the fields added since are null and the ``str``
+columns that became ``cat`` columns are coded by the EventDecoder. The
+``update_graph`` frames holding the keys and dependencies of the graph are
+summarized like the current ones, without the chunks.
+"""
+import ast
+import uuid
+import struct
+
+import numpy as np
+
+from mofkadask.graph import encode_graph
+
+FORMAT = "mofkadask"
+VERSION = 4
+# action of the events spooled once encoded, ``(metadata, data)`` pairs pushed again as they are
+ENCODED = "encoded"
+MAGIC = b"MD"
+
+HEADER = struct.Struct("<2sBBI")
+
+F64 = "f64"
+I64 = "i64"
+CAT = "cat"
+STR = "str"
+DLT = "delta"
+
+# number of log2 bins of the duration histograms of transition summaries and latency histograms
+DURATION_BINS = 24
+
+
+class Schema():
+    """Ordered (name, type) fields of one action"""
+    def __init__(self, schema_id, action, fields):
+        self.schema_id = schema_id
+        self.action = action
+        self.fields = fields
+        self.names = [name for name, _ in fields]
+        self.categorical = [name for name, kind in fields if kind == CAT]
+
+    def __repr__(self):
+        return f"Schema({self.schema_id}, {self.action!r})"
+
+
+SCHEMAS = [
+    Schema(0, "dictionary_delta", [("id", I64), ("value", STR)]),
+    Schema(1, "scheduler_transition", [("key", STR),
+                                       ("thread", I64),
+                                       ("worker", CAT),
+                                       ("prefix", CAT),
+                                       ("group", CAT),
+                                       ("start", CAT),
+                                       ("finish", CAT),
+                                       ("stimulus_id", STR),
+                                       ("called_from", CAT),
+                                       ("begins", F64),
+                                       ("ends", F64),
+                                       ("duration", F64),
+                                       ("size", I64),
+                                       ("time", F64),
+                                       ("queue_latency", F64),
+                                       ("dispatch_latency", F64),
+                                       ("exec_latency", F64)]),
+    Schema(2, "worker_transition", [("key", STR),
+                                    ("start", CAT),
+                                    ("finish", CAT),
+                                    ("called_from", CAT),
+                                    ("time", F64)]),
+    Schema(3, "worker_transfer", [("type", CAT),
+                                  ("who", CAT),
+                                  ("keys", STR),
+                                  ("total", I64),
+                                  ("compressed", I64),
+                                  ("bandwidth", F64),
+                                  ("start", F64),
+                                  ("stop", F64),
+                                  ("middle", F64),
+                                  ("duration", F64),
+                                  ("called_from", CAT),
+                                  ("time", F64)]),
+    Schema(4, "update_graph", [("client", CAT),
+                               ("graph_id", STR),
+                               ("ntasks", I64),
+                               ("nkeys", I64),
+                               ("nwanted", I64),
+                               ("nedges", I64),
+                               ("nchunks", I64),
+                               ("time", F64)]),
+    Schema(5, "add_worker", [("worker", CAT), ("time", F64)]),
+    Schema(6, "remove_worker", [("worker", CAT), ("stimulus_id", STR), ("time", F64)]),
+    Schema(7, "add_client", [("client", CAT), ("time", F64)]),
+    Schema(8, "remove_client", [("client", CAT), ("time", F64)]),
+    Schema(9, "restart", [("time", F64)]),
+    Schema(10, "before_close", [("time", F64)]),
+    Schema(11, "close", [("time", F64)]),
+    Schema(12, "log_event", [("topic", CAT), ("message", STR), ("time", F64)]),
+    Schema(13, "sampling_stats", [("source", CAT),
+                                  ("prefix", CAT),
+                                  ("start", CAT),
+                                  ("finish", CAT),
+                                  ("suppressed", I64),
+                                  ("time", F64)]),
+    Schema(14, "transition_summary", [("window_start", F64),
+                                      ("window_end", F64),
+                                      ("prefix", CAT),
+                                      ("worker", CAT),
+                                      ("start", CAT),
+                                      ("finish", CAT),
+                                      ("count", I64),
+                                      ("errors", I64),
+                                      ("duration_sum", F64),
+                                      ("duration_max", F64),
+                                      ("nbytes", I64)]
+                                     + [(f"duration_hist_{i}", I64) for i in range(DURATION_BINS)]),
+    Schema(15, "latency_histogram", [("window_start", F64),
+                                     ("window_end", F64),
+                                     ("prefix", CAT),
+                                     ("latency", CAT),
+                                     ("count", I64),
+                                     ("sum", F64),
+                                     ("max", F64)]
+                                    + [(f"hist_{i}", I64) for i in range(DURATION_BINS)]),
+    Schema(16, "stall_report", [("window_start", F64),
+                                ("window_end", F64),
+                                ("source", CAT),
+                                ("action", CAT),
+                                ("stalls", I64),
+                                ("stall_ms", F64),
+                                ("worst_ms", F64),
+                                ("push_ms", F64),
+                                ("max_lag_ms", F64)]),
+    Schema(17, "worker_telemetry", [("worker", CAT),
+                                    ("time", F64),
+                                    ("cpu", F64),
+                                    ("rss", DLT),
+                                    ("managed", DLT),
+                                    ("unmanaged", DLT),
+                                    ("spilled", DLT),
+                                    ("memory_limit", DLT),
+                                    ("executing", DLT),
+                                    ("ready", DLT),
+                                    ("incoming_count", DLT),
+                                    ("incoming_bytes", DLT),
+                                    ("incoming_total", DLT),
+                                    ("outgoing_count", DLT),
+                                    ("outgoing_bytes", DLT),
+                                    ("outgoing_total", DLT)]),
+    Schema(18, "worker_spill", [("worker", CAT),
+                                ("key", STR),
+                                ("prefix", CAT),
+                                ("direction", CAT),
+                                ("memory_bytes", I64),
+                                ("disk_bytes", I64),
+                                ("duration", F64),
+                                ("disk_time", F64),
+                                ("throughput", F64),
+                                ("time", F64)]),
+    Schema(19, "memory_threshold", [("worker", CAT),
+                                    ("level", CAT),
+                                    ("previous", CAT),
+                                    ("status", CAT),
+                                    ("rss", I64),
+                                    ("managed", I64),
+                                    ("memory_limit", I64),
+                                    ("fraction", F64),
+                                    ("time", F64)]),
+]
+
+SCHEMA_BY_ACTION = {schema.action: schema for schema in SCHEMAS}
+SCHEMA_BY_ID = {schema.schema_id: schema for schema in SCHEMAS}
+CATEGORICAL_FIELDS = {name for schema in SCHEMAS for name in schema.categorical}
+
+# oldest version of the frames still decoded
+MIN_VERSION = 1
+
+
+def _without(fields, names):
+    return [(name, kind) for name, kind in fields if name not in names]
+
+
+def _as_strings(fields):
+    return [(name, STR if kind == CAT else kind) for name, kind in fields]
+
+
+_LATENCIES = ("queue_latency", "dispatch_latency", "exec_latency")
+# update_graph before the graphs were pushed as CSR chunks, within version 2
+_GRAPH_V2 = [("client", CAT), ("keys", STR), ("dependencies", STR), ("time", F64)]
+_V2 = {1: [_without(SCHEMA_BY_ID[1].fields, _LATENCIES)],
+       4: [SCHEMA_BY_ID[4].fields, _GRAPH_V2]}
+# fields of the schemas as written by the older versions, by version and schema id: candidate
+# field lists, the one decoding the whole frame is used
+LEGACY_FIELDS = {
+    # before the dictionaries, every cat column was a str column
+    1 : {schema.schema_id: [_as_strings(fields) for fields in _V2.get(schema.schema_id, [schema.fields])]
+         for schema in SCHEMAS if schema.schema_id},
+    # before the latencies of the scheduler transitions
+    2 : _V2,
+}
+
+
+class StringDictionary():
+    """Producer side string -> id dictionary, remembering the entries not sent yet"""
+    def __init__(self):
+        self.ids = {}
+        self.new = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lookup(self, values):
+        ids = self.ids
+        out = []
+        for v in values:
+            if v is None:
+                out.append(0)
+                continue
+            i = ids.get(v)
+            if i is None:
+                i = ids[v] = len(ids)
+                self.new.append({"id": i, "value": v})
+            out.append(i)
+        return out
+
+    def delta(self):
+        """Return and forget the entries added since the last delta"""
+        new, self.new = self.new, []
+        return new
+
+    def resend(self):
+        """Send every entry again with the next delta, after a push that may have lost one"""
+        self.new = [{"id": i, "value": v} for v, i in self.ids.items()]
+
+
+def _validity(values):
+    bitmap = bytearray((len(values) + 7) // 8)
+    for i, v in enumerate(values):
+        if v is not None:
+            bitmap[i >> 3] |= 1 << (i & 7)
+    return bytes(bitmap)
+
+
+def _encode_column(kind, values, out, dictionary):
+    n = len(values)
+    has_null = None in values
+    if has_null:
+        out.append(b"\x01")
+        out.append(_validity(values))
+    else:
+        out.append(b"\x00")
+    if kind == F64:
+        if has_null:
+            values = [0.0 if v is None else v for v in values]
+        out.append(struct.pack(f"<{n}d", *values))
+    elif kind == I64:
+        if has_null:
+            values = [0 if v is None else v for v in values]
+        out.append(struct.pack(f"<{n}q", *values))
+    elif kind == CAT:
+        out.append(struct.pack(f"<{n}I", *dictionary.lookup(values)))
+    elif kind == DLT:
+        _encode_deltas(values, out)
+    else:
+        encoded = [b"" if v is None else str(v).encode("utf-8") for v in values]
+        out.append(struct.pack(f"<{n}I", *map(len, encoded)))
+        out.append(b"".join(encoded))
+
+
+# struct codes of the signed integers of the delta columns, by width
+DELTA_CODES = {1: "b", 2: "h", 4: "i", 8: "q"}
+
+
+def _encode_deltas(values, out):
+    previous = 0
+    filled = []
+    for v in values:
+        if v is not None:
+            previous = int(v)
+        filled.append(previous)
+    deltas = [b - a for a, b in zip(filled, filled[1:])]
+    width = 1
+    if deltas:
+        bound = max(max(deltas), -min(deltas) - 1)
+        while width < 8 and bound >= 1 << (8 * width - 1):
+            width *= 2
+    out.append(struct.pack("<B", width))
+    if filled:
+        out.append(struct.pack("<q", filled[0]))
+        out.append(struct.pack(f"<{len(deltas)}{DELTA_CODES[width]}", *deltas))
+
+
+def _decode_deltas(buf, offset, n):
+    width = buf[offset]
+    offset += 1
+    if n == 0:
+        return np.empty(0, dtype=np.int64), offset
+    values = np.empty(n, dtype=np.int64)
+    values[0] = np.frombuffer(buf, "<i8", 1, offset)[0]
+    offset += 8
+    values[1:] = np.frombuffer(buf, f"<i{width}", n - 1, offset)
+    offset += width * (n - 1)
+    return np.cumsum(values), offset
+
+
+def encode_frame(action, records, dictionary=None):
+    """
+    Encode a list of record dicts of the same action into one binary frame.
+
+    ``dictionary`` is the StringDictionary used for the ``cat`` columns, it is
+    required by every schema that has one.
+    """
+    schema = SCHEMA_BY_ACTION[action]
+    out = [HEADER.pack(MAGIC, VERSION, schema.schema_id, len(records))]
+    for name, kind in schema.fields:
+        _encode_column(kind, [r.get(name) for r in records], out, dictionary)
+    return b"".join(out)
+
+
+class BinaryEncoder():
+    """
+    Emitter ``encode`` callable producing one binary frame per run of same-action
+    events, preceded by a dictionary delta frame when new strings showed up.
+
+    ``update_graph`` records hold the ``keys`` and ``dependencies`` given to the
+    plugin: they are turned into graph chunks and a summary frame here, on the
+    emitter drain thread, rather than on the scheduler event loop.
+
+    Parameters
+    ----------
+    source :
+        Name of the dictionary of this producer. Must be unique among all the
+        producers writing to the same topic, a random one is used by default.
+    max_chunk_bytes :
+        Maximum size of the graph chunks.
+    selector :
+        ``selector(action, record) -> partition``, a PartitionSelector for instance.
+        When given, every event carries a ``partition`` metadata entry and each
+        partition has its own dictionary, so that the partitions of a topic can be
+        decoded independently of each other.
+    topics :
+        Dict mapping actions to the topic their events go to, when the event
+        classes have their own topics. Events then carry a ``topic`` metadata
+        entry and every topic has its own dictionaries.
+    """
+    def __init__(self, source=None, max_chunk_bytes=1 << 20, selector=None, topics=None):
+        self.source = source or uuid.uuid4().hex
+        self.dictionary = StringDictionary()
+        self.max_chunk_bytes = max_chunk_bytes
+        self.selector = selector
+        self.topics = topics
+        # dictionaries per (topic, partition)
+        self.dictionaries = {}
+
+    def metadata(self, action, count, partition=None, topic=None):
+        metadata = {"action": action, "format": FORMAT, "version": VERSION,
+                    "source": self.source, "count": count}
+        if partition is not None:
+            metadata["partition"] = partition
+        if topic is not None:
+            metadata["topic"] = topic
+        return metadata
+
+    def encode_graphs(self, records, partition=None, topic=None):
+        events = []
+        summaries = []
+        for record in records:
+            graph_id, chunks, summary = encode_graph(record["keys"], record["dependencies"],
+                                                     self.max_chunk_bytes)
+            for seq, chunk in enumerate(chunks):
+                metadata = self.metadata("graph_chunk", 1, partition, topic)
+                metadata.update({"graph_id": graph_id, "seq": seq, "nchunks": len(chunks)})
+                events.append((metadata, chunk))
+            summary.update({"client": record["client"], "time": record["time"]})
+            summaries.append(summary)
+        return events, summaries
+
+    def encode(self, action, records, dictionary, partition=None, topic=None):
+        events = []
+        if action == "update_graph":
+            events, records = self.encode_graphs(records, partition, topic)
+        frame = encode_frame(action, records, dictionary)
+        delta = dictionary.delta()
+        if delta:
+            events.append((self.metadata("dictionary_delta", len(delta), partition, topic),
+                           encode_frame("dictionary_delta", delta)))
+        events.append((self.metadata(action, len(records), partition, topic), frame))
+        return events
+
+    def __call__(self, action, records):
+        if action == ENCODED:
+            return list(records)
+        topic = self.topics[action] if self.topics else None
+        if self.selector is None:
+            if topic is None:
+                return self.encode(action, records, self.dictionary)
+            routed = {None: records}
+        else:
+            # one frame per partition, keeping the order of the records of each partition
+            routed = {}
+            for record in records:
+                routed.setdefault(self.selector(action, record), []).append(record)
+        events = []
+        for partition, part in routed.items():
+            dictionary = self.dictionaries.get((topic, partition))
+            if dictionary is None:
+                dictionary = self.dictionaries[(topic, partition)] = StringDictionary()
+            events.extend(self.encode(action, part, dictionary, partition, topic))
+        return events
+
+    def resend(self):
+        """Send the dictionaries again, the consumers ignore the entries they already know"""
+        for dictionary in [self.dictionary, *self.dictionaries.values()]:
+            dictionary.resend()
+
+
+def _decode_strings(buf, offset, n):
+    lengths = np.frombuffer(buf, "<u4", n, offset)
+    offset += 4 * n
+    ends = np.cumsum(lengths, dtype=np.int64)
+    total = int(ends[-1]) if n else 0
+    blob = bytes(buf[offset:offset + total])
+    starts = (ends - lengths).tolist()
+    ends = ends.tolist()
+    if blob.isascii():
+        # byte offsets are character offsets, decode the blob only once
+        text = blob.decode("ascii")
+        values = [text[a:b] for a, b in zip(starts, ends)]
+    else:
+        values = [blob[a:b].decode("utf-8") for a, b in zip(starts, ends)]
+    return np.array(values, dtype=object), offset + total
+
+
+def decode_frame(buf):
+    """
+    Decode one binary frame.
+
+    Returns
+    -------
+        The action name and a dict mapping every field to a numpy array.
+        Null f64/i64/delta values are NaN (integer columns with nulls become float64),
+        null strings are None and null ``cat`` ids are -1. The ``cat`` columns
+        hold the ids of the producer dictionary, see EventDecoder to resolve them.
+    """
+    buf = memoryview(buf)
+    magic, version, schema_id, n = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a mofkadask binary frame")
+    if not MIN_VERSION <= version <= VERSION:
+        raise ValueError(f"Unsupported mofkadask frame version {version}")
+    schema = SCHEMA_BY_ID[schema_id]
+    candidates = LEGACY_FIELDS.get(version, {}).get(schema_id)
+    if candidates is None:
+        columns, _ = _decode_columns(buf, HEADER.size, n, schema.fields)
+        return schema.action, columns
+    for fields in candidates:
+        try:
+            columns, offset = _decode_columns(buf, HEADER.size, n, fields)
+        except (ValueError, IndexError, UnicodeDecodeError):
+            continue
+        if offset == len(buf):
+            break
+    else:
+        raise ValueError(f"Frame of {schema.action} does not match its version {version} schema")
+    if "dependencies" in columns:
+        columns = _summarize_graphs(columns, n)
+    for name, kind in schema.fields:
+        if name not in columns:
+            # added after this version
+            if kind == STR:
+                columns[name] = np.full(n, None, dtype=object)
+            elif kind == CAT:
+                columns[name] = np.full(n, -1, dtype=np.int64)
+            else:
+                columns[name] = np.full(n, np.nan)
+    return schema.action, columns
+
+
+def _summarize_graphs(columns, n):
+    """
+    Columns of the current ``update_graph`` summary from the ``keys`` and
+    ``dependencies`` strings of the legacy frames, null counts when a graph
+    cannot be parsed back. These graphs were not chunked: ``nchunks`` is 0.
+    """
+    counts = {name: np.full(n, np.nan) for name in ("ntasks", "nkeys", "nwanted", "nedges")}
+    for i, (keys, dependencies) in enumerate(zip(columns["keys"], columns["dependencies"])):
+        try:
+            keys = ast.literal_eval(keys)
+            dependencies = ast.literal_eval(dependencies)
+            table = set(dependencies).union(keys, *dependencies.values())
+        except (ValueError, TypeError, SyntaxError, AttributeError, MemoryError, RecursionError):
+            continue
+        counts["ntasks"][i] = len(dependencies)
+        counts["nkeys"][i] = len(table)
+        counts["nwanted"][i] = len(keys)
+        counts["nedges"][i] = sum(len(deps) for deps in dependencies.values())
+    for name, values in counts.items():
+        if not np.isnan(values).any():
+            counts[name] = values.astype(np.int64)
+    return dict(counts, client=columns["client"], time=columns["time"], nchunks=np.zeros(n, dtype=np.int64))
+
+
+def _decode_columns(buf, offset, n, fields):
+    """Columns of ``fields`` of a frame of ``n`` events from ``offset``, and the offset after them"""
+    columns = {}
+    nbitmap = (n + 7) // 8
+    for name, kind in fields:
+        valid = None
+        if buf[offset]:
+            bits = np.frombuffer(buf, np.uint8, nbitmap, offset + 1)
+            valid = np.unpackbits(bits, count=n, bitorder="little").astype(bool)
+            offset += nbitmap
+        offset += 1
+        if kind == STR:
+            values, offset = _decode_strings(buf, offset, n)
+            if valid is not None:
+                values[~valid] = None
+        elif kind == CAT:
+            values = np.frombuffer(buf, "<u4", n, offset).astype(np.int64)
+            offset += 4 * n
+            if valid is not None:
+                values[~valid] = -1
+        elif kind == DLT:
+            values, offset = _decode_deltas(buf, offset, n)
+            if valid is not None:
+                values = values.astype(np.float64)
+                values[~valid] = np.nan
+        else:
+            values = np.frombuffer(buf, "<f8" if kind == F64 else "<i8", n, offset)
+            offset += 8 * n
+            if valid is not None:
+                values = values.astype(np.float64)
+                values[~valid] = np.nan
+        columns[name] = values
+    return columns, offset
+
+
+class EventDecoder():
+    """
+    Consumer side decoder of binary frames.
+
+    It keeps the dictionary of every producer (``source``) and maps their ids to
+    codes of one global category list, so the ``cat`` columns of all the producers
+    share the same codes and can be turned into pandas categoricals with
+    ``pd.Categorical.from_codes(codes, decoder.categories)``.
+    """
+    def __init__(self):
+        self.categories = []
+        self.codes = {}
+        self.remaps = {}
+
+    def _add_delta(self, source, columns):
+        remap = self.remaps.get(source, np.empty(0, dtype=np.int32))
+        ids = columns["id"]
+        size = max(len(remap), int(ids.max()) + 1) if len(ids) else len(remap)
+        if size > len(remap):
+            grown = np.full(size, -1, dtype=np.int32)
+            grown[:len(remap)] = remap
+            remap = grown
+        for i, value in zip(ids.tolist(), columns["value"]):
+            remap[i] = self._code(value)
+        self.remaps[source] = remap
+
+    def _code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.categories)
+            self.categories.append(value)
+        return code
+
+    def _resolve(self, source, schema, columns):
+        remap = self.remaps.get(source)
+        for name in schema.categorical:
+            ids = columns[name]
+            if ids.dtype == object:
+                # strings of a frame older than the dictionaries
+                columns[name] = np.array([-1 if v is None else self._code(v) for v in ids], dtype=np.int32)
+                continue
+            valid = ids >= 0
+            if remap is None:
+                if valid.any():
+                    raise KeyError(f"No dictionary received from source {source!r}")
+                columns[name] = ids.astype(np.int32)
+                continue
+            columns[name] = np.where(valid, remap[np.where(valid, ids, 0)], -1).astype(np.int32)
+        return columns
+
+    def decode(self, frames):
+        """
+        Decode a batch of (source, frame) pairs in order.
+
+        Dictionary deltas are applied as they come, and the columns of the frames
+        of the same action are concatenated.
+
+        Returns
+        -------
+            A dict mapping every action to a dict of columns, ``cat`` columns hold
+            int32 codes into ``categories`` (-1 for null).
+        """
+        return self.apply([(source, *decode_frame(buf)) for source, buf in frames])
+
+    def apply(self, frames):
+        """
+        Apply a batch of frames decoded with ``decode_frame``, as (source, action,
+        columns) triples, in order. ``decode_frame`` does not depend on the other
+        frames and can run in parallel, this has to see the frames in order.
+        """
+        decoded = {}
+        for source, action, columns in frames:
+            if action == "dictionary_delta":
+                self._add_delta(source, columns)
+                continue
+            columns = self._resolve(source, SCHEMA_BY_ACTION[action], columns)
+            decoded.setdefault(action, []).append(columns)
+        batch = {}
+        for action, parts in decoded.items():
+            if len(parts) == 1:
+                batch[action] = parts[0]
+            else:
+                batch[action] = {name: np.concatenate([p[name] for p in parts]) for name in parts[0]}
+        return batch
+
+    def categorical(self, df):
+        """Return a copy of a DataFrame built from decoded batches with its code columns as categoricals"""
+        import pandas as pd
+
+        df = df.copy()
+        for name in CATEGORICAL_FIELDS.intersection(df.columns):
+            if df[name].dtype.kind in "iu":
+                df[name] = pd.Categorical.from_codes(df[name], self.categories)
+        return df
@@ -0,0 +1,53 @@
+import time
+
+
+class FlushPolicy():
+    """
+    Decides when a producer whose pushes are not waited on must be flushed.
+
+    A flush is due when ``max_events`` events were pushed since the last flush,
+    when the oldest event pushed since the last flush is ``interval`` seconds old,
+    or, if ``on_idle`` is set, as soon as the scheduler or worker is idle while
+    some pushed events were not flushed yet. Setting ``max_events`` or
+    ``interval`` to 0 disables that trigger.
+    """
+    def __init__(self, max_events=1000, interval=1.0, on_idle=True):
+        self.max_events = max_events
+        self.interval = interval
+        self.on_idle = on_idle
+        self.pending = 0
+        self.flushing = False
+        self.last_flush = time.monotonic()
+        # time of the oldest event pushed since the last flush
+        self.oldest = None
+
+    def record(self, n=1):
+        """Count pushed events, returns True when they trigger a flush"""
+        if not self.pending:
+            self.oldest = time.monotonic()
+        self.pending += n
+        return bool(self.max_events) and self.pending >= self.max_events and not self.flushing
+
+    def due(self, is_idle):
+        """
+        Reason of the flush to start now, or None. ``is_idle`` is a callable only
+        called when idleness matters.
+        """
+        if not self.pending or self.flushing:
+            return None
+        if self.interval and time.monotonic() - self.oldest >= self.interval:
+            return "interval"
+        if self.on_idle and is_idle():
+            return "idle"
+        return None
+
+    def start(self):
+        """Mark a flush as started, returns the number of events it covers"""
+        self.flushing = True
+        pending, self.pending = self.pending, 0
+        self.oldest = None
+        return pending
+
+    def done(self):
+        self.flushing = False
+        self.last_flush = time.monotonic()
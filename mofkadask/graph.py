@@ -0,0 +1,219 @@
+"""
+Chunked compressed sparse row (CSR) encoding of the graphs submitted to the scheduler.
+
+A graph is a key table, where every key has flags, a number of dependencies
+(its degree) and the indices of its dependencies in the key table. The tasks of
+the graph come first in the table, followed by the dependencies that are not
+part of the graph (already computed tasks). Offsets are the cumulative sum of
+the degrees.
+
+The key table is split into chunks of bounded size. Each chunk is one Mofka
+event holding a contiguous slice of the table::
+
+    header  : magic "MG", version (u8), reserved (u8), graph id (16 bytes),
+              seq (u32), nchunks (u32), key_base (u64), nkeys (u32), nindices (u32)
+    body    : key lengths (u32 * nkeys), flags (u8 * nkeys), degrees (u32 * nkeys),
+              indices (u32 * nindices), concatenated utf-8 keys
+"""
+import uuid
+import struct
+
+import numpy as np
+
+MAGIC = b"MG"
+VERSION = 1
+
+HEADER = struct.Struct("<2sBB16sIIQII")
+
+# key flags
+WANTED = 1       # the client is interested in this key
+EXTERNAL = 2     # dependency that is not a task of this graph
+
+
+def build_csr(keys, dependencies):
+    """
+    Key table of a graph and its CSR adjacency.
+
+    Returns
+    -------
+        The list of keys (as strings), and the flags, degrees and indices arrays.
+    """
+    index = {}
+    table = []
+    for k in dependencies:
+        index[k] = len(table)
+        table.append(k)
+    ntasks = len(table)
+    degrees = []
+    indices = []
+    for deps in dependencies.values():
+        degrees.append(len(deps))
+        for d in deps:
+            i = index.get(d)
+            if i is None:
+                i = index[d] = len(table)
+                table.append(d)
+            indices.append(i)
+    flags = np.zeros(len(table), dtype=np.uint8)
+    flags[ntasks:] = EXTERNAL
+    for k in keys:
+        i = index.get(k)
+        if i is not None:
+            flags[i] |= WANTED
+    degrees = np.array(degrees + [0] * (len(table) - ntasks), dtype=np.uint32)
+    return [str(k) for k in table], flags, degrees, np.array(indices, dtype=np.uint32)
+
+
+def encode_graph(keys, dependencies, max_chunk_bytes=1 << 20):
+    """
+    Encode a graph into chunks of about ``max_chunk_bytes`` at most (a single key
+    with more dependencies than that still fits in one chunk).
+
+    Returns
+    -------
+        The graph id (hex), the list of encoded chunks and a summary dict.
+    """
+    table, flags, degrees, indices = build_csr(keys, dependencies)
+    encoded = [k.encode("utf-8") for k in table]
+    offsets = np.zeros(len(table) + 1, dtype=np.int64)
+    np.cumsum(degrees, out=offsets[1:])
+    # bytes taken by every key in a chunk
+    sizes = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)) + 9 + 4 * degrees.astype(np.int64)
+
+    bounds = [0]
+    total = 0
+    for i, size in enumerate(sizes.tolist()):
+        if total and total + size > max_chunk_bytes:
+            bounds.append(i)
+            total = 0
+        total += size
+    bounds.append(len(table))
+
+    graph_id = uuid.uuid4()
+    nchunks = len(bounds) - 1
+    chunks = []
+    for seq in range(nchunks):
+        a, b = bounds[seq], bounds[seq + 1]
+        chunk_indices = indices[offsets[a]:offsets[b]]
+        chunk_keys = encoded[a:b]
+        chunks.append(b"".join([
+            HEADER.pack(MAGIC, VERSION, 0, graph_id.bytes, seq, nchunks, a, b - a, len(chunk_indices)),
+            np.fromiter(map(len, chunk_keys), dtype="<u4", count=b - a).tobytes(),
+            flags[a:b].tobytes(),
+            degrees[a:b].astype("<u4").tobytes(),
+            chunk_indices.astype("<u4").tobytes(),
+            b"".join(chunk_keys),
+        ]))
+    summary = {"graph_id": graph_id.hex,
+               "ntasks": int(np.count_nonzero((flags & EXTERNAL) == 0)),
+               "nkeys": len(table),
+               "nwanted": int(np.count_nonzero(flags & WANTED)),
+               "nedges": len(indices),
+               "nchunks": nchunks}
+    return graph_id.hex, chunks, summary
+
+
+def decode_chunk(buf):
+    """Decode one chunk into a dict of its header fields and arrays"""
+    buf = memoryview(buf)
+    magic, version, _, graph_id, seq, nchunks, key_base, nkeys, nindices = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a mofkadask graph chunk")
+    if version != VERSION:
+        raise ValueError(f"Unsupported mofkadask graph chunk version {version}")
+    offset = HEADER.size
+    lengths = np.frombuffer(buf, "<u4", nkeys, offset)
+    offset += 4 * nkeys
+    flags = np.frombuffer(buf, np.uint8, nkeys, offset)
+    offset += nkeys
+    degrees = np.frombuffer(buf, "<u4", nkeys, offset)
+    offset += 4 * nkeys
+    indices = np.frombuffer(buf, "<u4", nindices, offset)
+    offset += 4 * nindices
+    ends = np.cumsum(lengths, dtype=np.int64)
+    blob = bytes(buf[offset:offset + (int(ends[-1]) if nkeys else 0)])
+    starts = (ends - lengths).tolist()
+    keys = [blob[a:b].decode("utf-8") for a, b in zip(starts, ends.tolist())]
+    return {"graph_id": uuid.UUID(bytes=bytes(graph_id)).hex, "seq": seq, "nchunks": nchunks,
+            "key_base": key_base, "keys": keys, "flags": flags, "degrees": degrees, "indices": indices}
+
+
+class TaskGraph():
+    """
+    A submitted graph, as CSR adjacency over its key table.
+
+    ``offsets[i]:offsets[i + 1]`` is the slice of ``indices`` holding the
+    dependencies of ``keys[i]``.
+    """
+    def __init__(self, graph_id, keys, flags, offsets, indices):
+        self.graph_id = graph_id
+        self.keys = keys
+        self.flags = flags
+        self.offsets = offsets
+        self.indices = indices
+        self.index = {k: i for i, k in enumerate(keys)}
+        self._reverse = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    @property
+    def tasks(self):
+        return [k for k, f in zip(self.keys, self.flags.tolist()) if not f & EXTERNAL]
+
+    @property
+    def wanted(self):
+        return [k for k, f in zip(self.keys, self.flags.tolist()) if f & WANTED]
+
+    @property
+    def nedges(self):
+        return len(self.indices)
+
+    def dependencies(self, key):
+        i = self.index[key]
+        return [self.keys[j] for j in self.indices[self.offsets[i]:self.offsets[i + 1]].tolist()]
+
+    def dependents(self, key):
+        if self._reverse is None:
+            # reverse CSR, built once on the first query
+            rows = np.repeat(np.arange(len(self.keys), dtype=np.int64), np.diff(self.offsets))
+            order = np.argsort(self.indices, kind="stable")
+            roffsets = np.zeros(len(self.keys) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.indices, minlength=len(self.keys)), out=roffsets[1:])
+            self._reverse = (roffsets, rows[order])
+        roffsets, rindices = self._reverse
+        i = self.index[key]
+        return [self.keys[j] for j in rindices[roffsets[i]:roffsets[i + 1]].tolist()]
+
+    def to_dict(self):
+        """The graph as the ``{key: [dependencies]}`` mapping the scheduler received"""
+        return {k: self.dependencies(k) for k in self.tasks}
+
+
+class GraphAssembler():
+    """Collect graph chunks, in any order, and rebuild the graphs once all their chunks arrived"""
+    def __init__(self):
+        self.pending = {}
+        self.graphs = {}
+
+    def add(self, buf):
+        """Add one chunk, returning the TaskGraph if it was the last missing one"""
+        chunk = decode_chunk(buf)
+        graph_id = chunk["graph_id"]
+        chunks = self.pending.setdefault(graph_id, {})
+        chunks[chunk["seq"]] = chunk
+        if len(chunks) < chunk["nchunks"]:
+            return None
+        del self.pending[graph_id]
+        parts = [chunks[seq] for seq in range(chunk["nchunks"])]
+        keys = [k for part in parts for k in part["keys"]]
+        flags = np.concatenate([part["flags"] for part in parts])
+        degrees = np.concatenate([part["degrees"] for part in parts])
+        indices = np.concatenate([part["indices"] for part in parts]).astype(np.int64)
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(degrees, out=offsets[1:])
+        graph = self.graphs[graph_id] = TaskGraph(graph_id, keys, flags, offsets, indices)
+        return graph
@@ -0,0 +1,212 @@
+"""
+Pipelined ingest of the events pulled by the consumers.
+
+Pulling, waiting and decoding one event at a time on one thread caps a consumer
+far below what hundreds of workers push. An IngestPipeline runs three stages:
+
+- one puller thread per Mofka consumer (topic or partition), keeping ``depth``
+  pulls in flight and grouping the pulled events into batches of up to
+  ``batch_size`` events. A partial batch is handed over as soon as the next pull
+  is not completed yet, so the last events of a stream never wait for more;
+- ``decoders`` threads running ``decode(events)`` on the batches, taken from a
+  bounded queue so the pullers slow down when decoding falls behind;
+- one aggregation thread running ``aggregate(decoded)`` on the decoded batches
+  in the order the batches were pulled, for the state that must see the events
+  in order (producer dictionaries, tables).
+
+A ThroughputCounter counts the events going through the aggregation stage and
+logs the rate every ``report_interval`` seconds.
+"""
+import time
+import queue
+import logging
+import threading
+import collections
+
+
+def _completed(future):
+    """True if a pull future is completed, False when unknown"""
+    done = getattr(future, "completed", False)
+    return bool(done() if callable(done) else done)
+
+
+class ThroughputCounter():
+    """
+    Events and batches ingested, with the rate over the last report interval.
+
+    Parameters
+    ----------
+    name :
+        Name used in the log lines.
+    report_interval :
+        Seconds between two log lines, 0 to never log.
+    """
+    def __init__(self, name="ingest", report_interval=10.0):
+        self.name = name
+        self.report_interval = report_interval
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.events = 0
+        self.batches = 0
+        self.last_time = self.start
+        self.last_events = 0
+        self.rate = 0.0
+        self.peak = 0.0
+
+    def add(self, events):
+        with self.lock:
+            self.events += events
+            self.batches += 1
+            now = time.time()
+            if now - self.last_time >= max(self.report_interval, 0.1):
+                self.rate = (self.events - self.last_events) / (now - self.last_time)
+                self.peak = max(self.peak, self.rate)
+                self.last_time, self.last_events = now, self.events
+                if self.report_interval:
+                    logging.info("%s: %d events ingested, %.0f events/s (peak %.0f)", self.name, self.events,
+                                 self.rate, self.peak)
+
+    def stats(self):
+        with self.lock:
+            elapsed = time.time() - self.start
+            return {"events"     : self.events,
+                    "batches"    : self.batches,
+                    "seconds"    : elapsed,
+                    "events/s"   : self.events / elapsed if elapsed > 0 else 0.0,
+                    "peak"       : max(self.peak, self.rate),
+                    "batch size" : self.events / self.batches if self.batches else 0.0}
+
+
+class IngestPipeline():
+    """
+    Pull, decode and aggregate the events of several Mofka consumers in parallel.
+
+    Parameters
+    ----------
+    consumers :
+        The Mofka consumers, one puller thread each.
+    decode :
+        ``decode(events) -> decoded``, run by the decoder threads on a list of
+        pulled events. It must not depend on the other batches.
+    aggregate :
+        ``aggregate(decoded)``, run by the aggregation thread on the decoded
+        batches in the order they were pulled.
+    stopped :
+        ``stopped() -> bool``, the pullers stop pulling once it returns True.
+    batch_size :
+        Maximum number of events per batch.
+    depth :
+        Number of pulls each puller keeps in flight.
+    decoders :
+        Number of decoder threads.
+    queue_size :
+        Maximum number of batches waiting to be decoded.
+    report_interval :
+        Seconds between two throughput log lines.
+    """
+    def __init__(self, consumers, decode, aggregate, stopped, batch_size=256, depth=8, decoders=2,
+                 queue_size=64, report_interval=10.0):
+        self.consumers = consumers
+        self.decode = decode
+        self.aggregate = aggregate
+        self.stopped = stopped
+        self.batch_size = max(1, batch_size)
+        self.depth = max(1, depth)
+        self.queue = queue.Queue(max(1, queue_size))
+        self.counter = ThroughputCounter("mofka-ingest", report_interval)
+        # sequence number of the next batch handed over, and of the next one to aggregate
+        self.sequence = 0
+        self.sequence_lock = threading.Lock()
+        self.next_aggregated = 0
+        # decoded batches waiting for the previous ones, by sequence number
+        self.decoded = {}
+        self.decoded_cond = threading.Condition()
+        self.pullers = [threading.Thread(target=self.pull, args=(consumer,), name=f"mofka-pull-{i}",
+                                         daemon=True)
+                        for i, consumer in enumerate(consumers)]
+        self.decoders = [threading.Thread(target=self.decode_loop, name=f"mofka-decode-{i}", daemon=True)
+                         for i in range(max(1, decoders))]
+        self.aggregator = threading.Thread(target=self.aggregate_loop, name="mofka-aggregate", daemon=True)
+        self.closed = False
+
+    def start(self):
+        for t in self.decoders + [self.aggregator] + self.pullers:
+            t.start()
+
+    def submit(self, events):
+        """Hand a batch of pulled events to the decoders, in pulling order"""
+        with self.sequence_lock:
+            if self.closed:
+                logging.warning("%d events pulled after the ingest pipeline was closed are dropped", len(events))
+                return
+            sequence = self.sequence
+            self.sequence += 1
+            # the queue keeps the order of the sequence numbers
+            self.queue.put((sequence, events))
+
+    def pull(self, consumer):
+        inflight = collections.deque(consumer.pull() for _ in range(self.depth))
+        batch = []
+        while not self.stopped():
+            future = inflight[0]
+            if batch and (len(batch) >= self.batch_size or not _completed(future)):
+                self.submit(batch)
+                batch = []
+            event = future.wait()
+            inflight.popleft()
+            inflight.append(consumer.pull())
+            batch.append(event)
+        if batch:
+            self.submit(batch)
+
+    def decode_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            sequence, events = item
+            try:
+                decoded = self.decode(events)
+            except Exception:
+                logging.exception("Exception while decoding a batch of %d events", len(events))
+                decoded = None
+            with self.decoded_cond:
+                self.decoded[sequence] = (len(events), decoded)
+                self.decoded_cond.notify_all()
+
+    def aggregate_loop(self):
+        while True:
+            with self.decoded_cond:
+                while self.next_aggregated not in self.decoded:
+                    if self.closed and self.next_aggregated >= self.sequence:
+                        return
+                    self.decoded_cond.wait(0.1)
+                n, decoded = self.decoded.pop(self.next_aggregated)
+                self.next_aggregated += 1
+                self.decoded_cond.notify_all()
+            if decoded is not None:
+                try:
+                    self.aggregate(decoded)
+                except Exception:
+                    logging.exception("Exception while aggregating a batch of %d events", n)
+            self.counter.add(n)
+
+    def close(self, timeout=1.0):
+        """
+        Give the pullers ``timeout`` seconds to hand over their last events, then
+        wait for the batches handed over to be decoded and aggregated.
+        """
+        for t in self.pullers:
+            t.join(timeout)
+        with self.sequence_lock:
+            self.closed = True
+            for _ in self.decoders:
+                self.queue.put(None)
+        for t in self.decoders:
+            t.join()
+        self.aggregator.join()
+        stats = self.counter.stats()
+        logging.info("%s: %d events ingested in %.2fs, %.0f events/s (peak %.0f), %.1f events per batch",
+                     self.counter.name, stats["events"], stats["seconds"], stats["events/s"], stats["peak"],
+                     stats["batch size"])
+        return stats
@@ -0,0 +1,105 @@
+import time
+
+from mofkadask.encoding import DURATION_BINS
+from mofkadask.aggregation import duration_bin
+
+LATENCIES = ("queue", "dispatch", "exec")
+
+# states a task waits in on the scheduler once its dependencies are in memory
+READY_STATES = ("queued", "no-worker", "processing")
+
+
+class LatencyTracker():
+    """
+    Per-task timestamps of the scheduler, turned into latencies when tasks finish.
+
+    For every task in flight it keeps the time it became ready to run (it left
+    ``waiting``) and the time it was sent to a worker (it entered ``processing``).
+    When the task finishes, the worker ``startstops`` of its computation give:
+
+    - ``queue``    : time spent ready on the scheduler, in ``queued`` or ``no-worker``
+    - ``dispatch`` : from the scheduler sending the task to the worker starting to
+                     compute it, which includes the network, the worker queue and
+                     the transfer of its dependencies
+    - ``exec``     : compute time on the worker
+
+    Worker timestamps must be given in the scheduler clock, see ``WorkerState.time_delay``.
+    """
+    def __init__(self):
+        # key -> [ready time, dispatch time]
+        self.tasks = {}
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def transition(self, key, start, finish, now):
+        """Record the timestamps of a transition that is not the end of a computation"""
+        if finish in READY_STATES:
+            times = self.tasks.get(key)
+            if times is None:
+                times = self.tasks[key] = [None, None]
+            if start == "waiting" or times[0] is None:
+                times[0] = now
+            if finish == "processing":
+                times[1] = now
+        elif start in READY_STATES or finish in ("released", "forgotten"):
+            # the task left the ready states without finishing a computation
+            self.tasks.pop(key, None)
+
+    def finished(self, key, begin=None, end=None):
+        """
+        Latencies of a task that finished computing, in seconds.
+
+        Returns
+        -------
+            The queue, dispatch and exec latencies, None for the unknown ones.
+        """
+        times = self.tasks.pop(key, None)
+        ready, dispatched = times if times is not None else (None, None)
+        queue = dispatched - ready if ready is not None and dispatched is not None else None
+        dispatch = begin - dispatched if begin is not None and dispatched is not None else None
+        execution = end - begin if begin is not None and end is not None else None
+        return queue, dispatch, execution
+
+
+class LatencyHistograms():
+    """
+    Per task prefix log2 histograms of the queue, dispatch and exec latencies,
+    pushed once per window as ``latency_histogram`` records.
+    """
+    def __init__(self):
+        self.window_start = time.time()
+        self.stats = {}
+
+    def add(self, prefix, queue=None, dispatch=None, execution=None):
+        for latency, value in zip(LATENCIES, (queue, dispatch, execution)):
+            if value is None:
+                continue
+            s = self.stats.get((prefix, latency))
+            if s is None:
+                # count, sum, max, histogram
+                s = self.stats[(prefix, latency)] = [0, 0.0, 0.0, [0] * DURATION_BINS]
+            s[0] += 1
+            s[1] += value
+            if value > s[2]:
+                s[2] = value
+            s[3][duration_bin(value)] += 1
+
+    def flush(self):
+        """Return the histogram records of the current window and start a new one"""
+        window_end = time.time()
+        records = []
+        for (prefix, latency), s in self.stats.items():
+            record = {"window_start" : self.window_start,
+                      "window_end"   : window_end,
+                      "prefix"       : prefix,
+                      "latency"      : latency,
+                      "count"        : s[0],
+                      "sum"          : s[1],
+                      "max"          : s[2]}
+            for i, c in enumerate(s[3]):
+                record[f"hist_{i}"] = c
+            records.append(record)
+        self.stats = {}
+        self.window_start = window_end
+        return records
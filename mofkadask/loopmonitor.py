@@ -0,0 +1,84 @@
+import time
+
+
+class LoopMonitor():
+    """
+    Event loop lag monitor attributing the stalls to the Mofka pushes made on the loop.
+
+    ``tick`` runs as a periodic callback every ``interval`` seconds. The lag of a
+    tick is how late it runs, a tick later than ``threshold`` seconds is a stall.
+    The plugins report the time every push made on the event loop took with
+    ``pushed``. The push time accumulated since the previous tick is what overlaps
+    the stall: a stall with push time is tagged with the action that spent the
+    most time pushing, the other stalls with ``None``.
+
+    Parameters
+    ----------
+    threshold :
+        Lag in seconds from which a tick is a stall.
+    interval :
+        Expected time in seconds between two ticks.
+    """
+    def __init__(self, threshold=0.05, interval=0.02):
+        self.threshold = threshold
+        self.interval = interval
+        self.last_tick = None
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        # push time per action since the last tick
+        self.push_time = {}
+        # per responsible action: [stalls, total stall time, worst stall, push time during stalls]
+        self.stalls = {}
+        self.window_start = time.time()
+
+    def pushed(self, action, seconds):
+        self.push_time[action] = self.push_time.get(action, 0.0) + seconds
+
+    def tick(self):
+        now = time.perf_counter()
+        if self.last_tick is not None:
+            lag = max(0.0, now - self.last_tick - self.interval)
+            self.last_lag = lag
+            if lag > self.max_lag:
+                self.max_lag = lag
+            if lag >= self.threshold:
+                self.stall(lag)
+        self.last_tick = now
+        self.push_time = {}
+
+    def stall(self, lag):
+        action = None
+        push = 0.0
+        if self.push_time:
+            action = max(self.push_time, key=self.push_time.get)
+            push = sum(self.push_time.values())
+        s = self.stalls.get(action)
+        if s is None:
+            s = self.stalls[action] = [0, 0.0, 0.0, 0.0]
+        s[0] += 1
+        s[1] += lag
+        if lag > s[2]:
+            s[2] = lag
+        s[3] += min(push, lag)
+
+    def report(self, source):
+        """
+        Stall attribution since the last report, as ``stall_report`` records,
+        one per responsible action (None for the stalls without pushes).
+        The counters are reset so that consumers can simply sum the reports.
+        """
+        window_end = time.time()
+        records = [{"window_start" : self.window_start,
+                    "window_end"   : window_end,
+                    "source"       : source,
+                    "action"       : action,
+                    "stalls"       : s[0],
+                    "stall_ms"     : s[1] * 1e3,
+                    "worst_ms"     : s[2] * 1e3,
+                    "push_ms"      : s[3] * 1e3,
+                    "max_lag_ms"   : self.max_lag * 1e3}
+                   for action, s in self.stalls.items()]
+        self.stalls = {}
+        self.max_lag = 0.0
+        self.window_start = window_end
+        return records
@@ -0,0 +1,233 @@
+"""
+Spill, unspill and memory threshold events of the Dask worker memory manager.
+
+The worker ``data`` is a ``SpillBuffer``: values move from its ``fast`` dict to
+its ``slow`` store (pickled to files in the spill directory) when the worker
+spills, and back when they are read again. ``SpillRecorder`` replaces the store
+behind the ``slow`` cache with a proxy timing every spill and unspill, and the
+file mapping behind the store with a proxy timing the disk reads and writes
+alone. Nothing is changed in Dask itself: the proxies forward everything else to
+the objects they wrap, and ``uninstall`` puts these objects back.
+"""
+import time
+import logging
+from collections.abc import MutableMapping
+
+from dask.utils import key_split
+
+# memory levels of a worker, from the lowest to the highest
+LEVELS = ("ok", "target", "spill", "pause")
+
+
+class TimedFile(MutableMapping):
+    """Proxy of the spill files mapping, remembering how long the last read or write took"""
+    def __init__(self, d):
+        self.d = d
+        self.seconds = 0.0
+
+    def __getitem__(self, key):
+        t0 = time.perf_counter()
+        try:
+            return self.d[key]
+        finally:
+            self.seconds = time.perf_counter() - t0
+
+    def __setitem__(self, key, value):
+        t0 = time.perf_counter()
+        try:
+            self.d[key] = value
+        finally:
+            self.seconds = time.perf_counter() - t0
+
+    def __delitem__(self, key):
+        del self.d[key]
+
+    def __contains__(self, key):
+        return key in self.d
+
+    def __iter__(self):
+        return iter(self.d)
+
+    def __len__(self):
+        return len(self.d)
+
+    def __getattr__(self, name):
+        return getattr(self.d, name)
+
+
+class TimedSlow(MutableMapping):
+    """Proxy of the ``Slow`` store of a SpillBuffer, reporting every spill and unspill"""
+    def __init__(self, slow, recorder):
+        self.slow = slow
+        self.recorder = recorder
+
+    def __getitem__(self, key):
+        weight = self.slow.weight_by_key.get(key)
+        t0 = time.perf_counter()
+        value = self.slow[key]
+        self.recorder.record("unspill", key, weight, time.perf_counter() - t0)
+        return value
+
+    def __setitem__(self, key, value):
+        t0 = time.perf_counter()
+        self.slow[key] = value
+        duration = time.perf_counter() - t0
+        self.recorder.record("spill", key, self.slow.weight_by_key.get(key), duration)
+
+    def __delitem__(self, key):
+        del self.slow[key]
+
+    def __contains__(self, key):
+        return key in self.slow
+
+    def __iter__(self):
+        return iter(self.slow)
+
+    def __len__(self):
+        return len(self.slow)
+
+    def __getattr__(self, name):
+        return getattr(self.slow, name)
+
+
+class SpillRecorder():
+    """
+    Report the spills and unspills of a worker as ``worker_spill`` records.
+
+    Records hold the key and its prefix, the direction (``spill`` or ``unspill``),
+    the size of the value in memory (sizeof) and on disk (pickled, possibly
+    compressed), the duration of the whole spill or unspill (serialization and
+    disk access), the time spent reading or writing the file, and the disk
+    throughput in bytes per second.
+
+    Parameters
+    ----------
+    worker :
+        The Dask worker.
+    callback :
+        ``callback(record)`` called with every record. Spills happen on the event
+        loop or in the threads of the worker, so it must be thread safe.
+    """
+    def __init__(self, worker, callback):
+        self.worker = worker
+        self.callback = callback
+        self.cache = None
+        self.slow = None
+        self.file = None
+
+    def install(self):
+        """Wrap the spill store of the worker, returns False if the worker does not spill"""
+        cache = getattr(self.worker.data, "slow", None)
+        slow = getattr(cache, "data", None)
+        if slow is None or not hasattr(slow, "weight_by_key"):
+            logging.info("Worker %s does not spill to disk, no spill events", self.worker.name)
+            return False
+        self.cache = cache
+        self.slow = slow
+        self.file = slow.d = TimedFile(slow.d)
+        cache.data = TimedSlow(slow, self)
+        return True
+
+    def uninstall(self):
+        if self.cache is None:
+            return
+        self.slow.d = self.file.d
+        self.cache.data = self.slow
+        self.cache = None
+
+    def record(self, direction, key, weight, duration):
+        disk_time = self.file.seconds
+        memory_bytes, disk_bytes = weight if weight is not None else (None, None)
+        try:
+            self.callback({"worker"       : self.worker.address,
+                           "key"          : str(key),
+                           "prefix"       : key_split(key),
+                           "direction"    : direction,
+                           "memory_bytes" : memory_bytes,
+                           "disk_bytes"   : disk_bytes,
+                           "duration"     : duration,
+                           "disk_time"    : disk_time,
+                           "throughput"   : disk_bytes / disk_time if disk_bytes and disk_time > 0 else None,
+                           "time"         : time.time()})
+        except Exception:
+            # never fail a spill because of the plugin
+            logging.exception("Exception while reporting the %s of %s", direction, key)
+
+
+class MemoryThresholds():
+    """
+    Track the memory level of a worker against the memory manager thresholds.
+
+    The level is ``pause`` when the worker is paused or its process memory is
+    above the pause threshold, ``spill`` above the spill threshold, ``target``
+    when the managed memory held in memory is above the target threshold (the
+    worker spills by itself), and ``ok`` otherwise. ``check`` returns a
+    ``memory_threshold`` record every time the level changes.
+    """
+    def __init__(self, worker):
+        self.worker = worker
+        self.level = "ok"
+
+    def current(self, rss):
+        mm = self.worker.memory_manager
+        limit = mm.memory_limit
+        status = getattr(self.worker.status, "name", str(self.worker.status))
+        if status == "paused" or (mm.memory_pause_fraction and rss > mm.memory_pause_fraction * limit):
+            return "pause"
+        if mm.memory_spill_fraction and rss > mm.memory_spill_fraction * limit:
+            return "spill"
+        fast = getattr(getattr(self.worker.data, "fast", None), "total_weight", None)
+        if mm.memory_target_fraction and fast is not None and fast > mm.memory_target_fraction * limit:
+            return "target"
+        return "ok"
+
+    def check(self):
+        """Return a ``memory_threshold`` record if the level changed since the last check, None otherwise"""
+        limit = self.worker.memory_manager.memory_limit
+        if not limit:
+            return None
+        rss = self.worker.monitor.get_process_memory()
+        level = self.current(rss)
+        if level == self.level:
+            return None
+        previous, self.level = self.level, level
+        return {"worker"       : self.worker.address,
+                "level"        : level,
+                "previous"     : previous,
+                "status"       : getattr(self.worker.status, "name", str(self.worker.status)),
+                "rss"          : rss,
+                "managed"      : self.worker.state.nbytes,
+                "memory_limit" : limit,
+                "fraction"     : rss / limit,
+                "time"         : time.time()}
+
+
+def spill_by_prefix(spills):
+    """
+    Consumer side summary of ``worker_spill`` events per task prefix and direction.
+
+    Parameters
+    ----------
+    spills :
+        DataFrame of the ``worker_spill`` events, with ``prefix`` and ``direction`` as strings
+        or categoricals.
+
+    Returns
+    -------
+        A DataFrame with the number of spills or unspills, the bytes moved (in memory
+        and on disk), the total and disk times, and the mean disk throughput of every
+        (prefix, direction), the most spilled prefixes first.
+    """
+    import pandas as pd
+
+    if spills.empty:
+        return pd.DataFrame()
+    report = (spills.groupby(["prefix", "direction"], observed=True)
+                    .agg(count=("key", "size"),
+                         memory_bytes=("memory_bytes", "sum"),
+                         disk_bytes=("disk_bytes", "sum"),
+                         duration=("duration", "sum"),
+                         disk_time=("disk_time", "sum"))
+                    .reset_index())
+    report["throughput"] = report["disk_bytes"] / report["disk_time"].where(report["disk_time"] > 0)
+    return report.sort_values("disk_bytes", ascending=False, ignore_index=True)
@@ -0,0 +1,323 @@
+"""
+Time-ordered merge of the tables written by the members of a consumer group.
+
+A consumer group is N consumer processes (``consumer.py --group-size N
+--group-rank R``), every member pulling its share of the topic partitions and
+writing its tables to ``<group-dir>/member-R``, as CSV files or as a streaming
+sink (see ``mofkadask.sink``). ``merge_streams`` merges the tables of the
+members into one table ordered by event time.
+
+The rows of a member are in pulling order, which is time order only up to the
+lateness of the events: events of different workers reach Mofka with some
+delay. With a bound ``lateness`` on that delay, a row of time ``t`` can be
+output once every member has read rows later than ``t + lateness``. The merge
+reads the members chunk by chunk, always from the one holding back the output
+(the member with the earliest latest time, kept in a heap), sorts the rows of
+every member that became safe and merges these sorted runs, so it holds about
+``lateness`` seconds of events (and a chunk per member) in memory. Rows
+later than the bound are still output, as soon as they are read, and counted
+as ``late``.
+
+The rolling statistics tables (``rolling_prefix``, ``rolling_worker``) are not
+events: every member saves the buckets and sketches of its statistics to
+``rolling_state.json``, and ``merge_rolling`` merges them into the statistics
+of the whole group.
+
+Merge the tables of a group with::
+
+    python -m mofkadask.merge --group-dir group --lateness 1.0
+"""
+import os
+import json
+import heapq
+import logging
+
+import numpy as np
+import click
+
+# columns holding the time of the rows, tried in order
+TIME_COLUMNS = ("time", "window_end")
+CHUNK_ROWS = 65536
+# created in the group directory by the member seeing the end of the workflow
+STOP_MARKER = "stopped"
+
+
+def member_dir(group_dir, rank):
+    return os.path.join(group_dir, f"member-{rank}")
+
+
+def member_dirs(group_dir):
+    """Output directories of the members of a group, by rank"""
+    members = [name for name in os.listdir(group_dir) if name.startswith("member-")]
+    return [os.path.join(group_dir, name) for name in sorted(members, key=lambda name: int(name.split("-")[1]))]
+
+
+def table_names(directory):
+    """Tables written to a member directory, by the sink or as CSV files"""
+    index = os.path.join(directory, "index.json")
+    if os.path.exists(index):
+        with open(index) as f:
+            return list(json.load(f)["tables"])
+    return [name[:-4] for name in os.listdir(directory) if name.endswith(".csv")]
+
+
+def table_chunks(directory, table, rows=CHUNK_ROWS):
+    """DataFrames of the rows of a member table, read lazily in pulling order"""
+    import pandas as pd
+
+    index = os.path.join(directory, "index.json")
+    if not os.path.exists(index):
+        path = os.path.join(directory, f"{table}.csv")
+        if os.path.exists(path) and os.path.getsize(path) > 1:
+            for chunk in pd.read_csv(path, index_col=0, chunksize=rows):
+                yield chunk
+        return
+    import pyarrow as pa
+
+    with open(index) as f:
+        index = json.load(f)
+    for entry in index["tables"].get(table, []):
+        if not entry["complete"]:
+            continue
+        path = os.path.join(directory, entry["path"])
+        if index["format"] == "parquet":
+            import pyarrow.parquet as pq
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=rows):
+                yield batch.to_pandas()
+        else:
+            with pa.OSFile(path, "rb") as source:
+                for batch in pa.ipc.open_stream(source):
+                    yield batch.to_pandas()
+
+
+def time_column(frame):
+    for name in TIME_COLUMNS:
+        if name in frame.columns:
+            return name
+    return None
+
+
+class MemberStream():
+    """Rows read from one member and not output yet, sorted by time"""
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = None
+        self.times = None
+        # latest time read so far, +inf once all the rows were read
+        self.watermark = -np.inf
+        self.done = False
+
+    def read(self, column):
+        """Read the next chunk, returns the number of its rows"""
+        import pandas as pd
+
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.done = True
+            self.watermark = np.inf
+            return 0
+        if column not in chunk.columns or not len(chunk):
+            return 0
+        self.watermark = max(self.watermark, float(np.nanmax(chunk[column].to_numpy(dtype=float))))
+        frames = [chunk] if self.pending is None else [self.pending, chunk]
+        self.pending = pd.concat(frames, ignore_index=True).sort_values(column, kind="stable",
+                                                                       ignore_index=True)
+        self.times = self.pending[column].to_numpy(dtype=float)
+        return len(chunk)
+
+    def take(self, cut):
+        """Sorted rows of time lower or equal to ``cut``, removed from the stream"""
+        if self.pending is None:
+            return None
+        n = int(np.searchsorted(self.times, cut, side="right"))
+        if not n:
+            return None
+        ready = self.pending.iloc[:n]
+        self.pending = self.pending.iloc[n:].reset_index(drop=True) if n < len(self.pending) else None
+        self.times = self.times[n:] if self.pending is not None else None
+        return ready
+
+
+def merge_runs(runs, column):
+    """
+    k-way merge of time-sorted DataFrames.
+
+    The runs are concatenated and merged by a stable sort: numpy's timsort finds
+    the sorted runs and merges them in O(n log k), without going through the
+    rows in Python as a heap of the next row of every run would.
+    """
+    import pandas as pd
+
+    runs = [run for run in runs if run is not None and len(run)]
+    if len(runs) < 2:
+        return runs[0].reset_index(drop=True) if runs else None
+    frame = pd.concat(runs, ignore_index=True)
+    order = np.argsort(frame[column].to_numpy(dtype=float), kind="stable")
+    return frame.take(order).reset_index(drop=True)
+
+
+def merge_streams(streams, lateness=1.0, stats=None):
+    """
+    Merge the chunks of several members into time-ordered DataFrames.
+
+    Parameters
+    ----------
+    streams :
+        One iterable of DataFrames per member, see ``table_chunks``.
+    lateness :
+        Maximum delay, in seconds, between the time of a row and the time of the
+        rows read before it from the same member.
+    stats :
+        Optional dict updated with the number of ``rows`` output and of ``late`` rows.
+
+    Yields
+    ------
+        Consecutive time-ordered parts of the merged table.
+    """
+    stats = {} if stats is None else stats
+    stats.setdefault("rows", 0)
+    stats.setdefault("late", 0)
+    members = [MemberStream(chunks) for chunks in streams]
+    # members left to read, by latest time read
+    heap = [(-np.inf, i) for i in range(len(members))]
+    column = None
+    output = -np.inf
+    while heap:
+        _, i = heapq.heappop(heap)
+        member = members[i]
+        if column is None:
+            chunk = next(member.chunks, None)
+            if chunk is None:
+                member.done = True
+                continue
+            if len(chunk):
+                column = time_column(chunk)
+                if column is None:
+                    raise ValueError(f"No time column among {TIME_COLUMNS} in {list(chunk.columns)}")
+                member.chunks = _prepend(chunk, member.chunks)
+            # else the CSV file of an empty table
+            heapq.heappush(heap, (member.watermark, i))
+            continue
+        member.read(column)
+        if not member.done:
+            heapq.heappush(heap, (member.watermark, i))
+        # no member can still read rows earlier than this
+        cut = (heap[0][0] if heap else np.inf) - lateness
+        merged = merge_runs([m.take(cut) for m in members], column)
+        if merged is not None:
+            times = merged[column].to_numpy(dtype=float)
+            stats["late"] += int(np.count_nonzero(times < output))
+            output = max(output, float(np.nanmax(times)))
+            stats["rows"] += len(merged)
+            yield merged
+
+
+def _prepend(item, iterator):
+    yield item
+    yield from iterator
+
+
+def merge_rolling(members):
+    """RollingStats merged from the ``rolling_state.json`` of the members, None if none saved one"""
+    from mofkadask.rolling import STATE, RollingStats
+
+    merged = None
+    for directory in members:
+        path = os.path.join(directory, STATE)
+        if not os.path.exists(path):
+            continue
+        stats = RollingStats.load(path)
+        if merged is None:
+            merged = stats
+        else:
+            merged.merge(stats)
+    return merged
+
+
+def merge_group(group_dir, output_dir=".", lateness=1.0, tables=None):
+    """Merge every table of the members of ``group_dir`` into ``output_dir``, in the format they were written"""
+    members = member_dirs(group_dir)
+    if not members:
+        logging.warning("No consumer group member in %s", group_dir)
+        return {}
+    names = sorted(set().union(*(table_names(m) for m in members)))
+    if tables:
+        names = [name for name in names if name in tables]
+    sink = None
+    index = os.path.join(members[0], "index.json")
+    if os.path.exists(index):
+        from mofkadask.sink import Sink
+        with open(index) as f:
+            sink = Sink(output_dir, json.load(f)["format"], rows=0)
+    os.makedirs(output_dir, exist_ok=True)
+    report = {}
+    for name in names:
+        if name == "spill_by_prefix" or name.startswith("rolling_"):
+            # summaries, not events: they are recomputed from the merged spills and statistics
+            continue
+        stats = {}
+        streams = [table_chunks(m, name) for m in members]
+        path = os.path.join(output_dir, f"{name}.csv")
+        rows = 0
+        for part in merge_streams(streams, lateness, stats):
+            if sink is not None:
+                sink.write(name, part)
+            else:
+                part.index = np.arange(rows, rows + len(part))
+                part.to_csv(path, mode="a" if rows else "w", header=not rows)
+            rows += len(part)
+        report[name] = stats
+        logging.info("Merged table %s of %d members: %d rows, %d later than %.3fs", name, len(members),
+                     stats["rows"], stats["late"], lateness)
+    rolling = merge_rolling(members)
+    if rolling is not None:
+        from mofkadask.rolling import GROUPS, STATE
+        rolling.save(os.path.join(output_dir, STATE))
+        for by in GROUPS:
+            name = f"rolling_{by}"
+            if tables and name not in tables:
+                continue
+            frame = rolling.frame(by)
+            if sink is not None:
+                sink.write(name, frame)
+            else:
+                frame.to_csv(os.path.join(output_dir, f"{name}.csv"))
+        logging.info("Merged the rolling statistics of %d members", len(members))
+    if sink is not None:
+        sink.close()
+        if "worker_spill" in report:
+            from mofkadask.memory import spill_by_prefix
+            sink.write("spill_by_prefix", spill_by_prefix(sink.read("worker_spill")))
+            sink.close()
+    elif "worker_spill" in report:
+        import pandas as pd
+        from mofkadask.memory import spill_by_prefix
+        spill_by_prefix(pd.read_csv(os.path.join(output_dir, "worker_spill.csv"), index_col=0)).to_csv(
+            os.path.join(output_dir, "spill_by_prefix.csv"))
+    return report
+
+
+@click.command()
+@click.option('--group-dir',
+               type=str,
+               default="group",
+               help="Directory of the member-<rank> directories of the consumer group")
+@click.option('--output-dir',
+               type=str,
+               default=".",
+               help="Directory of the merged tables")
+@click.option('--lateness',
+               type=float,
+               default=1.0,
+               help="Maximum delay in seconds of an event behind the events pulled before it")
+@click.option('--tables',
+               type=str,
+               default=None,
+               help="Comma separated tables to merge (default all)")
+def main(group_dir, output_dir, lateness, tables):
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    merge_group(group_dir, output_dir, lateness, tables.split(",") if tables else None)
+
+
+if __name__ == '__main__':
+    main()
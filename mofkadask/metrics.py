@@ -0,0 +1,180 @@
+"""
+Self-instrumentation of the plugins, exported as Prometheus metrics.
+
+The plugins measure the time spent in their ``transition`` hook, in building
+the payloads (encoding), in ``producer.push`` and in flushes, and count the
+events and bytes they push. The metrics are registered in the default
+``prometheus_client`` registry, which the scheduler and worker HTTP servers
+export on ``/metrics`` next to the Dask metrics.
+
+``prometheus_client`` is optional: without it the metrics are still measured
+and logged when the plugins close, they are just not exported.
+"""
+import math
+import time
+import logging
+import functools
+import threading
+
+try:
+    import prometheus_client
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+except ImportError:
+    prometheus_client = None
+
+PREFIX = "dask_mofka_"
+
+HISTOGRAMS = {
+    "transition" : "Time spent in the transition hook of the plugin",
+    "encode"     : "Time spent building and encoding event payloads",
+    "push"       : "Time spent in producer.push (and waiting for the pushes, for batched pushes)",
+    "flush"      : "Latency of the producer flushes",
+}
+
+# histogram buckets are powers of 2, from about 1 us to 16 s
+MIN_EXPONENT = -20
+BUCKETS = 25
+
+
+class Histogram():
+    """Log2 histogram of durations, cheap enough to be observed on every transition"""
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        b = math.frexp(seconds)[1] - MIN_EXPONENT if seconds > 0 else 0
+        self.counts[0 if b < 0 else (BUCKETS - 1 if b >= BUCKETS else b)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def buckets(self):
+        """Cumulative (upper bound, count) pairs, in the prometheus_client format"""
+        buckets = []
+        total = 0
+        for i, c in enumerate(self.counts[:-1]):
+            total += c
+            buckets.append((repr(2.0 ** (MIN_EXPONENT + i)), total))
+        buckets.append(("+Inf", total + self.counts[-1]))
+        return buckets
+
+
+class PluginMetrics():
+    """
+    Metrics of one plugin instance.
+
+    Parameters
+    ----------
+    component :
+        ``scheduler`` or ``worker``, exported as a label.
+    instance :
+        Name of the scheduler or worker, exported as a label.
+    """
+    def __init__(self, component, instance):
+        self.component = component
+        self.instance = str(instance)
+        self.histograms = {name: Histogram() for name in HISTOGRAMS}
+        self.events = 0
+        self.bytes = 0
+        self.failed = 0
+        # name -> (documentation, callable returning the current value)
+        self.gauges = {}
+
+    def observe(self, name, seconds):
+        self.histograms[name].observe(seconds)
+
+    def pushed(self, events, nbytes):
+        self.events += events
+        self.bytes += nbytes
+
+    def gauge(self, name, documentation, value):
+        """Export the value returned by ``value()`` at every scrape"""
+        self.gauges[name] = (documentation, value)
+
+    def register(self):
+        _COLLECTOR.add(self)
+
+    def unregister(self):
+        _COLLECTOR.remove(self)
+
+    def summary(self):
+        return {"events" : self.events,
+                "bytes"  : self.bytes,
+                "failed" : self.failed,
+                **{f"{name}_mean" : (h.sum / h.count if h.count else None)
+                   for name, h in self.histograms.items()}}
+
+
+def timed(name):
+    """Method decorator observing its duration in the ``name`` histogram of ``self.metrics``"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.metrics.observe(name, time.perf_counter() - t0)
+        return wrapper
+    return decorator
+
+
+class Collector():
+    """
+    The process wide prometheus_client collector of all the plugin metrics.
+
+    Schedulers and workers can run in the same process (LocalCluster with
+    threads), so there is a single collector, registered once, exporting every
+    plugin instance under its ``component`` and ``instance`` labels.
+    """
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+        self.registered = False
+
+    def add(self, metrics):
+        with self.lock:
+            self.metrics.append(metrics)
+            register = not self.registered and prometheus_client is not None
+            self.registered = True
+        if register:
+            # the registry calls collect, which takes the lock
+            prometheus_client.REGISTRY.register(self)
+
+    def remove(self, metrics):
+        with self.lock:
+            if metrics in self.metrics:
+                self.metrics.remove(metrics)
+
+    def collect(self):
+        with self.lock:
+            instances = list(self.metrics)
+        labels = ["component", "instance"]
+        for name, documentation in HISTOGRAMS.items():
+            family = HistogramMetricFamily(f"{PREFIX}{name}_seconds", documentation, labels=labels)
+            for m in instances:
+                h = m.histograms[name]
+                family.add_metric([m.component, m.instance], h.buckets(), h.sum)
+            yield family
+        for name, documentation, attr in (("events", "Events pushed to Mofka", "events"),
+                                          ("bytes", "Bytes pushed to Mofka", "bytes"),
+                                          ("failed_pushes", "Events whose push failed", "failed")):
+            family = CounterMetricFamily(f"{PREFIX}{name}", documentation, labels=labels)
+            for m in instances:
+                family.add_metric([m.component, m.instance], getattr(m, attr))
+            yield family
+        gauges = {}
+        for m in instances:
+            for name, (documentation, value) in m.gauges.items():
+                family = gauges.get(name)
+                if family is None:
+                    family = gauges[name] = GaugeMetricFamily(f"{PREFIX}{name}", documentation, labels=labels)
+                try:
+                    family.add_metric([m.component, m.instance], value())
+                except Exception:
+                    logging.exception("Exception while collecting the %s metric", name)
+        yield from gauges.values()
+
+
+_COLLECTOR = Collector()
@@ -0,0 +1,95 @@
+import time
+import zlib
+import logging
+
+STRATEGIES = ("worker", "key", "action")
+
+# record fields holding the routing value of every strategy, tried in order
+ROUTING_FIELDS = {
+    "worker" : ("worker", "called_from", "who"),
+    "key"    : ("key", "keys"),
+    "action" : (),
+}
+
+
+def open_topic(driver, topic_name="Dask", partitions=1, timeout=30.0):
+    """
+    Open a topic, creating it with ``partitions`` memory partitions if it does not exist.
+
+    The scheduler, the workers and the consumer may all try to create the topic
+    at the same time: a process losing that race opens the topic created by the
+    winner, then waits up to ``timeout`` seconds for the winner to add the
+    expected number of partitions, so that it does not route its events over a
+    partial partition count.
+
+    Returns
+    -------
+        The topic and its number of partitions, which is the one of the existing
+        topic if another component created it first.
+    """
+    created = False
+    if not driver.topic_exists(topic_name):
+        try:
+            driver.create_topic(topic_name)
+            created = True
+        except Exception as Argument:
+            if not driver.topic_exists(topic_name):
+                raise
+            logging.info("Mofka topic %s was created by another component (%s)", topic_name, Argument)
+    if created:
+        logging.info("Mofka topic %s is created with %d partitions", topic_name, partitions)
+        for _ in range(partitions):
+            driver.add_memory_partition(topic_name, 0)
+    deadline = time.time() + timeout
+    delay = 0.05
+    while True:
+        topic = driver.open_topic(topic_name)
+        if not hasattr(topic, "partitions"):
+            return topic, partitions
+        found = len(topic.partitions)
+        if created or found >= partitions:
+            return topic, found
+        if time.time() > deadline:
+            if not found:
+                raise TimeoutError(f"Mofka topic {topic_name} has no partition after {timeout}s")
+            # the creator asked for fewer partitions than this process
+            logging.warning("Mofka topic %s has %d partitions, %d expected", topic_name, found, partitions)
+            return topic, found
+        time.sleep(delay)
+        delay = min(2 * delay, 1.0)
+
+
+class PartitionSelector():
+    """
+    Route events to the partitions of a multi-partition topic.
+
+    Parameters
+    ----------
+    strategy :
+        ``worker`` routes on the worker name or address of the event, so all the
+        events of a worker land in the same partition and keep their order.
+        ``key`` routes on the task key, so all the transitions of a task land in
+        the same partition. ``action`` routes on the event type.
+        Events without the routing field are routed on their action.
+    npartitions :
+        Number of partitions of the topic.
+    """
+    def __init__(self, strategy="worker", npartitions=1):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown partition strategy {strategy!r}, expected one of {STRATEGIES}")
+        self.strategy = strategy
+        self.fields = ROUTING_FIELDS[strategy]
+        self.npartitions = max(1, npartitions)
+
+    def partition(self, value):
+        """Partition of a routing value, stable across processes (unlike ``hash``)"""
+        return zlib.crc32(str(value).encode("utf-8")) % self.npartitions
+
+    def __call__(self, action, record):
+        if self.npartitions == 1:
+            return 0
+        for field in self.fields:
+            value = record.get(field)
+            if value is not None:
+                return self.partition(value)
+        return self.partition(action)
@@ -0,0 +1,200 @@
+"""
+Per-process cache of Mofka producers for the tasks pushing events themselves.
+
+Creating a Margo engine, a Mofka driver, a topic handle and a producer takes
+far longer than a push, so tasks should not do it on every call. ``producer``
+returns the producer of a (protocol, group file, topic) from the pool of the
+process, creating it the first time::
+
+    from mofkadask.pool import producer
+
+    def task(block, mofka_protocol, group_file):
+        producer(mofka_protocol, group_file, "Numerics").push({"action": "result"}, block)
+
+The process has one engine per protocol and one driver per group file, kept as
+long as it runs. The pool holds at most ``max_size`` producers: the least
+recently used one is flushed and closed beyond, and so are the producers unused
+for ``idle_timeout`` seconds. Since a task may still be pushing with a producer
+evicted meanwhile, evicted producers are kept in a ``closing`` list and flushed
+again with the pool. The producers are flushed when the Dask worker running the
+tasks closes (ProducerPoolPlugin registers itself on the first use of the pool
+in a worker), and when the process exits.
+"""
+import time
+import atexit
+import logging
+import threading
+import collections
+
+from mofkadask.partitioning import open_topic
+
+
+class ProducerPool():
+    """
+    LRU pool of Mofka producers keyed by protocol, group file, topic and producer name.
+
+    Parameters
+    ----------
+    max_size :
+        Maximum number of producers kept open.
+    idle_timeout :
+        Seconds after which an unused producer is flushed and closed, 0 to keep them.
+    """
+    def __init__(self, max_size=8, idle_timeout=300.0):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.RLock()
+        self.engines = {}
+        self.drivers = {}
+        # key -> [producer, topic, last use]
+        self.producers = collections.OrderedDict()
+        # (key, producer) evicted from the pool, maybe still used by a task
+        self.closing = []
+        self.created = 0
+        self.evicted = 0
+        self.hits = 0
+
+    def __len__(self):
+        return len(self.producers)
+
+    def engine(self, mofka_protocol):
+        engine = self.engines.get(mofka_protocol)
+        if engine is None:
+            from pymargo.core import Engine
+            engine = self.engines[mofka_protocol] = Engine(mofka_protocol, use_progress_thread=True)
+        return engine
+
+    def driver(self, mofka_protocol, group_file):
+        driver = self.drivers.get((mofka_protocol, group_file))
+        if driver is None:
+            import mochi.mofka.client as mofka
+            driver = mofka.MofkaDriver(group_file, self.engine(mofka_protocol))
+            self.drivers[(mofka_protocol, group_file)] = driver
+        return driver
+
+    def create(self, mofka_protocol, group_file, topic_name, producer_name, partitions):
+        """Open the topic and create its producer, returns both"""
+        import mochi.mofka.client as mofka
+        topic, _ = open_topic(self.driver(mofka_protocol, group_file), topic_name, partitions)
+        producer = topic.producer(producer_name, mofka.AdaptiveBatchSize, mofka.ThreadPool(1),
+                                  mofka.Ordering.Strict)
+        return producer, topic
+
+    def get(self, mofka_protocol, group_file, topic_name="Numerics", producer_name="task_producer", partitions=1):
+        """Producer of ``topic_name``, created and topic opened (or created) on first use"""
+        key = (mofka_protocol, group_file, topic_name, producer_name)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.producers.get(key)
+            if entry is not None:
+                entry[2] = now
+                self.producers.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            evicted = self.pop_idle(now)
+            t0 = time.time()
+            producer, topic = self.create(mofka_protocol, group_file, topic_name, producer_name, partitions)
+            self.producers[key] = [producer, topic, now]
+            self.created += 1
+            logging.info("Mofka producer %s of topic %s is created in %.3fs", producer_name, topic_name,
+                         time.time() - t0)
+            while len(self.producers) > self.max_size:
+                evicted.append(self.pop(next(iter(self.producers))))
+        # not under the lock, the other tasks do not wait for the flushes
+        self.flush_producers(evicted)
+        _register_worker_plugin()
+        return producer
+
+    def pop(self, key):
+        """Remove a producer from the pool, to be flushed by the caller, returns (key, producer)"""
+        with self.lock:
+            producer, _, _ = self.producers.pop(key)
+            self.evicted += 1
+            self.closing.append((key, producer))
+            return key, producer
+
+    def pop_idle(self, now=None):
+        """Remove the producers unused for ``idle_timeout`` seconds, returns the (key, producer) removed"""
+        if not self.idle_timeout:
+            return []
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            idle = [key for key, (_, _, used) in self.producers.items() if now - used > self.idle_timeout]
+            return [self.pop(key) for key in idle]
+
+    def flush_producers(self, producers):
+        for key, producer in producers:
+            try:
+                producer.flush()
+            except Exception:
+                logging.exception("Exception while flushing the Mofka producer of %s", key[2])
+
+    def evict(self, key):
+        """Flush and close the producer of ``key``"""
+        self.flush_producers([self.pop(key)])
+
+    def evict_idle(self, now=None):
+        """Flush and close the producers unused for ``idle_timeout`` seconds"""
+        self.flush_producers(self.pop_idle(now))
+
+    def flush(self):
+        """Flush every producer of the pool, and the evicted ones a task may still use"""
+        with self.lock:
+            producers = [(key, entry[0]) for key, entry in self.producers.items()] + self.closing
+        self.flush_producers(producers)
+
+    def close(self):
+        """Flush and close every producer, evicted ones included, the engines and drivers are kept"""
+        with self.lock:
+            for key in list(self.producers):
+                self.pop(key)
+            producers, self.closing = self.closing, []
+        self.flush_producers(producers)
+
+    def stats(self):
+        return {"producers" : len(self.producers),
+                "created"   : self.created,
+                "hits"      : self.hits,
+                "evicted"   : self.evicted}
+
+
+pool = ProducerPool()
+atexit.register(pool.close)
+
+
+def producer(mofka_protocol, group_file, topic_name="Numerics", producer_name="task_producer", partitions=1):
+    """Producer of ``topic_name`` from the pool of this process, see ProducerPool.get"""
+    return pool.get(mofka_protocol, group_file, topic_name, producer_name, partitions)
+
+
+try:
+    from distributed.diagnostics.plugin import WorkerPlugin
+except ImportError:
+    WorkerPlugin = object
+
+
+class ProducerPoolPlugin(WorkerPlugin):
+    """Worker plugin flushing and closing the producers of the pool when the worker closes"""
+    name = "mofka-producer-pool"
+
+    def teardown(self, worker):
+        logging.info("Mofka producer pool of worker %s closed: %s", worker.name, pool.stats())
+        pool.close()
+
+
+_registered = set()
+
+
+def _register_worker_plugin():
+    """Add ProducerPoolPlugin to the worker running the calling task, once"""
+    try:
+        from distributed import get_worker
+        worker = get_worker()
+    except (ImportError, ValueError):
+        # not in a task
+        return
+    if worker.id in _registered:
+        return
+    _registered.add(worker.id)
+    if ProducerPoolPlugin.name not in worker.plugins:
+        worker.loop.add_callback(worker.plugin_add, ProducerPoolPlugin(), name=ProducerPoolPlugin.name)
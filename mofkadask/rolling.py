@@ -0,0 +1,436 @@
+"""
+Online rolling statistics of the tasks, per task prefix and per worker.
+
+The consumer feeds every decoded batch of ``scheduler_transition`` events to a
+RollingStats. The tasks reaching ``memory`` or ``erred`` are aggregated per
+prefix and per worker into time buckets of ``window / buckets`` seconds (of
+event time): number of tasks, errors, bytes produced, duration sum and a
+QuantileSketch of the durations. Only the buckets of the last ``window``
+seconds are kept, so the memory is bounded by keys x buckets x sketch size,
+and ``query`` merges the buckets of every key into the statistics of the
+window: throughput, mean, p50, p95 and p99 duration, bytes and error rate.
+
+Events are aggregated by batch with numpy, in O(1) amortised time per event.
+``serve`` answers queries over HTTP while the workflow runs::
+
+    curl 'http://localhost:8790/stats?by=prefix'
+
+``to_dict`` and ``from_dict`` save and load the buckets with their sketches,
+so the statistics of the members of a consumer group, each aggregating its own
+partitions, are merged exactly with ``merge`` (see ``mofkadask.merge``).
+"""
+import json
+import math
+import logging
+import threading
+
+import numpy as np
+
+GROUPS = ("prefix", "worker")
+QUANTILES = (0.5, 0.95, 0.99)
+# saved statistics of a consumer, next to its tables
+STATE = "rolling_state.json"
+
+
+class QuantileSketch():
+    """
+    Mergeable quantile sketch with relative accuracy (DDSketch).
+
+    Positive values are counted in logarithmic bins of ratio
+    ``gamma = (1 + relative_accuracy) / (1 - relative_accuracy)``, so any quantile
+    is returned within ``relative_accuracy`` of the true value. Merging two
+    sketches adds their bins. Beyond ``max_bins`` bins the lowest ones are
+    collapsed, losing accuracy on the smallest values only.
+    """
+    def __init__(self, relative_accuracy=0.01, max_bins=2048, min_value=1e-9):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.min_value = min_value
+        self.bins = {}
+        # values below min_value, zero durations included
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value, count=1):
+        if value > self.min_value:
+            i = math.ceil(math.log(value) / self.log_gamma)
+            self.bins[i] = self.bins.get(i, 0) + count
+        else:
+            self.zeros += count
+        self.count += count
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def add_many(self, values):
+        """Add an array of values, NaN values are ignored"""
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return
+        positive = values[values > self.min_value]
+        self.zeros += len(values) - len(positive)
+        self.count += len(values)
+        if len(positive):
+            index = np.ceil(np.log(positive) / self.log_gamma).astype(np.int64)
+            low = int(index.min())
+            counts = np.bincount(index - low)
+            bins = self.bins
+            for i in np.flatnonzero(counts).tolist():
+                bins[i + low] = bins.get(i + low, 0) + int(counts[i])
+            if len(bins) > self.max_bins:
+                self._collapse()
+
+    def merge(self, other):
+        for i, n in other.bins.items():
+            self.bins[i] = self.bins.get(i, 0) + n
+        self.zeros += other.zeros
+        self.count += other.count
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def to_dict(self):
+        return {"bins": [[i, n] for i, n in self.bins.items()], "zeros": self.zeros, "count": self.count}
+
+    @classmethod
+    def from_dict(cls, state, relative_accuracy=0.01):
+        sketch = cls(relative_accuracy)
+        sketch.bins = {int(i): int(n) for i, n in state["bins"]}
+        sketch.zeros = state["zeros"]
+        sketch.count = state["count"]
+        return sketch
+
+    def _collapse(self):
+        keys = sorted(self.bins)
+        extra = keys[:len(keys) - self.max_bins + 1]
+        lowest = keys[len(extra)]
+        self.bins[lowest] += sum(self.bins.pop(i) for i in extra)
+
+    def quantile(self, q):
+        """Value of quantile ``q`` (0 to 1), NaN if the sketch is empty"""
+        if not self.count:
+            return math.nan
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for i in sorted(self.bins):
+            seen += self.bins[i]
+            if rank < seen:
+                return 2 * self.gamma ** i / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+
+class Aggregate():
+    """Statistics of one key in one bucket"""
+    __slots__ = ("tasks", "errors", "nbytes", "duration_sum", "durations", "sketch")
+
+    def __init__(self, relative_accuracy):
+        self.tasks = 0
+        self.errors = 0
+        self.nbytes = 0
+        self.duration_sum = 0.0
+        self.durations = 0
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    def merge(self, other):
+        self.tasks += other.tasks
+        self.errors += other.errors
+        self.nbytes += other.nbytes
+        self.duration_sum += other.duration_sum
+        self.durations += other.durations
+        self.sketch.merge(other.sketch)
+
+    def to_dict(self):
+        return {"tasks"        : self.tasks,
+                "errors"       : self.errors,
+                "nbytes"       : self.nbytes,
+                "duration_sum" : self.duration_sum,
+                "durations"    : self.durations,
+                "sketch"       : self.sketch.to_dict()}
+
+    @classmethod
+    def from_dict(cls, state, relative_accuracy=0.01):
+        a = cls(relative_accuracy)
+        a.tasks = state["tasks"]
+        a.errors = state["errors"]
+        a.nbytes = state["nbytes"]
+        a.duration_sum = state["duration_sum"]
+        a.durations = state["durations"]
+        a.sketch = QuantileSketch.from_dict(state["sketch"], relative_accuracy)
+        return a
+
+
+def _factorize(keys):
+    """Codes of the distinct keys of an array, and the keys, -1 for missing keys"""
+    import pandas as pd
+
+    codes, uniques = pd.factorize(keys, use_na_sentinel=True)
+    if keys.dtype.kind in "iu":
+        # null dictionary codes
+        codes[keys < 0] = -1
+    return codes, list(uniques)
+
+
+class RollingStats():
+    """
+    Statistics of the tasks completed over the last ``window`` seconds, see the module documentation.
+
+    Parameters
+    ----------
+    window :
+        Length of the sliding window, in seconds of event time.
+    buckets :
+        Number of buckets of the window, the window slides by ``window / buckets``.
+    relative_accuracy :
+        Relative accuracy of the duration quantiles.
+    labels :
+        Optional ``labels(key) -> name`` turning the keys (dictionary codes for
+        instance) into names in the query results.
+    """
+    def __init__(self, window=60.0, buckets=12, relative_accuracy=0.01, labels=None):
+        self.window = window
+        self.nbuckets = max(1, buckets)
+        self.width = window / self.nbuckets
+        self.relative_accuracy = relative_accuracy
+        self.labels = labels
+        self.lock = threading.Lock()
+        # bucket id -> {(group, key): Aggregate}
+        self.buckets = {}
+        self.newest = None
+        self.events = 0
+        self.late = 0
+
+    def _slide(self, bucket):
+        """Make ``bucket`` the newest bucket if it is, dropping the buckets out of the window"""
+        if self.newest is None or bucket > self.newest:
+            self.newest = bucket
+            for old in [b for b in self.buckets if b <= bucket - self.nbuckets]:
+                del self.buckets[old]
+
+    def add_batch(self, time, groups, duration=None, nbytes=None, erred=None):
+        """
+        Aggregate a batch of completed tasks.
+
+        Parameters
+        ----------
+        time :
+            Array of the event times, in seconds.
+        groups :
+            Dict mapping ``prefix`` and ``worker`` to the arrays of the keys of the tasks.
+        duration, nbytes :
+            Optional arrays of the durations and bytes produced, NaN when unknown.
+        erred :
+            Optional boolean array, True for the tasks that erred.
+        """
+        time = np.asarray(time, dtype=float)
+        timed = np.flatnonzero(~np.isnan(time))
+        n = len(timed)
+        if not n:
+            return
+        time = time[timed]
+        groups = {group: np.asarray(keys)[timed] for group, keys in groups.items()}
+        duration = np.full(n, np.nan) if duration is None else np.asarray(duration, dtype=float)[timed]
+        nbytes = np.zeros(n) if nbytes is None else np.nan_to_num(np.asarray(nbytes, dtype=float)[timed])
+        erred = np.zeros(n, dtype=bool) if erred is None else np.asarray(erred, dtype=bool)[timed]
+        ids = np.floor(time / self.width).astype(np.int64)
+        with self.lock:
+            self._slide(int(ids.max()))
+            first = self.newest - self.nbuckets + 1
+            live = ids >= first
+            self.late += int(n - np.count_nonzero(live))
+            self.events += n
+            for bucket in np.unique(ids[live]).tolist():
+                rows = np.flatnonzero(ids == bucket)
+                aggregates = self.buckets.setdefault(bucket, {})
+                for group, keys in groups.items():
+                    self._add_group(aggregates, group, keys[rows], duration[rows], nbytes[rows], erred[rows])
+
+    def _add_group(self, aggregates, group, keys, duration, nbytes, erred):
+        codes, uniques = _factorize(keys)
+        valid = codes >= 0
+        codes, duration, nbytes, erred = codes[valid], duration[valid], nbytes[valid], erred[valid]
+        m = len(uniques)
+        tasks = np.bincount(codes, minlength=m)
+        errors = np.bincount(codes, weights=erred, minlength=m)
+        total = np.bincount(codes, weights=nbytes, minlength=m)
+        timed = ~np.isnan(duration)
+        sums = np.bincount(codes, weights=np.where(timed, duration, 0.0), minlength=m)
+        counts = np.bincount(codes, weights=timed, minlength=m)
+        # the durations of every key, contiguous
+        order = np.argsort(codes, kind="stable")
+        ends = np.cumsum(tasks)
+        for j, key in enumerate(uniques):
+            if isinstance(key, np.generic):
+                key = key.item()
+            a = aggregates.get((group, key))
+            if a is None:
+                a = aggregates[(group, key)] = Aggregate(self.relative_accuracy)
+            a.tasks += int(tasks[j])
+            a.errors += int(errors[j])
+            a.nbytes += int(total[j])
+            a.duration_sum += float(sums[j])
+            a.durations += int(counts[j])
+            if counts[j]:
+                a.sketch.add_many(duration[order[ends[j] - tasks[j]:ends[j]]])
+
+    def add_transitions(self, columns, codes=None):
+        """
+        Aggregate a batch of decoded ``scheduler_transition`` columns.
+
+        ``codes`` maps the strings to their dictionary codes when the state,
+        prefix and worker columns hold codes (binary frames).
+        """
+        finish = np.asarray(columns["finish"])
+        if finish.dtype == object:
+            memory, erred = finish == "memory", finish == "erred"
+        else:
+            codes = codes or {}
+            memory, erred = finish == codes.get("memory", -2), finish == codes.get("erred", -2)
+        done = np.flatnonzero(memory | erred)
+        if not len(done):
+            return
+        get = lambda name: np.asarray(columns[name])[done] if name in columns else None
+        self.add_batch(get("time"),
+                       {group: get(group) for group in GROUPS if group in columns},
+                       duration=get("duration"),
+                       nbytes=get("size"),
+                       erred=erred[done])
+
+    def query(self, by="prefix"):
+        """
+        Statistics of the window per key of ``by`` (``prefix`` or ``worker``).
+
+        Returns
+        -------
+            A list of dicts, the keys with the most tasks first.
+        """
+        with self.lock:
+            if self.newest is None:
+                return []
+            first = self.newest - self.nbuckets + 1
+            live = [b for b in self.buckets if b >= first]
+            merged = {}
+            for bucket in live:
+                for (group, key), a in self.buckets[bucket].items():
+                    if group != by:
+                        continue
+                    m = merged.get(key)
+                    if m is None:
+                        m = merged[key] = Aggregate(self.relative_accuracy)
+                    m.merge(a)
+            start = min(live) * self.width if live else first * self.width
+            end = (self.newest + 1) * self.width
+        span = end - start
+        rows = []
+        for key, a in merged.items():
+            row = {by             : self.labels(key) if self.labels is not None else key,
+                   "window_start" : start,
+                   "window_end"   : end,
+                   "tasks"        : a.tasks,
+                   "throughput"   : a.tasks / span,
+                   "errors"       : a.errors,
+                   "error_rate"   : a.errors / a.tasks if a.tasks else 0.0,
+                   "bytes"        : a.nbytes,
+                   "bytes_per_s"  : a.nbytes / span,
+                   "mean"         : a.duration_sum / a.durations if a.durations else math.nan}
+            for q in QUANTILES:
+                row[f"p{round(q * 100)}"] = a.sketch.quantile(q)
+            rows.append(row)
+        rows.sort(key=lambda row: -row["tasks"])
+        return rows
+
+    def frame(self, by="prefix"):
+        import pandas as pd
+        return pd.DataFrame(self.query(by))
+
+    def to_dict(self):
+        """JSON-able buckets of the window, the keys turned into their labels"""
+        label = self.labels if self.labels is not None else (lambda key: key)
+        with self.lock:
+            return {"window"            : self.window,
+                    "buckets"           : self.nbuckets,
+                    "relative_accuracy" : self.relative_accuracy,
+                    "newest"            : self.newest,
+                    "events"            : self.events,
+                    "late"              : self.late,
+                    "aggregates"        : [[bucket, group, label(key), a.to_dict()]
+                                           for bucket, aggregates in self.buckets.items()
+                                           for (group, key), a in aggregates.items()]}
+
+    @classmethod
+    def from_dict(cls, state):
+        stats = cls(state["window"], state["buckets"], state["relative_accuracy"])
+        stats.newest = state["newest"]
+        stats.events = state["events"]
+        stats.late = state["late"]
+        for bucket, group, key, a in state["aggregates"]:
+            stats.buckets.setdefault(bucket, {})[(group, key)] = Aggregate.from_dict(a, stats.relative_accuracy)
+        return stats
+
+    def merge(self, other):
+        """
+        Add the buckets of ``other``, which must have the same window and buckets.
+        The window slides to the newest bucket of both.
+        """
+        if (other.window, other.nbuckets) != (self.window, self.nbuckets):
+            raise ValueError(f"Cannot merge rolling statistics of {other.nbuckets} buckets over {other.window}s "
+                             f"into {self.nbuckets} buckets over {self.window}s")
+        with self.lock:
+            self.events += other.events
+            self.late += other.late
+            if other.newest is None:
+                return
+            self._slide(other.newest)
+            first = self.newest - self.nbuckets + 1
+            for bucket, aggregates in other.buckets.items():
+                if bucket < first:
+                    continue
+                mine = self.buckets.setdefault(bucket, {})
+                for key, a in aggregates.items():
+                    m = mine.get(key)
+                    if m is None:
+                        m = mine[key] = Aggregate(self.relative_accuracy)
+                    m.merge(a)
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, default=str)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+def serve(stats, port, host=""):
+    """
+    Answer ``GET /stats?by=prefix`` (or ``worker``) with the JSON of ``stats.query``
+    from a background thread. Returns the server, ``shutdown`` stops it.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlparse
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            by = parse_qs(url.query).get("by", ["prefix"])[0]
+            if url.path != "/stats" or by not in GROUPS:
+                self.send_error(404, f"Use /stats?by={'|'.join(GROUPS)}")
+                return
+            rows = [{k: (None if isinstance(v, float) and math.isnan(v) else v) for k, v in row.items()}
+                    for row in stats.query(by)]
+            body = json.dumps(rows, default=str).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("stats server: " + format, *args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="mofka-stats-server", daemon=True).start()
+    logging.info("Rolling statistics served on http://%s:%d/stats", host or "0.0.0.0", server.server_port)
+    return server
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+from fnmatch import fnmatchcase
+
+
+class SamplingRule():
+    """
+    One sampling rule for task transitions.
+
+    Patterns use shell wildcards (``*``, ``?``, ``[...]``) and match the task
+    prefix, the start and finish states and the worker address or name.
+
+    Parameters
+    ----------
+    prefix, start, finish, worker :
+        Patterns the transition must match for the rule to apply.
+    rate :
+        Fraction of the matching transitions that is kept, per task prefix.
+        Sampling is deterministic: with ``rate=0.25`` exactly one transition out
+        of four is kept.
+    first :
+        Keep the first ``first`` matching transitions of every task prefix,
+        then apply ``rate`` (which defaults to 0 in this case).
+    """
+    def __init__(self, prefix="*", start="*", finish="*", worker="*", rate=None, first=None):
+        self.prefix = prefix
+        self.start = start
+        self.finish = finish
+        self.worker = worker
+        self.first = first
+        if rate is None:
+            rate = 1.0 if first is None else 0.0
+        if not 0.0 <= rate <= 1.0:
+            raise ValueError(f"Sampling rate must be between 0 and 1, got {rate}")
+        self.rate = rate
+
+    def matches(self, prefix, start, finish, worker):
+        return (fnmatchcase(prefix or "", self.prefix)
+                and fnmatchcase(start or "", self.start)
+                and fnmatchcase(finish or "", self.finish)
+                and fnmatchcase(worker or "", self.worker))
+
+    def to_dict(self):
+        return {"prefix": self.prefix, "start": self.start, "finish": self.finish,
+                "worker": self.worker, "rate": self.rate, "first": self.first}
+
+    def __repr__(self):
+        return f"SamplingRule({self.to_dict()})"
+
+
+class SamplingPolicy():
+    """
+    Decides which task transitions are pushed to Mofka.
+
+    Rules are tried in order and the first matching one applies. Transitions
+    that match no rule are always kept, so a policy without rules keeps
+    everything. Put the transitions you always want first, for instance::
+
+        [{"finish": "erred"},
+         {"start": "processing", "finish": "memory"},
+         {"start": "released", "finish": "waiting", "rate": 0.01},
+         {"prefix": "getitem*", "first": 100}]
+
+    The policy counts exactly how many transitions it suppressed per
+    (prefix, start, finish), so consumers can rescale their aggregates.
+    """
+    def __init__(self, rules=()):
+        self.set_rules(rules)
+        self.suppressed = {}
+        self.suppressed_total = 0
+
+    def set_rules(self, rules):
+        """Replace the rules, given as SamplingRule or dicts of SamplingRule arguments"""
+        self.rules = [r if isinstance(r, SamplingRule) else SamplingRule(**r) for r in rules]
+        # memoized rule index per (prefix, start, finish, worker), None if no rule matches
+        self.matched = {}
+        # per (rule index, prefix): [transitions seen, sampling credit]
+        self.state = {}
+
+    def _match(self, prefix, start, finish, worker):
+        for i, rule in enumerate(self.rules):
+            if rule.matches(prefix, start, finish, worker):
+                return i
+        return None
+
+    def keep(self, prefix, start, finish, worker=None):
+        """Whether this transition must be pushed, counting it if it is suppressed"""
+        if not self.rules:
+            return True
+        signature = (prefix, start, finish, worker)
+        try:
+            i = self.matched[signature]
+        except KeyError:
+            i = self.matched[signature] = self._match(prefix, start, finish, worker)
+        if i is None:
+            return True
+        rule = self.rules[i]
+        state = self.state.get((i, prefix))
+        if state is None:
+            state = self.state[(i, prefix)] = [0, 0.0]
+        state[0] += 1
+        if rule.first is not None and state[0] <= rule.first:
+            return True
+        state[1] += rule.rate
+        if state[1] >= 1.0:
+            state[1] -= 1.0
+            return True
+        key = (prefix, start, finish)
+        self.suppressed[key] = self.suppressed.get(key, 0) + 1
+        self.suppressed_total += 1
+        return False
+
+    def report(self, source):
+        """
+        Suppressed counts since the last report, as ``sampling_stats`` records.
+        The counters are reset so that consumers can simply sum the reports.
+        """
+        now = time.time()
+        suppressed, self.suppressed = self.suppressed, {}
+        return [{"source": source, "prefix": prefix, "start": start, "finish": finish,
+                 "suppressed": count, "time": now}
+                for (prefix, start, finish), count in suppressed.items()]
+
+    def to_dict(self):
+        return {"rules": [r.to_dict() for r in self.rules],
+                "suppressed_total": self.suppressed_total}
+
+    @classmethod
+    def from_config(cls, config):
+        """Build a policy from a JSON list of rules, or from the path of a file holding one"""
+        if not config:
+            return cls()
+        if os.path.exists(config):
+            with open(config) as f:
+                return cls(json.load(f))
+        return cls(json.loads(config))
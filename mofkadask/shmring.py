@@ -0,0 +1,303 @@
+"""
+Shared memory ring buffers between the workers of a node and its Mofka agent.
+
+Every worker plugin configured with an agent creates its own ring, a POSIX
+shared memory segment named ``mofkadask-<agent>-<pid>-<id>``, and writes its
+events into it. The agent (``python -m mofkadask.agent``) finds the rings of
+its name in ``/dev/shm``, reads them and pushes the events through its single
+Mofka producer. A ring has one writer process and one reader process, so it
+needs no lock shared between processes: the writer only moves ``tail``, the
+reader only moves ``head``.
+
+Segment layout, all counters are little-endian u64::
+
+    0   magic "MDRING01"
+    8   capacity of the data area, in bytes
+    16  head, bytes read by the agent since the creation of the ring
+    24  tail, bytes written by the worker
+    32  events written by the worker
+    40  events read by the agent
+    48  flush request: the worker asks the agent to push everything below this tail
+    56  flushed: tail up to which the agent pushed and flushed the events
+    64  closed: 1 once the worker wrote its last event
+    72  heartbeat of the agent, time.time_ns()
+    128 data area
+
+Every event is a u32 length followed by the pickled ``(action, record)`` pair.
+An event never wraps around the end of the data area: the writer skips the end
+of the area (marked with a ``PAD`` length if there is room for one) and
+starts again at its beginning.
+"""
+import os
+import time
+import uuid
+import pickle
+import struct
+import logging
+import threading
+from multiprocessing import shared_memory
+
+MAGIC = b"MDRING01"
+PREFIX = "mofkadask"
+SHM_DIR = "/dev/shm"
+
+CAPACITY = 8
+HEAD = 16
+TAIL = 24
+WRITTEN = 32
+READ = 40
+FLUSH_REQUEST = 48
+FLUSHED = 56
+CLOSED = 64
+HEARTBEAT = 72
+DATA = 128
+
+U64 = struct.Struct("<Q")
+U32 = struct.Struct("<I")
+PAD = 0xFFFFFFFF
+
+# an agent whose heartbeat is older than this many seconds is considered gone
+AGENT_TIMEOUT = 5.0
+
+
+def ring_prefix(agent):
+    return f"{PREFIX}-{agent}-"
+
+
+def _attach(name):
+    """Attach an existing segment without handing it to the resource tracker of this process"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 always tracks the segments, and would unlink them when this process exits
+        shm = shared_memory.SharedMemory(name=name)
+        _untrack(shm)
+        return shm
+
+
+def _untrack(shm):
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+
+
+def _unlink(shm):
+    """Unlink a segment of this module, none of them is known to the resource tracker"""
+    try:
+        import _posixshmem
+    except ImportError:
+        # no segment to unlink on windows, they go with their last handle
+        shm.unlink()
+        return
+    # SharedMemory.unlink of python < 3.13 also unregisters the segment, which the tracker reports as an error
+    _posixshmem.shm_unlink(shm._name)
+
+
+class ShmRing():
+    """
+    One ring buffer in a shared memory segment.
+
+    Use ``ShmRing.create`` in the worker and ``ShmRing.attach`` in the agent.
+    """
+    def __init__(self, shm):
+        self.shm = shm
+        self.name = shm.name
+        self.buf = shm.buf
+        if bytes(self.buf[:8]) != MAGIC:
+            raise ValueError(f"{self.name} is not a mofkadask ring")
+        self.capacity = self.get(CAPACITY)
+
+    @classmethod
+    def create(cls, agent, capacity):
+        name = f"{ring_prefix(agent)}{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=DATA + capacity, track=False)
+        except TypeError:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=DATA + capacity)
+            # the agent unlinks the ring once it read it, not the exit of this process
+            _untrack(shm)
+        shm.buf[:DATA] = bytes(DATA)
+        U64.pack_into(shm.buf, CAPACITY, capacity)
+        # the magic goes last, the agent ignores the ring until then
+        shm.buf[:8] = MAGIC
+        return cls(shm)
+
+    @classmethod
+    def attach(cls, name):
+        shm = _attach(name)
+        try:
+            return cls(shm)
+        except ValueError:
+            shm.close()
+            raise
+
+    @property
+    def pid(self):
+        """Pid of the worker process, from the ring name"""
+        return int(self.name.rsplit("-", 2)[1])
+
+    def get(self, offset):
+        return U64.unpack_from(self.buf, offset)[0]
+
+    def set(self, offset, value):
+        U64.pack_into(self.buf, offset, value)
+
+    def put(self, payload):
+        """Write one event, returns False if the ring is full. Only the worker calls it."""
+        n = len(payload)
+        needed = U32.size + n
+        if needed > self.capacity:
+            raise ValueError(f"Event of {n} bytes larger than the ring {self.name}")
+        tail = self.get(TAIL)
+        pos = tail % self.capacity
+        skip = self.capacity - pos if self.capacity - pos < needed else 0
+        if tail + skip + needed - self.get(HEAD) > self.capacity:
+            return False
+        if skip:
+            if skip >= U32.size:
+                U32.pack_into(self.buf, DATA + pos, PAD)
+            pos = 0
+        start = DATA + pos
+        U32.pack_into(self.buf, start, n)
+        self.buf[start + U32.size:start + needed] = payload
+        # publish the event once it is written
+        self.set(TAIL, tail + skip + needed)
+        self.set(WRITTEN, self.get(WRITTEN) + 1)
+        return True
+
+    def take(self):
+        """Read all the events written so far. Only the agent calls it."""
+        head = self.get(HEAD)
+        tail = self.get(TAIL)
+        payloads = []
+        while head < tail:
+            pos = head % self.capacity
+            if self.capacity - pos < U32.size:
+                head += self.capacity - pos
+                continue
+            n = U32.unpack_from(self.buf, DATA + pos)[0]
+            if n == PAD:
+                head += self.capacity - pos
+                continue
+            start = DATA + pos + U32.size
+            payloads.append(bytes(self.buf[start:start + n]))
+            head += U32.size + n
+        if payloads:
+            self.set(HEAD, head)
+            self.set(READ, self.get(READ) + len(payloads))
+        return payloads
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        try:
+            _unlink(self.shm)
+        except FileNotFoundError:
+            pass
+
+
+def list_rings(agent):
+    """Names of the rings of the ``agent`` agent currently in shared memory"""
+    prefix = ring_prefix(agent)
+    try:
+        return sorted(name for name in os.listdir(SHM_DIR) if name.startswith(prefix))
+    except FileNotFoundError:
+        return []
+
+
+class AgentEmitter():
+    """
+    Emitter handing the events of a worker to the Mofka agent of its node.
+
+    It has the interface of BatchingEmitter, so the worker plugin uses either of
+    them. ``emit`` pickles the event into the shared memory ring of the worker,
+    the encoding and the Mofka pushes happen in the agent process.
+
+    Parameters
+    ----------
+    agent :
+        Name of the agent, as given to ``python -m mofkadask.agent --name``.
+    capacity :
+        Size of the ring, in bytes.
+    overflow :
+        What ``emit`` does when the ring is full: ``block`` waits for the agent to
+        read it, the other policies drop the event.
+    name :
+        Name used in log messages.
+    """
+    def __init__(self, agent, capacity=16 << 20, overflow="block", name="mofka-agent-emitter"):
+        self.agent = agent
+        self.overflow = overflow
+        self.name = name
+        self.ring = ShmRing.create(agent, capacity)
+        self.created = time.time()
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.closed = False
+        logging.info("%s: events go to agent %s through %s", name, agent, self.ring.name)
+
+    def emit(self, action, record):
+        if self.closed:
+            logging.warning("%s: %s event emitted after close is dropped", self.name, action)
+            return False
+        payload = pickle.dumps((action, record), protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            while not self.ring.put(payload):
+                if self.overflow != "block" or not self.agent_alive():
+                    self.dropped += 1
+                    return False
+                time.sleep(0.001)
+        return True
+
+    def agent_alive(self):
+        heartbeat = self.ring.get(HEARTBEAT)
+        if not heartbeat:
+            # give the agent time to find the ring
+            return time.time() - self.created < AGENT_TIMEOUT
+        return time.time() - heartbeat * 1e-9 < AGENT_TIMEOUT
+
+    @property
+    def queued(self):
+        return self.ring.get(WRITTEN) - self.ring.get(READ)
+
+    def flush(self, timeout=None):
+        """
+        Block until the agent pushed every event emitted before this call and
+        flushed its producer. Returns False if ``timeout`` expired first, or
+        if the agent is not running.
+        """
+        if self.closed:
+            return True
+        request = self.ring.get(TAIL)
+        self.ring.set(FLUSH_REQUEST, request)
+        deadline = None if timeout is None else time.time() + timeout
+        while self.ring.get(FLUSHED) < request:
+            if not self.agent_alive() or (deadline is not None and time.time() > deadline):
+                return False
+            time.sleep(0.001)
+        return True
+
+    def stats(self):
+        return {"queued"  : self.queued,
+                "dropped" : self.dropped,
+                "written" : self.ring.get(WRITTEN),
+                "read"    : self.ring.get(READ)}
+
+    def close(self, timeout=None):
+        """Wait for the agent to push the remaining events, and release the ring"""
+        if self.closed:
+            return
+        flushed = self.flush(timeout)
+        self.closed = True
+        self.ring.set(CLOSED, 1)
+        logging.info("%s closed: %s", self.name, self.stats())
+        if not flushed:
+            logging.warning("%s: agent %s did not read %d events", self.name, self.agent, self.queued)
+            if not self.agent_alive():
+                # nobody will read the ring
+                self.ring.unlink()
+        self.ring.close()
@@ -0,0 +1,246 @@
+"""
+Streaming Parquet or Arrow IPC sink of the consumer tables.
+
+Instead of keeping every table in memory until the end of the run, the consumer
+hands a table to the Sink every ``rows`` rows or ``interval`` seconds, and the
+sink appends it as a row group (Parquet) or record batches (Arrow IPC stream)
+to the current file of the table, then the consumer starts the table over. The
+memory of the consumer thus stays bounded by the tables of the last interval.
+
+Every table is written to ``<directory>/<table>-<sequence>.parquet`` (or
+``.arrows``), rolled to the next sequence once the file reaches
+``max_file_size`` bytes or when the columns of the table change. String
+columns are dictionary encoded. ``<directory>/index.json`` lists the files of
+every table with their row counts, sizes and columns, and is rewritten after
+every write, so readers can follow the run::
+
+    {"format": "parquet", "tables": {"worker_transition": [
+        {"path": "worker_transition-000000.parquet", "rows": 65536, "bytes": 1048576,
+         "groups": 1, "columns": [...], "complete": false}, ...]}}
+
+A Parquet file can only be read once ``complete``, its footer is written when
+it is closed. An Arrow IPC stream can be read up to its last batch, even after
+a crash of the consumer.
+
+The sink needs ``pyarrow``.
+"""
+import os
+import json
+import time
+import logging
+
+FORMATS = {"parquet": ".parquet", "arrow": ".arrows"}
+INDEX = "index.json"
+
+
+def _arrow():
+    try:
+        import pyarrow
+    except ImportError as Argument:
+        raise ImportError("The streaming sink needs pyarrow, install it or run the consumer without --sink-dir") \
+            from Argument
+    return pyarrow
+
+
+def to_arrow(frame):
+    """
+    Arrow table of a DataFrame of the consumer, strings dictionary encoded.
+
+    Categorical columns keep only the categories they use and get int32
+    indices, so the row groups of a file share the same type. Object columns
+    that are not strings (tuples of task keys, lists) are written as strings.
+    """
+    pa = _arrow()
+    import pandas as pd
+
+    columns = {}
+    for name in frame.columns:
+        values = frame[name]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.cat.remove_unused_categories()
+            columns[name] = pa.DictionaryArray.from_arrays(
+                pa.array(values.cat.codes.to_numpy(), pa.int32(), mask=values.isna().to_numpy()),
+                pa.array(values.cat.categories.astype(str), pa.string()))
+            continue
+        if values.dtype == object:
+            try:
+                array = pa.array(values, from_pandas=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                array = pa.array([None if v is None else str(v) for v in values], pa.string())
+            if pa.types.is_string(array.type) or pa.types.is_large_string(array.type):
+                array = array.cast(pa.string()).dictionary_encode()
+            columns[name] = array
+            continue
+        columns[name] = pa.array(values.to_numpy(), from_pandas=True)
+    return pa.table(columns)
+
+
+def _conform(table, schema):
+    """``table`` cast to ``schema``, missing columns as nulls, None if it does not fit"""
+    pa = _arrow()
+    if table.schema.equals(schema):
+        return table
+    if not set(table.column_names) <= set(schema.names):
+        return None
+    arrays = []
+    for field in schema:
+        if field.name not in table.column_names:
+            arrays.append(pa.nulls(len(table), field.type))
+            continue
+        column = table.column(field.name)
+        if column.type == field.type:
+            arrays.append(column)
+            continue
+        try:
+            if pa.types.is_dictionary(field.type) and not pa.types.is_dictionary(column.type):
+                column = column.cast(field.type.value_type).dictionary_encode()
+            arrays.append(column.cast(field.type))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+            return None
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+class TableFile():
+    """One file of a table being written"""
+    def __init__(self, directory, table, sequence, schema, format):
+        pa = _arrow()
+        self.path = os.path.join(directory, f"{table}-{sequence:06d}{FORMATS[format]}")
+        self.schema = schema
+        self.format = format
+        self.rows = 0
+        self.groups = 0
+        self.complete = False
+        if format == "parquet":
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(self.path, schema, use_dictionary=True, compression="zstd")
+        else:
+            self.file = pa.OSFile(self.path, "wb")
+            self.writer = pa.ipc.new_stream(self.file, schema)
+
+    @property
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def write(self, table):
+        self.writer.write_table(table)
+        self.rows += len(table)
+        self.groups += 1
+
+    def close(self):
+        if not self.complete:
+            self.writer.close()
+            if self.format != "parquet":
+                self.file.close()
+            self.complete = True
+
+    def entry(self, directory):
+        return {"path"     : os.path.relpath(self.path, directory),
+                "rows"     : self.rows,
+                "bytes"    : self.size,
+                "groups"   : self.groups,
+                "columns"  : self.schema.names,
+                "complete" : self.complete}
+
+
+class Sink():
+    """
+    Files of the tables of a consumer, see the module documentation.
+
+    Parameters
+    ----------
+    directory :
+        Directory of the files and of ``index.json``, created if needed.
+    format :
+        ``parquet`` or ``arrow`` (Arrow IPC stream).
+    rows :
+        Number of rows from which a table is written.
+    interval :
+        Seconds after which a table is written, whatever its number of rows.
+    max_file_size :
+        Size in bytes from which the next write of a table goes to a new file.
+    """
+    def __init__(self, directory, format="parquet", rows=65536, interval=10.0, max_file_size=256 << 20):
+        if format not in FORMATS:
+            raise ValueError(f"Unknown sink format {format!r}, expected one of {tuple(FORMATS)}")
+        _arrow()
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.format = format
+        self.rows = rows
+        self.interval = interval
+        self.max_file_size = max_file_size
+        # table -> [TableFile], the last one is being written
+        self.files = {}
+        self.written_at = {}
+        self.written = 0
+
+    def due(self, table, rows, now=None):
+        """True if a table of ``rows`` rows should be written now"""
+        if not rows:
+            return False
+        if rows >= self.rows:
+            return True
+        now = time.time() if now is None else now
+        return now - self.written_at.setdefault(table, now) >= self.interval
+
+    def write(self, table, frame):
+        """Append a DataFrame to the files of ``table``"""
+        self.written_at[table] = time.time()
+        if not len(frame):
+            return
+        data = to_arrow(frame)
+        files = self.files.setdefault(table, [])
+        current = files[-1] if files and not files[-1].complete else None
+        if current is not None:
+            conformed = _conform(data, current.schema)
+            if conformed is None or current.size >= self.max_file_size:
+                # the columns changed or the file is full
+                current.close()
+                current = None
+            else:
+                data = conformed
+        if current is None:
+            current = TableFile(self.directory, table, len(files), data.schema, self.format)
+            files.append(current)
+            logging.info("Writing table %s to %s", table, current.path)
+        current.write(data)
+        self.written += len(data)
+        self.write_index()
+
+    def write_index(self):
+        index = {"format" : self.format,
+                 "tables" : {table: [f.entry(self.directory) for f in files] for table, files in self.files.items()}}
+        path = os.path.join(self.directory, INDEX)
+        with open(path + ".tmp", "w") as f:
+            json.dump(index, f, indent=1)
+        os.replace(path + ".tmp", path)
+
+    def read(self, table):
+        """DataFrame of all the rows written to ``table``, from its complete files"""
+        pa = _arrow()
+        import pandas as pd
+
+        frames = []
+        for f in self.files.get(table, []):
+            if not f.complete:
+                continue
+            if self.format == "parquet":
+                import pyarrow.parquet as pq
+                data = pq.read_table(f.path)
+            else:
+                with pa.OSFile(f.path, "rb") as source:
+                    data = pa.ipc.open_stream(source).read_all()
+            frames.append(data.to_pandas())
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    def close(self):
+        """Close every file and write the final index"""
+        for files in self.files.values():
+            if files:
+                files[-1].close()
+        self.write_index()
+        logging.info("Sink %s closed, %d rows written to %d files", self.directory, self.written,
+                     sum(len(files) for files in self.files.values()))
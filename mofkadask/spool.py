@@ -0,0 +1,403 @@
+"""
+Local write-ahead spool of the events that cannot be pushed to Mofka right now.
+
+When Mofka falls behind (too many events waiting to be pushed) or pushes fail,
+the plugins append their events to a Spool instead of blocking Dask or losing
+them, and replay them once Mofka keeps up again. Once a spool is active every
+new event goes through it, so events are still pushed in the order they were
+emitted, with their original timestamps.
+
+A spool is a directory of append-only segment files, named
+``<name>-<sequence>.seg`` and written through ``mmap``. Every record is::
+
+    length (u32), crc32 of the payload (u32), payload
+
+where the payload is the pickled ``(action, record)`` pair, or ``(ENCODED,
+(metadata, data))`` for an event spooled after it was encoded (the chunks of a
+graph left after a failed push, the events of a failed flush). A zero length marks
+the end of the written part of a segment, and a record whose checksum does not
+match (torn by a crash) ends it too. The pages of the segments survive a crash
+of the process; they are synced to disk when a segment is full and when the
+spool is closed. A segment is deleted once all its events were pushed and the
+producer flushed, so events are delivered at least once: the events of a
+partially replayed segment are pushed again if the process dies meanwhile.
+
+Segments left behind by dead processes are replayed with::
+
+    python -m mofkadask.spool --spool-dir spool --mofka-protocol cxi --group-file mofka.json
+"""
+import os
+import mmap
+import time
+import uuid
+import zlib
+import pickle
+import socket
+import struct
+import logging
+import threading
+
+import click
+
+from mofkadask.connection import MofkaConnection
+from mofkadask.emitter import BatchingEmitter, split_runs
+from mofkadask.encoding import ENCODED
+
+RECORD = struct.Struct("<II")
+SUFFIX = ".seg"
+# events replayed at once by the plugins pushing from the event loop
+REPLAY_BATCH = 1024
+
+
+def spool_name(component):
+    """Unique spool name of a plugin of this process"""
+    return f"{component}-{os.getpid()}-{uuid.uuid4().hex[:8]}@{socket.gethostname()}"
+
+
+class Segment():
+    """One segment file, mapped in memory"""
+    def __init__(self, path, size=None):
+        self.path = path
+        self.writable = size is not None
+        if size is None:
+            self.file = open(path, "rb")
+            size = os.fstat(self.file.fileno()).st_size
+            self.mm = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ) if size else None
+        else:
+            self.file = open(path, "w+b")
+            self.file.truncate(size)
+            self.mm = mmap.mmap(self.file.fileno(), size)
+        self.size = size
+        # end of the written records
+        self.end = 0
+
+    def append(self, payload):
+        """Write one record, returns False if it does not fit"""
+        n = len(payload)
+        if self.end + RECORD.size + n > self.size:
+            return False
+        start = self.end + RECORD.size
+        self.mm[start:start + n] = payload
+        # the header goes last, a record is only valid once it is complete
+        RECORD.pack_into(self.mm, self.end, n, zlib.crc32(payload))
+        self.end = start + n
+        return True
+
+    def read(self, offset):
+        """Payload of the record at ``offset`` and the offset of the next one, None at the end"""
+        if self.mm is None or offset + RECORD.size > self.size:
+            return None, offset
+        n, crc = RECORD.unpack_from(self.mm, offset)
+        start = offset + RECORD.size
+        if n == 0 or start + n > self.size:
+            return None, offset
+        payload = self.mm[start:start + n]
+        if zlib.crc32(payload) != crc:
+            logging.warning("Corrupted record at %d of spool segment %s, ignoring the rest", offset, self.path)
+            return None, offset
+        return payload, start + n
+
+    def sync(self):
+        if self.writable and not self.mm.closed:
+            self.mm.flush()
+
+    def close(self):
+        if self.mm is not None and not self.mm.closed:
+            self.sync()
+            self.mm.close()
+        self.file.close()
+
+    def delete(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class Spool():
+    """
+    Write-ahead spool of one plugin.
+
+    ``append`` is called by the plugin hooks, ``take``, ``commit`` and ``rewind``
+    by the replayer: ``take`` reads the next events, ``commit`` forgets the events
+    taken so far once they are pushed and flushed, and ``rewind`` goes back to the
+    last commit when their push failed. ``active`` is True from the first append
+    until the replayer caught up, the plugins send every event to the spool
+    meanwhile to keep them in order. After a failed push, ``backoff`` delays the
+    next replay (``due``) from 1 to 30 seconds, ``replayed_ok`` resets the delay.
+
+    Parameters
+    ----------
+    directory :
+        Directory of the segments, created if needed.
+    name :
+        Prefix of the segment files, ``spool_name(component)`` by default.
+    segment_size :
+        Size of the segment files, in bytes.
+    """
+    def __init__(self, directory, name=None, segment_size=64 << 20):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.name = name or spool_name("plugin")
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.segments = []
+        self.sequence = 0
+        # read cursor and last committed cursor, as (segment index, offset)
+        self.cursor = (0, 0)
+        self.committed = (0, 0)
+        self.appended = 0
+        self.taken = 0
+        self.replayed = 0
+        self.active = False
+        self.retry_at = 0.0
+        self.retry_delay = 1.0
+
+    def __len__(self):
+        """Events appended and not committed yet"""
+        return self.appended - self.replayed
+
+    def due(self):
+        """True if there are events to replay and no failure is being waited out"""
+        return self.appended > self.replayed and time.time() >= self.retry_at
+
+    def backoff(self):
+        self.retry_at = time.time() + self.retry_delay
+        self.retry_delay = min(2 * self.retry_delay, 30.0)
+
+    def replayed_ok(self):
+        self.retry_delay = 1.0
+
+    def _new_segment(self, n):
+        path = os.path.join(self.directory, f"{self.name}-{self.sequence:06d}{SUFFIX}")
+        self.sequence += 1
+        if self.segments:
+            self.segments[-1].sync()
+        segment = Segment(path, max(self.segment_size, RECORD.size + n))
+        self.segments.append(segment)
+        logging.info("Spooling events to %s", path)
+        return segment
+
+    def append(self, action, record):
+        payload = pickle.dumps((action, record), protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.active = True
+            if not self.segments or not self.segments[-1].append(payload):
+                self._new_segment(len(payload)).append(payload)
+            self.appended += 1
+
+    def take(self, max_items):
+        """The next ``max_items`` events at most, as (action, record) pairs"""
+        items = []
+        with self.lock:
+            index, offset = self.cursor
+            while len(items) < max_items and index < len(self.segments):
+                payload, offset = self.segments[index].read(offset)
+                if payload is None:
+                    if index == len(self.segments) - 1:
+                        break
+                    index, offset = index + 1, 0
+                    continue
+                items.append(pickle.loads(payload))
+            self.cursor = (index, offset)
+            self.taken += len(items)
+        return items
+
+    def commit(self):
+        """Forget the events taken so far, deleting the segments fully replayed"""
+        with self.lock:
+            index, offset = self.cursor
+            self.replayed = self.taken
+            # every segment before the cursor was read to its end
+            for segment in self.segments[:index]:
+                segment.delete()
+            self.segments = self.segments[index:]
+            self.cursor = self.committed = (0, offset)
+            if self.replayed == self.appended:
+                # caught up, the next events go straight to mofka
+                for segment in self.segments:
+                    segment.delete()
+                self.segments = []
+                self.cursor = self.committed = (0, 0)
+                self.active = False
+
+    def rewind(self):
+        """Read again the events taken since the last commit"""
+        with self.lock:
+            self.cursor = self.committed
+            self.taken = self.replayed
+
+    def close(self):
+        """Sync the segments left to disk, they are replayed by ``python -m mofkadask.spool``"""
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
+            if self.segments:
+                logging.warning("%d spooled events were not replayed, they are kept in %s",
+                                len(self), self.directory)
+            self.segments = []
+
+
+def spool_files(directory):
+    """Segment files of the spools in ``directory``, grouped by spool name and in order"""
+    spools = {}
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(SUFFIX):
+            name = filename[:-len(SUFFIX)].rsplit("-", 1)[0]
+            spools.setdefault(name, []).append(os.path.join(directory, filename))
+    return spools
+
+
+def owner_alive(name):
+    """True if the spool ``name`` belongs to a process still running on this host"""
+    try:
+        owner, host = name.rsplit("@", 1)
+        if host != socket.gethostname():
+            return False
+        os.kill(int(owner.rsplit("-", 2)[1]), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def spool_failed_push(spool, encoder, action, records, events=None, pushed=0):
+    """
+    Spool the events of a failed push: the records if they could not be encoded,
+    else the encoded events from the ``pushed``-th one, the ones before were pushed.
+    """
+    # a lost dictionary delta would make the next events unreadable
+    encoder.resend()
+    spool.backoff()
+    if events is None:
+        for record in records:
+            spool.append(action, record)
+        return
+    for event in events[pushed:]:
+        spool.append(ENCODED, event)
+
+
+def spool_unflushed(spool, encoder, events):
+    """Spool the encoded events pushed since the last flush, after the flush failed"""
+    encoder.resend()
+    spool.backoff()
+    for event in events:
+        spool.append(ENCODED, event)
+    logging.warning("%d events pushed before a failed flush are spooled", len(events))
+
+
+def push_events(items, encoder, producer):
+    """Encode and push (action, record) pairs without waiting for them, returns the number of pushes"""
+    n = 0
+    for action, records in split_runs(items):
+        try:
+            events = encoder(action, records)
+        except Exception:
+            # pushing them again would not help
+            logging.exception("%d spooled %s events could not be encoded, they are dropped", len(records), action)
+            continue
+        for metadata, data in events:
+            producer.push(metadata, data, metadata.get("partition"))
+            n += 1
+    return n
+
+
+async def replay_step(spool, encoder, producer, loop, max_items=REPLAY_BATCH):
+    """
+    Replay the next spooled events of a plugin pushing from the event loop: push
+    them, flush the producer in a thread and commit, or rewind and back off if
+    the push or the flush failed. Returns the number of events replayed.
+    """
+    items = spool.take(max_items)
+    try:
+        push_events(items, encoder, producer)
+        await loop.run_in_executor(None, producer.flush)
+    except Exception:
+        spool.rewind()
+        encoder.resend()
+        spool.backoff()
+        logging.exception("Exception while replaying %d spooled events", len(items))
+        return 0
+    spool.commit()
+    spool.replayed_ok()
+    return len(items)
+
+
+def replay_all(spool, encoder, producer, max_items=REPLAY_BATCH):
+    """Replay the whole spool at close, then close it. The events that cannot be pushed stay on disk."""
+    while producer is not None and spool.due():
+        items = spool.take(max_items)
+        try:
+            push_events(items, encoder, producer)
+            producer.flush()
+        except Exception:
+            spool.rewind()
+            logging.exception("Exception while replaying %d spooled events", len(items))
+            break
+        spool.commit()
+    spool.close()
+
+
+def replay_files(paths, emit):
+    """Call ``emit(action, record)`` for every event of the segment files ``paths``, returns their number"""
+    n = 0
+    for path in paths:
+        segment = Segment(path)
+        offset = 0
+        while True:
+            payload, offset = segment.read(offset)
+            if payload is None:
+                break
+            emit(*pickle.loads(payload))
+            n += 1
+        segment.close()
+    return n
+
+
+@click.command()
+@click.option('--spool-dir',
+               type=str,
+               default="spool",
+               help="Spool directory of the plugins")
+@click.option('--mofka-protocol',
+                type=str,
+                default="cxi",
+                help="Mofka protocol")
+@click.option('--group-file',
+               type=str,
+               default="mofka.json",
+               help="Mofka group file path")
+@click.option('--topic-layout',
+               type=click.Choice(("single", "per-class")),
+               default="single",
+               help="Topic layout the plugins were started with")
+@click.option('--force',
+               is_flag=True,
+               help="Also replay the spools of processes still running on this host")
+def main(spool_dir, mofka_protocol, group_file, topic_layout, force):
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    spools = {name: paths for name, paths in spool_files(spool_dir).items() if force or not owner_alive(name)}
+    if not spools:
+        logging.info("Nothing to replay in %s", spool_dir)
+        return
+    connection = MofkaConnection(mofka_protocol, group_file, "Dask_spool_replayer", topic_layout=topic_layout)
+    emitter = BatchingEmitter(None, name="mofka-spool-replayer", connect=connection.connect)
+    for name, paths in spools.items():
+        t0 = time.time()
+        failed = emitter.failed
+        n = replay_files(paths, emitter.emit)
+        emitter.flush()
+        if emitter.failed > failed:
+            logging.error("%d events of spool %s could not be pushed, its segments are kept",
+                          emitter.failed - failed, name)
+            continue
+        for path in paths:
+            os.remove(path)
+        logging.info("Replayed %d events of spool %s in %.3fs", n, name, time.time() - t0)
+    emitter.close()
+
+
+if __name__ == '__main__':
+    main()
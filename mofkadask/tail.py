@@ -0,0 +1,36 @@
+import logging
+
+
+class LogTail():
+    """
+    Cursor on a bounded log deque (``Worker.transfer_incoming_log`` for instance),
+    returning the entries appended since the previous call.
+
+    The cursor is the last entry returned, compared by identity: ``new_entries``
+    walks the deque backwards from its end until it finds it, so a call costs
+    O(new entries) whatever the length of the log, and keeps working once the
+    deque rotates. If the cursor entry was evicted, more entries were appended
+    than the deque holds since the previous call: all the entries are returned
+    and the overrun is counted, since some entries were lost.
+    """
+    def __init__(self, log, name="log"):
+        self.log = log
+        self.name = name
+        self.last = None
+        self.overruns = 0
+
+    def new_entries(self):
+        entries = []
+        last = self.last
+        for entry in reversed(self.log):
+            if entry is last:
+                break
+            entries.append(entry)
+        else:
+            if last is not None and self.log:
+                self.overruns += 1
+                logging.warning("%s rotated past its cursor, some entries were not tailed", self.name)
+        if entries:
+            self.last = entries[0]
+            entries.reverse()
+        return entries
@@ -0,0 +1,96 @@
+import time
+import logging
+
+
+class WorkerTelemetry():
+    """
+    Periodic resource samples of a Dask worker, pushed as ``worker_telemetry`` events.
+
+    ``sample`` reads the worker process (CPU and RSS through the psutil process of
+    the worker system monitor), its memory manager (managed, unmanaged and
+    spilled bytes, memory limit), its state machine (executing tasks, ready
+    queue) and its transfer counters. It is cheap enough to run every few
+    hundred milliseconds on the worker event loop. The CPU usage is measured
+    between two samples, rather than taken from the system monitor, so that it
+    has the resolution of the sampling period.
+
+    Samples are kept until ``batch`` of them are collected, so that they are
+    pushed together in one frame whose integer columns are delta encoded.
+
+    Parameters
+    ----------
+    worker :
+        The Dask worker.
+    batch :
+        Number of samples pushed together.
+    """
+    def __init__(self, worker, batch=20):
+        self.worker = worker
+        self.batch = batch
+        self.samples = []
+        self.proc = worker.monitor.proc
+        self.last_time = None
+        self.last_cpu = None
+
+    def cpu(self, now):
+        """CPU usage of the worker process since the previous sample, in percent"""
+        times = self.proc.cpu_times()
+        cpu = times.user + times.system
+        usage = None
+        if self.last_time is not None and now > self.last_time:
+            usage = 100.0 * (cpu - self.last_cpu) / (now - self.last_time)
+        self.last_time = now
+        self.last_cpu = cpu
+        return usage
+
+    def spilled(self):
+        """Spilled bytes, in memory (sizeof of the spilled values) and on disk"""
+        try:
+            return self.worker.data.spilled_total
+        except AttributeError:
+            # spilling is disabled
+            return 0, 0
+
+    def sample(self):
+        """
+        Take one sample.
+
+        Returns
+        -------
+            The samples to push once ``batch`` of them are collected, None otherwise.
+        """
+        worker = self.worker
+        state = worker.state
+        now = time.time()
+        try:
+            rss = self.proc.memory_info().rss
+            cpu = self.cpu(now)
+        except Exception:
+            logging.exception("Exception while sampling the worker process")
+            rss, cpu = None, None
+        spilled_memory, spilled_disk = self.spilled()
+        managed = state.nbytes - spilled_memory
+        self.samples.append({"worker"         : worker.address,
+                             "time"           : now,
+                             "cpu"            : cpu,
+                             "rss"            : rss,
+                             "managed"        : managed,
+                             "unmanaged"      : max(0, rss - managed) if rss is not None else None,
+                             "spilled"        : spilled_disk,
+                             "memory_limit"   : worker.memory_manager.memory_limit,
+                             "executing"      : state.executing_count,
+                             "ready"          : len(state.ready),
+                             "incoming_count" : state.transfer_incoming_count,
+                             "incoming_bytes" : state.transfer_incoming_bytes,
+                             "incoming_total" : state.transfer_incoming_count_total,
+                             "outgoing_count" : worker.transfer_outgoing_count,
+                             "outgoing_bytes" : worker.transfer_outgoing_bytes,
+                             "outgoing_total" : worker.transfer_outgoing_count_total})
+        if len(self.samples) >= self.batch:
+            return self.take()
+        return None
+
+    def take(self):
+        """Return and forget the samples collected so far"""
+        samples, self.samples = self.samples, []
+        return samples
@@ -0,0 +1,99 @@
+"""
+Topic layouts of the Dask events.
+
+With the ``single`` layout every event goes to the ``Dask`` topic. With the
+``per-class`` layout every event class has its own ``Dask_<class>`` topic, so a
+consumer only pulls the classes it subscribed to.
+"""
+import logging
+
+from mofkadask.partitioning import open_topic
+
+LAYOUTS = ("single", "per-class")
+
+EVENT_CLASSES = {
+    "lifecycle"            : ("add_worker", "remove_worker", "add_client", "remove_client",
+                              "restart", "before_close", "close", "log_event"),
+    "scheduler_transition" : ("scheduler_transition",),
+    "worker_transition"    : ("worker_transition",),
+    "worker_transfer"      : ("worker_transfer",),
+    "graph"                : ("update_graph", "graph_chunk"),
+    "stats"                : ("sampling_stats", "transition_summary", "latency_histogram",
+                              "stall_report"),
+    "telemetry"            : ("worker_telemetry",),
+    "memory"               : ("worker_spill", "memory_threshold"),
+}
+
+CLASS_OF_ACTION = {action: name for name, actions in EVENT_CLASSES.items() for action in actions}
+
+
+def topic_names(topic_name="Dask", layout="single", classes=None):
+    """
+    Topics of the event classes in ``classes`` (all by default).
+
+    Returns
+    -------
+        A dict mapping every event class to its topic name.
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown topic layout {layout!r}, expected one of {LAYOUTS}")
+    classes = list(EVENT_CLASSES) if classes is None else classes
+    for name in classes:
+        if name not in EVENT_CLASSES:
+            raise ValueError(f"Unknown event class {name!r}, expected one of {list(EVENT_CLASSES)}")
+    if layout == "single":
+        return {name: topic_name for name in classes}
+    return {name: f"{topic_name}_{name}" for name in classes}
+
+
+def action_topics(topic_name="Dask", layout="single"):
+    """Dict mapping every action to its topic, None with the single topic layout"""
+    if layout == "single":
+        return None
+    names = topic_names(topic_name, layout)
+    return {action: names[name] for action, name in CLASS_OF_ACTION.items()}
+
+
+def open_topics(driver, topic_name="Dask", layout="single", partitions=1, classes=None):
+    """
+    Open (and create if needed) the topics of a layout.
+
+    Returns
+    -------
+        A dict mapping every topic name to its topic handle, and the smallest
+        number of partitions of these topics.
+    """
+    names = set(topic_names(topic_name, layout, classes).values())
+    topics = {}
+    counts = []
+    for name in sorted(names):
+        topics[name], npartitions = open_topic(driver, name, partitions)
+        counts.append(npartitions)
+    return topics, min(counts)
+
+
+class TopicProducers():
+    """
+    One Mofka producer per topic behind the producer interface used by the plugins.
+
+    ``push`` sends every event to the producer of the ``topic`` entry of its
+    metadata, and ``flush`` flushes all the producers.
+    """
+    def __init__(self, topics, name, batchsize, thread_pool, ordering):
+        self.producers = {topic_name: topic.producer(name, batchsize, thread_pool, ordering)
+                          for topic_name, topic in topics.items()}
+        self.default = next(iter(self.producers.values())) if len(self.producers) == 1 else None
+
+    def push(self, metadata, data=None, partition=None):
+        producer = self.default or self.producers[metadata["topic"]]
+        kwargs = {} if partition is None else {"partition": partition}
+        if data is None:
+            return producer.push(metadata, **kwargs)
+        return producer.push(metadata, data, **kwargs)
+
+    def flush(self):
+        for topic_name, producer in self.producers.items():
+            try:
+                producer.flush()
+            except Exception:
+                logging.exception("Exception while flushing the producer of topic %s", topic_name)
@@ -1,73 +1,370 @@
 import os
 import sys
 import json
+import asyncio
 import time
 import click
 import logging
+import collections
+import concurrent.futures
 
-from pymargo.core import Engine
-import mochi.mofka.client as mofka
 from typing import Any
 
+from tornado.ioloop import PeriodicCallback
 from distributed.diagnostics.plugin import SchedulerPlugin
 
+# make the mofkadask helpers importable when the plugin is preloaded from nonBlockingPlugins/
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mofkadask.flush import FlushPolicy
+from mofkadask.sampling import SamplingPolicy
+from mofkadask.aggregation import WindowAggregator
+from mofkadask.latency import LatencyTracker
+from mofkadask.partitioning import STRATEGIES
+from mofkadask.metrics import PluginMetrics, timed
+from mofkadask.loopmonitor import LoopMonitor
+from mofkadask.topics import LAYOUTS
+from mofkadask.connection import MofkaConnection
+from mofkadask.spool import Spool, replay_all, replay_step, spool_failed_push, spool_name, spool_unflushed
+
+MODES = ("raw", "aggregate", "both")
+
 class MofkaSchedulerPlugin(SchedulerPlugin):
     """
     MofkaSchedulerPlugin couples Dask distributed witj Mofka through the Scheduler.
     This plugin pushes information about the progress and state transition of Dask
     tasks in the scheduler, adding/removing clients/workers.
+
+    Pushes are not waited on. The producer is flushed according to a FlushPolicy
+    (after a number of events, after some time, or when the scheduler is idle),
+    and on demand with the ``mofka_flush`` scheduler RPC, which also flushes the
+    producers of all the workers running MofkaWorkerPlugin.
+
+    The plugin connects to Mofka in the background (see MofkaConnection), the
+    events pushed meanwhile are kept in memory, up to ``pending_size`` of them.
+
+    With ``spool_dir``, the events are written to a local Spool instead of being
+    pushed when their push fails, when the connection failed, or when Mofka falls
+    behind: ``spool_threshold`` events were pushed while a flush is still running.
+    A periodic callback pushes them again once Mofka keeps up, flushing the
+    producer before it forgets them. The events pushed since the last flush are
+    kept encoded, and spooled if the flush fails.
+
+    Since pushes run on the event loop, a LoopMonitor measures the scheduler event
+    loop lag and attributes the stalls to the actions that were being pushed,
+    ``stall_report`` events are pushed every ``stall_report_interval`` seconds.
+
+    Task transitions go through a SamplingPolicy first, as with the blocking
+    plugin: its rules are replaced at runtime with the ``mofka_set_sampling``
+    scheduler RPC, and the number of suppressed transitions is pushed
+    periodically as ``sampling_stats`` events.
+
+    In ``aggregate`` mode, transitions are not pushed one by one: they are aggregated
+    per task prefix and worker over windows of ``window`` seconds, and only the
+    ``transition_summary`` records of every window are pushed. ``both`` does both.
+
+    The graphs of ``update_graph`` can be large, so they are encoded into CSR
+    chunks and pushed by a background thread. The events of the other hooks wait
+    in memory meanwhile, and are pushed once it is done so the order is kept.
     """
-    def __init__(self, scheduler, mofka_protocol, group_file):
+
+    # actions encoded and pushed by the background thread
+    BACKGROUND_ACTIONS = ("update_graph",)
+
+    def __init__(self, scheduler, mofka_protocol, group_file,
+                 flush_events=1000, flush_interval=1.0, flush_on_idle=True,
+                 partitions=1, partition_by="worker", topic_layout="single",
+                 stall_threshold=50.0, stall_report_interval=5.0, pending_size=65536,
+                 spool_dir=None, spool_threshold=100000, spool_segment_size=64 << 20,
+                 sampling_rules=None, sampling_report_interval=5.0, mode="raw", window=1.0):
         logging.basicConfig(filename="MofkaSchedulerPlugin.log",
                             format='%(asctime)s %(message)s',
                             datefmt='%m/%d/%Y %I:%M:%S %p',
                             filemode='w')
         logger = logging.getLogger()
         logger.setLevel(logging.INFO)
-        # create mofka client
-        print("about to try to create dask client")
         self.scheduler = scheduler
-        self.engine = Engine(mofka_protocol, use_progress_thread=True)
-        self.driver = mofka.MofkaDriver(group_file, self.engine)
-        print("Created dask clinet")
-        # create a topic
-        topic_name = "Dask"
-        if not self.driver.topic_exists(topic_name):
-            logging.info("Mofka topic %s is created by MofkaPlugin", topic_name)
-            self.driver.create_topic(topic_name)
-            self.driver.add_memory_partition(topic_name, 0)
-
-        self.topic = self.driver.open_topic(topic_name)
-
-        # create a producer
-        producer_name = "Dask_scheduler_producer"
-        batchsize = mofka.AdaptiveBatchSize
-        thread_pool = mofka.ThreadPool(1)
-        ordering = mofka.Ordering.Strict
-        self.producer = self.topic.producer(producer_name, batchsize, thread_pool, ordering)
-        logging.info("Mofka producer %s is created", producer_name)
-        
+        # connect to mofka in the background, the events pushed until then are kept in pending
+        self.producer = None
+        self.encoder = None
+        self.pending = collections.deque()
+        self.pending_size = pending_size
+        self.pending_dropped = 0
+        # events pushed while an event is pushed in the background, None when none is
+        self.deferred = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="mofka-graph")
+        self.connection = MofkaConnection(mofka_protocol, group_file, "Dask_scheduler_producer",
+                                          topic_layout=topic_layout, partitions=partitions,
+                                          partition_by=partition_by)
+        self.connection.start(lambda: self.scheduler.loop.add_callback(self.connected))
+        self.flush_policy = FlushPolicy(flush_events, flush_interval, flush_on_idle)
+        self.spool = Spool(spool_dir, spool_name("scheduler"), spool_segment_size) if spool_dir else None
+        self.spool_threshold = spool_threshold
+        self.replaying = False
+        # encoded events pushed since the last flush, spooled again if the flush fails
+        self.unflushed = []
+        # self-instrumentation, exported on the scheduler /metrics endpoint
+        self.metrics = PluginMetrics("scheduler", scheduler.id)
+        self.metrics.gauge("queue_depth", "Events pushed and not flushed yet",
+                           lambda: self.flush_policy.pending)
+        if self.spool is not None:
+            self.metrics.gauge("spooled_events", "Events waiting in the local spool",
+                               lambda: len(self.spool))
+        self.scheduler.handlers["mofka_flush"] = self.mofka_flush
+        self.sampling = SamplingPolicy.from_config(sampling_rules)
+        self.sampling_report_interval = sampling_report_interval
+        self.scheduler.handlers["mofka_set_sampling"] = self.set_sampling
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode {mode!r}, expected one of {MODES}")
+        self.raw = mode in ("raw", "both")
+        self.aggregator = WindowAggregator() if mode in ("aggregate", "both") else None
+        self.window = window
+        self.latency = LatencyTracker()
+        # event loop lag, in seconds, 0 disables the monitor
+        self.monitor = LoopMonitor(stall_threshold / 1e3) if stall_threshold > 0 else None
+        self.stall_report_interval = stall_report_interval
+        if self.monitor is not None:
+            self.metrics.gauge("event_loop_lag_seconds", "Lag of the last event loop monitor tick",
+                               lambda: self.monitor.last_lag)
+        self.metrics.register()
+
+    def push(self, action, record):
+        """Push one binary encoded event without waiting for it"""
+        if self.producer is None:
+            self.keep(action, record)
+            return
+        if self.deferred is not None:
+            # an event is pushed in the background, keep the order
+            self.deferred.append((action, record))
+            return
+        if self.spooling():
+            self.spool.append(action, record)
+            return
+        if action in self.BACKGROUND_ACTIONS:
+            self.deferred = collections.deque()
+            future = self.executor.submit(self.send, action, record)
+            future.add_done_callback(lambda f: self.scheduler.loop.add_callback(self.sent, f))
+            return
+        t0 = time.perf_counter()
+        n = self.send(action, record)
+        if self.monitor is not None:
+            self.monitor.pushed(action, time.perf_counter() - t0)
+        if n and self.flush_policy.record(n):
+            self.scheduler.loop.add_callback(self.flush, "events")
+
+    def send(self, action, record):
+        """Encode and push one event, returns the number of Mofka events pushed"""
+        events = None
+        pushed = 0
+        try:
+            t0 = time.perf_counter()
+            events = self.encoder(action, [record])
+            t1 = time.perf_counter()
+            for metadata, data in events:
+                self.producer.push(metadata, data, metadata.get("partition"))
+                pushed += 1
+            self.metrics.observe("encode", t1 - t0)
+            self.metrics.observe("push", time.perf_counter() - t1)
+            self.metrics.pushed(len(events), sum(len(data) for _, data in events))
+        except Exception as Argument:
+            logging.exception("Exception while sending %s event", action)
+            if self.spool is not None:
+                if events is not None:
+                    self.unflushed.extend(events[:pushed])
+                spool_failed_push(self.spool, self.encoder, action, [record], events, pushed)
+                return pushed
+            self.metrics.failed += 1
+            return pushed
+        if self.spool is not None:
+            self.unflushed.extend(events)
+        return len(events)
+
+    def sent(self, future):
+        """Run on the event loop once the background push is done, pushes the events deferred meanwhile"""
+        n = future.result()
+        if n and self.flush_policy.record(n):
+            self.scheduler.loop.add_callback(self.flush, "events")
+        deferred, self.deferred = self.deferred, None
+        while deferred:
+            self.push(*deferred.popleft())
+            if self.deferred is not None:
+                # another event went to the background, the others wait for it
+                self.deferred.extend(deferred)
+                break
+
+    def spooling(self):
+        """True if the events go to the spool: it is not replayed yet, or Mofka is behind"""
+        if self.spool is None:
+            return False
+        return self.spool.active or (self.flush_policy.flushing and
+                                     self.flush_policy.pending >= self.spool_threshold)
+
+    async def replay_spool(self):
+        """Periodic callback pushing the spooled events again"""
+        if self.replaying or self.producer is None or self.deferred is not None or not self.spool.due():
+            return
+        self.replaying = True
+        try:
+            await replay_step(self.spool, self.encoder, self.producer, self.scheduler.loop)
+        finally:
+            self.replaying = False
+
+    def keep(self, action, record):
+        """Keep an event until the plugin is connected to Mofka"""
+        if self.spool is not None and self.connection.ready.is_set() and self.connection.producer is None:
+            # the connection failed, the spool keeps the events for python -m mofkadask.spool
+            self.spool.append(action, record)
+            return
+        if len(self.pending) >= self.pending_size:
+            self.pending.popleft()
+            self.pending_dropped += 1
+        self.pending.append((action, record))
+
+    def connected(self):
+        """Run on the event loop once the connection finished, pushes the events kept meanwhile"""
+        if self.producer is not None:
+            return
+        if self.connection.producer is None:
+            if self.spool is not None:
+                for action, record in self.pending:
+                    self.spool.append(action, record)
+                logging.error("Mofka is not reachable, %d events are spooled, %d are lost",
+                              len(self.pending), self.pending_dropped)
+                self.pending.clear()
+                return
+            logging.error("Mofka is not reachable, %d events are lost", len(self.pending) + self.pending_dropped)
+            return
+        self.encoder = self.connection.encoder
+        self.producer = self.connection.producer
+        pending, self.pending = self.pending, collections.deque()
+        for action, record in pending:
+            self.push(action, record)
+        logging.info("Mofka connected, pushed %d events kept meanwhile (%d dropped)",
+                     len(pending), self.pending_dropped)
+
+    def is_idle(self):
+        return not any(ws.processing for ws in self.scheduler.workers.values())
+
+    def check_flush(self):
+        """Periodic callback starting the time and idle triggered flushes"""
+        reason = self.flush_policy.due(self.is_idle)
+        if reason:
+            self.scheduler.loop.add_callback(self.flush, reason)
+
+    async def flush(self, reason):
+        """
+        Flush the producer in a thread, so the event loop keeps running.
+
+        Returns
+        -------
+            The flush latency in seconds, None if a flush was already running
+            or if the plugin is not connected to Mofka yet.
+        """
+        if self.flush_policy.flushing or self.producer is None:
+            return None
+        n = self.flush_policy.start()
+        unflushed, self.unflushed = self.unflushed, []
+        t0 = time.time()
+        try:
+            await self.scheduler.loop.run_in_executor(None, self.producer.flush)
+        except Exception as Argument:
+            logging.exception("Exception while flushing the Mofka producer")
+            if self.spool is not None:
+                spool_unflushed(self.spool, self.encoder, unflushed)
+        finally:
+            self.flush_policy.done()
+        latency = time.time() - t0
+        self.metrics.observe("flush", latency)
+        logging.info("Mofka producer flushed %d events in %.3fs (%s)", n, latency, reason)
+        return latency
+
+    async def mofka_flush(self):
+        """
+        Scheduler RPC handler flushing the producers of the scheduler and of the
+        workers running MofkaWorkerPlugin, for instance from a client before it
+        shuts the cluster down::
+
+            client.sync(client.scheduler.mofka_flush)
+
+        Returns
+        -------
+            The flush latency in seconds of the scheduler and of every worker.
+        """
+        while self.flush_policy.flushing or self.deferred is not None:
+            await asyncio.sleep(0.01)
+        latency = await self.flush("rpc")
+        workers = await self.scheduler.broadcast(msg={"op": "mofka_flush"}, on_error="ignore")
+        return {"scheduler": latency, "workers": workers}
 
     async def start(self, scheduler):
         """Run when the scheduler starts up
 
         This runs at the end of the Scheduler startup process
         """
-        try:
-            f = self.producer.push({"action": "restart", "time" : str(time.time())})
-        except Exception as Argument:
-            logging.exception("Exception while calling restart method when sending")
+        self.push("restart", {"time" : time.time()})
+        pc = PeriodicCallback(self.check_flush, 100)
+        self.scheduler.periodic_callbacks["mofka-flush"] = pc
+        pc.start()
+        pc = PeriodicCallback(self.report_sampling, self.sampling_report_interval * 1000)
+        self.scheduler.periodic_callbacks["mofka-sampling-report"] = pc
+        pc.start()
+        if self.aggregator is not None:
+            pc = PeriodicCallback(self.flush_window, self.window * 1000)
+            self.scheduler.periodic_callbacks["mofka-window-flush"] = pc
+            pc.start()
+        if self.spool is not None:
+            pc = PeriodicCallback(self.replay_spool, 100)
+            self.scheduler.periodic_callbacks["mofka-spool-replay"] = pc
+            pc.start()
+        if self.monitor is not None:
+            pc = PeriodicCallback(self.monitor.tick, self.monitor.interval * 1000)
+            self.scheduler.periodic_callbacks["mofka-loop-monitor"] = pc
+            pc.start()
+            pc = PeriodicCallback(self.report_stalls, self.stall_report_interval * 1000)
+            self.scheduler.periodic_callbacks["mofka-stall-report"] = pc
+            pc.start()
+
+    def report_sampling(self):
+        """Push the number of transitions suppressed by sampling since the last report"""
+        for record in self.sampling.report("scheduler"):
+            self.push("sampling_stats", record)
+
+    def flush_window(self):
+        """Push the transition summaries of the current window"""
+        if self.aggregator is None:
+            return
+        for record in self.aggregator.flush():
+            self.push("transition_summary", record)
+
+    async def set_sampling(self, rules=None):
+        """
+        Scheduler RPC handler replacing the sampling rules of the scheduler and of
+        the workers running MofkaWorkerPlugin, for instance from a client::
+
+            client.sync(client.scheduler.mofka_set_sampling, rules=[{"finish": "erred"}, ...])
+
+        An empty list of rules keeps every transition.
+        """
+        rules = rules or []
+        self.report_sampling()
+        self.sampling.set_rules(rules)
+        logging.info("Mofka sampling rules set to %s", rules)
+        workers = await self.scheduler.broadcast(msg={"op": "mofka_set_sampling", "rules": rules},
+                                                 on_error="ignore")
+        return {"scheduler": self.sampling.to_dict(), "workers": workers}
+
+    def report_stalls(self):
+        """Push the event loop stalls since the last report and the actions they are attributed to"""
+        if self.monitor is None:
+            return
+        for record in self.monitor.report("scheduler"):
+            self.push("stall_report", record)
 
     async def before_close(self):
         """Runs prior to any Scheduler shutdown logic"""
-        before_close = str({"time" : time.time()}).encode("utf-8")
-        try:
-            f = self.producer.push({"action": "before_close", "time" : str(time.time())})
-            f.wait()
-            
-            
-        except Exception as Argument:
-            logging.exception("Exception while calling before_close method when sending")
+        self.report_sampling()
+        self.flush_window()
+        self.report_stalls()
+        self.push("before_close", {"time" : time.time()})
 
     async def close(self):
         """Run when the scheduler closes down
@@ -76,9 +373,28 @@ class MofkaSchedulerPlugin(SchedulerPlugin):
         workers have been asked to shut down gracefully. Given, we are closing 
         the worker, this push is allowed to be blocking.
         """
-        close = str({"time" : time.time()}).encode("utf-8")
-        f = self.producer.push({"action": "close"}, close)
-        f.wait()
+        self.push("close", {"time" : time.time()})
+        if self.producer is None:
+            # give a connection in progress a chance to deliver the kept events
+            await self.scheduler.loop.run_in_executor(None, self.connection.wait, 10.0)
+            self.connected()
+        while self.deferred is not None:
+            await asyncio.sleep(0.01)
+        self.executor.shutdown()
+        if self.producer is not None:
+            unflushed, self.unflushed = self.unflushed, []
+            try:
+                self.producer.flush()
+            except Exception as Argument:
+                logging.exception("Exception while flushing the Mofka producer")
+                if self.spool is not None:
+                    spool_unflushed(self.spool, self.encoder, unflushed)
+        if self.spool is not None:
+            while self.replaying:
+                await asyncio.sleep(0.01)
+            replay_all(self.spool, self.encoder, self.producer)
+        self.metrics.unregister()
+        logging.info("Mofka scheduler plugin metrics: %s", self.metrics.summary())
 
     def update_graph(
         self,
@@ -121,22 +437,16 @@ class MofkaSchedulerPlugin(SchedulerPlugin):
                 It is recommended to allow plugins to accept more parameters to
                 ensure future compatibility.
         """
-        try:
-            f = self.producer.push({"action": "update_graph", "client": str(client),
-                            "keys": str(keys),
-                            "dependencies": str(dependencies),
-                            "time": str(time.time())}
-                            )
-        except Exception as Argument:
-            logging.exception("Exception while calling update_graph method when sending")
+        self.push("update_graph", {"client": client,
+                                   "keys": keys,
+                                   "dependencies": dependencies,
+                                   "time": time.time()})
 
     def restart(self, scheduler):
         """Run when the scheduler restarts itself"""
-        try:
-            f = self.producer.push({"action": "restrat", "time": str(time.time())})
-        except Exception as Argument:
-            logging.exception("Exception while calling restart method when sending")
+        self.push("restart", {"time": time.time()})
 
+    @timed("transition")
     def transition(
         self,
         key,
@@ -149,14 +459,6 @@ class MofkaSchedulerPlugin(SchedulerPlugin):
         For a description of the transition mechanism and the available states,
         see :ref:`Scheduler task states <scheduler-task-state>`.
 
-        To force the buffer to flush, submit a task with the key "flush-mofka-buffer" as shown below:
-        -----
-        def no_op():
-            return None
-            
-        client.submit(no_op, key="flush-mofka-buffer")
-        ----
-
         .. warning::
 
             This is an advanced feature and the transition mechanism and details
@@ -197,37 +499,49 @@ class MofkaSchedulerPlugin(SchedulerPlugin):
 
         if kwargs.get("worker"):
             worker = kwargs["worker"]
-        
-            
 
-        
-        try:
-            f = self.producer.push( {
-                "action": "scheduler_transition",
-                "key"            : str(key),
-                "thread"         : thread,
-                "worker"         : worker,
-                "prefix"         : self.scheduler.tasks[key].prefix.name,
-                "group"          : self.scheduler.tasks[key].group.name,
-                "start"          : start,
-                "finish"         : finish,
-                "stimulus_id"    : stimulus_id,
-                "called_from"    : self.scheduler.address,
-                "begins"         : begins,
-                "ends"           : ends,
-                "duration"       : duration,
-                "size"           : size,
-                "time"           : str(time.time())}
-                
-                )
-        except Exception as Argument:
-            logging.exception("Exception while calling transition method when sending")
-
-        # on custom key, force buffer to flush
-        if "flush-mofka-buffer" == str(key):            
-            logging.info("Mofka producer started flush")
-            self.producer.flush()
-            logging.info("Mofka producer completed flush")
+        now = time.time()
+        queue_latency = dispatch_latency = exec_latency = None
+        if start == "processing" and finish in ("memory", "erred"):
+            begin = end = None
+            for ss in kwargs.get("startstops") or ():
+                if ss["action"] == "compute":
+                    # worker clock to scheduler clock
+                    ws = self.scheduler.workers.get(worker)
+                    delay = ws.time_delay if ws is not None else 0
+                    begin = ss["start"] + delay
+                    end = ss["stop"] + delay
+            queue_latency, dispatch_latency, exec_latency = self.latency.finished(key, begin, end)
+        else:
+            self.latency.transition(key, start, finish, now)
+
+        ts = self.scheduler.tasks[key]
+        if self.aggregator is not None:
+            self.aggregator.add(ts.prefix.name, worker, start, finish, duration, size)
+            if not self.raw:
+                return
+
+        if not self.sampling.keep(ts.prefix.name, start, finish, worker):
+            return
+
+        self.push("scheduler_transition",
+                  {"key"            : str(key),
+                   "thread"         : thread,
+                   "worker"         : worker,
+                   "prefix"         : ts.prefix.name,
+                   "group"          : ts.group.name,
+                   "start"          : start,
+                   "finish"         : finish,
+                   "stimulus_id"    : stimulus_id,
+                   "called_from"    : self.scheduler.address,
+                   "begins"         : begins,
+                   "ends"           : ends,
+                   "duration"       : duration,
+                   "size"           : size,
+                   "time"           : now,
+                   "queue_latency"  : queue_latency,
+                   "dispatch_latency" : dispatch_latency,
+                   "exec_latency"   : exec_latency})
 
 
     def add_worker(self, scheduler, worker: str):
@@ -244,10 +558,7 @@ class MofkaSchedulerPlugin(SchedulerPlugin):
             ``SchedulerPlugin.add_worker`` hooks and the ordering may be subject
             to change without deprecation cycle.
         """
-        try:
-            f = self.producer.push({"action": "add_worker",  "time": str(time.time())})
-        except Exception as Argument:
-            logging.exception("Exception while calling add_worker method when sending")
+        self.push("add_worker", {"worker" : worker, "time": time.time()})
 
     def remove_worker(
         self, scheduler, worker: str, stimulus_id: str, **kwargs):
@@ -264,39 +575,22 @@ class MofkaSchedulerPlugin(SchedulerPlugin):
             ``SchedulerPlugin.remove_worker`` hooks and the ordering may be subject
             to change without deprecation cycle.
         """
-        try:
-            f = self.producer.push({"action": "remove_worker", "worker" : worker, "stimulus_id" : stimulus_id,
-                         "time" : str(time.time())})
-
-        except Exception as Argument:
-            logging.exception("Exception while calling remove_worker method when sending")
+        self.push("remove_worker", {"worker" : worker, "stimulus_id" : stimulus_id,
+                                    "time" : time.time()})
 
     def add_client(self, scheduler, client: str):
         """Run when a new client connects"""
-        try:
-            f = self.producer.push({"action": "add_client", "client" : client,
-                          "time" : str(time.time())})
-        except Exception as Argument:
-            logging.exception("Exception while calling add_client method when sending")
+        self.push("add_client", {"client" : client, "time" : time.time()})
 
     def remove_client(self, scheduler, client: str):
         """Run when a client disconnects"""
-        try:
-            f = self.producer.push({"action": "remove_client", "client" : client, "time" : str(time.time())})
-        except Exception as Argument:
-            logging.exception("Exception while calling remove client method when sending")
+        self.push("remove_client", {"client" : client, "time" : time.time()})
 
     def log_event(self, topic: str, msg: Any):
         """Run when an event is logged"""
-        try:
-            f = self.producer.push({"action": "log_event", "topic" : str(topic), "message": str(msg), "time": str(time.time())})
-
-        except Exception as Argument:
-            logging.exception("Exception while calling log_event method when sending")
+        self.push("log_event", {"topic" : topic, "message": msg, "time": time.time()})
 
     # TODO It maybe interesting to add to SchedulerPlugin inetface support for other methods.
-    # def send_task_to_worker(self, worker: str, ts: TaskState, duration: float = -1):
-    # def handle_task_finished(self, ...):
     # def other_handlers(...)
 
 
@@ -309,7 +603,79 @@ class MofkaSchedulerPlugin(SchedulerPlugin):
                type=str,
                default="mofka.json",
                help="Mofka group file path")
-
-def dask_setup(scheduler, mofka_protocol, group_file):
-    plugin = MofkaSchedulerPlugin(scheduler, mofka_protocol, group_file)
+@click.option('--flush-events',
+               type=int,
+               default=1000,
+               help="Flush the producer after this many events, 0 to disable")
+@click.option('--flush-interval',
+               type=float,
+               default=1.0,
+               help="Flush the producer when events are older than this many seconds, 0 to disable")
+@click.option('--flush-on-idle/--no-flush-on-idle',
+               default=True,
+               help="Flush the producer as soon as no task is processing")
+@click.option('--pending-size',
+               type=int,
+               default=65536,
+               help="Maximum number of events kept until the plugin is connected to Mofka, the oldest are dropped beyond")
+@click.option('--partitions',
+               type=int,
+               default=1,
+               help="Number of partitions of the Dask topic, when this component creates it")
+@click.option('--partition-by',
+               type=click.Choice(STRATEGIES),
+               default="worker",
+               help="Route events to the topic partitions by worker, task key or action")
+@click.option('--topic-layout',
+               type=click.Choice(LAYOUTS),
+               default="single",
+               help="Push all the events to the Dask topic (single) or every event class to its own topic (per-class)")
+@click.option('--stall-threshold',
+               type=float,
+               default=50.0,
+               help="Event loop lag in milliseconds from which the loop is considered stalled, 0 to disable the monitor")
+@click.option('--stall-report-interval',
+               type=float,
+               default=5.0,
+               help="Seconds between two event loop stall reports")
+@click.option('--spool-dir',
+               type=str,
+               default=None,
+               help="Directory where events are spooled while Mofka is slow or unavailable, no spool by default")
+@click.option('--spool-threshold',
+               type=int,
+               default=100000,
+               help="Number of events pushed during a flush from which events are spooled")
+@click.option('--spool-segment-size',
+               type=int,
+               default=64 << 20,
+               help="Size in bytes of the spool segment files")
+@click.option('--sampling-rules',
+               type=str,
+               default=None,
+               help="JSON list of transition sampling rules, or path to a JSON file holding them")
+@click.option('--sampling-report-interval',
+               type=float,
+               default=5.0,
+               help="Seconds between two reports of the number of transitions suppressed by sampling")
+@click.option('--mode',
+               type=click.Choice(MODES),
+               default="raw",
+               help="Push every transition (raw), per-window summaries (aggregate) or both")
+@click.option('--window',
+               type=float,
+               default=1.0,
+               help="Length in seconds of the aggregation windows")
+
+def dask_setup(scheduler, mofka_protocol, group_file, flush_events, flush_interval, flush_on_idle,
+               partitions, partition_by, topic_layout,
+               stall_threshold, stall_report_interval, pending_size,
+               spool_dir, spool_threshold, spool_segment_size,
+               sampling_rules, sampling_report_interval, mode, window):
+    plugin = MofkaSchedulerPlugin(scheduler, mofka_protocol, group_file,
+                                  flush_events, flush_interval, flush_on_idle,
+                                  partitions, partition_by, topic_layout,
+                                  stall_threshold, stall_report_interval, pending_size,
+                                  spool_dir, spool_threshold, spool_segment_size,
+                                  sampling_rules, sampling_report_interval, mode, window)
     scheduler.add_plugin(plugin)
@@ -2,52 +2,255 @@ import os
 import sys
 import json
 import time
+import asyncio
 import click
 import logging
+import collections
 
-from pymargo.core import Engine
-import mochi.mofka.client as mofka
 from typing import Any
 import traceback
+from dask.utils import key_split
+from tornado.ioloop import PeriodicCallback
 from distributed.diagnostics.plugin import WorkerPlugin
 
+# make the mofkadask helpers importable when the plugin is preloaded from nonBlockingPlugins/
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mofkadask.flush import FlushPolicy
+from mofkadask.sampling import SamplingPolicy
+from mofkadask.partitioning import STRATEGIES
+from mofkadask.metrics import PluginMetrics, timed
+from mofkadask.tail import LogTail
+from mofkadask.telemetry import WorkerTelemetry
+from mofkadask.memory import MemoryThresholds, SpillRecorder
+from mofkadask.topics import LAYOUTS
+from mofkadask.connection import MofkaConnection
+from mofkadask.spool import Spool, replay_all, replay_step, spool_failed_push, spool_name, spool_unflushed
+
 class MofkaWorkerPlugin(WorkerPlugin):
     """
     MofkaWorkerPlugin is a plugin that couples Dask distributed to Mofka through the worker.
     This plugin pushes information about the progress and state transition of Dask tasks in
     the worker.
+
+    Pushes are not waited on. The producer is flushed according to a FlushPolicy
+    (after a number of events, after some time, or when the worker is idle), and
+    on demand with the ``mofka_flush`` worker RPC.
+
+    The plugin connects to Mofka in the background (see MofkaConnection), the
+    events pushed meanwhile are kept in memory, up to ``pending_size`` pushes.
+
+    Transfers are not looked for on every transition: a periodic callback tails
+    the worker transfer logs every ``transfer_interval`` seconds.
+
+    Every ``telemetry_interval`` seconds, the worker CPU, memory, spilled bytes,
+    task queues and transfer counters are sampled, and pushed by batches of
+    ``telemetry_batch`` samples as ``worker_telemetry`` events.
+
+    With ``memory_events``, every spill and unspill of the worker is pushed as a
+    ``worker_spill`` event, and every change of its memory level (target, spill and
+    pause thresholds of the memory manager) as a ``memory_threshold`` event.
+
+    With ``spool_dir``, the events are written to a local Spool when their push
+    fails or when Mofka falls behind, and pushed again once it keeps up (see
+    MofkaSchedulerPlugin).
+
+    Task transitions go through a SamplingPolicy first, whose rules are replaced
+    by the scheduler ``mofka_set_sampling`` RPC.
     """
-    def __init__(self, worker, mofka_protocol, group_file):
+    def __init__(self, worker, mofka_protocol, group_file,
+                 flush_events=1000, flush_interval=1.0, flush_on_idle=True,
+                 partitions=1, partition_by="worker", topic_layout="single", transfer_interval=1.0,
+                 telemetry_interval=0.25, telemetry_batch=20, memory_events=True, memory_check_interval=0.1,
+                 pending_size=65536, spool_dir=None, spool_threshold=100000, spool_segment_size=64 << 20,
+                 sampling_rules=None, sampling_report_interval=5.0):
         logging.basicConfig(filename="MofkaWorkerPlugin.log",
                             format='%(asctime)s %(message)s',
                             datefmt='%m/%d/%Y %I:%M:%S %p',
                             filemode='w')
         logger = logging.getLogger()
         logger.setLevel(logging.INFO)
-        # create mofka client
         self.worker = worker
-        self.commin = 0
-        self.commout = 0
-        self.engine = Engine(mofka_protocol, use_progress_thread=True)
-        self.driver = mofka.MofkaDriver(group_file, self.engine)
+        # connect to mofka in the background, the events pushed until then are kept in pending
+        self.producer = None
+        self.encoder = None
+        self.pending = collections.deque()
+        self.pending_size = pending_size
+        self.pending_dropped = 0
+        self.connection = MofkaConnection(mofka_protocol, group_file, "Dask_worker_producer",
+                                          topic_layout=topic_layout, partitions=partitions,
+                                          partition_by=partition_by)
+        self.connection.start(lambda: self.worker.loop.add_callback(self.connected))
+        self.flush_policy = FlushPolicy(flush_events, flush_interval, flush_on_idle)
+        self.spool = Spool(spool_dir, spool_name("worker"), spool_segment_size) if spool_dir else None
+        self.spool_threshold = spool_threshold
+        self.replaying = False
+        # encoded events pushed since the last flush, spooled again if the flush fails
+        self.unflushed = []
+        self.sampling = SamplingPolicy.from_config(sampling_rules)
+        self.sampling_report_interval = sampling_report_interval
+        self.transfer_interval = transfer_interval
+        self.telemetry_interval = telemetry_interval
+        self.telemetry_batch = telemetry_batch
+        self.telemetry = None
+        self.memory_events = memory_events
+        self.memory_check_interval = memory_check_interval
+        self.spills = None
+        self.thresholds = None
+        # self-instrumentation, exported on the worker /metrics endpoint
+        self.metrics = PluginMetrics("worker", worker.id)
+        self.metrics.gauge("queue_depth", "Events pushed and not flushed yet",
+                           lambda: self.flush_policy.pending)
+        if self.spool is not None:
+            self.metrics.gauge("spooled_events", "Events waiting in the local spool",
+                               lambda: len(self.spool))
 
-        # create a topic
-        topic_name = "Dask"
-        if not self.driver.topic_exists(topic_name):
-            logging.info("Mofka topic %s is created by MofkaPlugin", topic_name)
-            self.driver.create_topic(topic_name)
-            self.driver.add_memory_partition(topic_name, 0)
 
-        self.topic = self.driver.open_topic(topic_name)
+    def push(self, action, record):
+        """Push one binary encoded event without waiting for it"""
+        self.push_batch(action, [record])
 
-        # create a producer
-        producer_name = "Dask_worker_producer"
-        batchsize = mofka.AdaptiveBatchSize
-        thread_pool = mofka.ThreadPool(1)
-        ordering = mofka.Ordering.Strict
-        self.producer = self.topic.producer(producer_name, batchsize, thread_pool, ordering)
-        logging.info("Mofka producer %s is created", producer_name)
+    def push_batch(self, action, records):
+        """Push records of the same action in one binary frame without waiting for it"""
+        if self.producer is None:
+            self.keep(action, records)
+            return
+        if self.spooling():
+            for record in records:
+                self.spool.append(action, record)
+            return
+        events = None
+        pushed = 0
+        try:
+            t0 = time.perf_counter()
+            events = self.encoder(action, records)
+            t1 = time.perf_counter()
+            for metadata, data in events:
+                self.producer.push(metadata, data, metadata.get("partition"))
+                pushed += 1
+            self.metrics.observe("encode", t1 - t0)
+            self.metrics.observe("push", time.perf_counter() - t1)
+            self.metrics.pushed(len(events), sum(len(data) for _, data in events))
+        except Exception as Argument:
+            logging.exception("Exception while sending %d %s events", len(records), action)
+            traceback.print_exc()
+            if self.spool is not None:
+                if events is not None:
+                    self.unflushed.extend(events[:pushed])
+                spool_failed_push(self.spool, self.encoder, action, records, events, pushed)
+                return
+            self.metrics.failed += len(records)
+            return
+        if self.spool is not None:
+            self.unflushed.extend(events)
+        if self.flush_policy.record(len(events)):
+            self.worker.loop.add_callback(self.flush, "events")
 
+    def spooling(self):
+        """True if the events go to the spool: it is not replayed yet, or Mofka is behind"""
+        if self.spool is None:
+            return False
+        return self.spool.active or (self.flush_policy.flushing and
+                                     self.flush_policy.pending >= self.spool_threshold)
+
+    async def replay_spool(self):
+        """Periodic callback pushing the spooled events again"""
+        if self.replaying or self.producer is None or not self.spool.due():
+            return
+        self.replaying = True
+        try:
+            await replay_step(self.spool, self.encoder, self.producer, self.worker.loop)
+        finally:
+            self.replaying = False
+
+    def keep(self, action, records):
+        """Keep events until the plugin is connected to Mofka"""
+        if self.spool is not None and self.connection.ready.is_set() and self.connection.producer is None:
+            # the connection failed, the spool keeps the events for python -m mofkadask.spool
+            for record in records:
+                self.spool.append(action, record)
+            return
+        if len(self.pending) >= self.pending_size:
+            self.pending.popleft()
+            self.pending_dropped += 1
+        self.pending.append((action, records))
+
+    def connected(self):
+        """Run on the event loop once the connection finished, pushes the events kept meanwhile"""
+        if self.producer is not None:
+            return
+        if self.connection.producer is None:
+            if self.spool is not None:
+                for action, records in self.pending:
+                    for record in records:
+                        self.spool.append(action, record)
+                logging.error("Mofka is not reachable, %d event batches are spooled, %d are lost",
+                              len(self.pending), self.pending_dropped)
+                self.pending.clear()
+                return
+            logging.error("Mofka is not reachable, %d events are lost", len(self.pending) + self.pending_dropped)
+            return
+        self.encoder = self.connection.encoder
+        self.producer = self.connection.producer
+        pending, self.pending = self.pending, collections.deque()
+        for action, records in pending:
+            self.push_batch(action, records)
+        logging.info("Mofka connected, pushed %d event batches kept meanwhile (%d dropped)",
+                     len(pending), self.pending_dropped)
+
+    def is_idle(self):
+        state = self.worker.state
+        return state.executing_count == 0 and not state.ready
+
+    def check_flush(self):
+        """Periodic callback starting the time and idle triggered flushes"""
+        reason = self.flush_policy.due(self.is_idle)
+        if reason:
+            self.worker.loop.add_callback(self.flush, reason)
+
+    async def flush(self, reason):
+        """
+        Flush the producer in a thread, so the event loop keeps running.
+
+        Returns
+        -------
+            The flush latency in seconds, None if a flush was already running
+            or if the plugin is not connected to Mofka yet.
+        """
+        if self.flush_policy.flushing or self.producer is None:
+            return None
+        n = self.flush_policy.start()
+        unflushed, self.unflushed = self.unflushed, []
+        t0 = time.time()
+        try:
+            await self.worker.loop.run_in_executor(None, self.producer.flush)
+        except Exception as Argument:
+            logging.exception("Exception while flushing the Mofka producer")
+            if self.spool is not None:
+                spool_unflushed(self.spool, self.encoder, unflushed)
+        finally:
+            self.flush_policy.done()
+        latency = time.time() - t0
+        self.metrics.observe("flush", latency)
+        logging.info("Mofka worker %s flushed %d events in %.3fs (%s)", self.worker.name, n, latency, reason)
+        return latency
+
+    def report_sampling(self):
+        """Push the number of transitions suppressed by sampling since the last report"""
+        for record in self.sampling.report(self.worker.name):
+            self.push("sampling_stats", record)
+
+    def set_sampling(self, rules=None):
+        """Worker RPC handler replacing the sampling rules, called by the scheduler plugin"""
+        self.report_sampling()
+        self.sampling.set_rules(rules or [])
+        logging.info("Mofka sampling rules set to %s", rules)
+        return self.sampling.to_dict()
+
+    async def mofka_flush(self):
+        """Worker RPC handler flushing the producer, returns the flush latency in seconds"""
+        while self.flush_policy.flushing:
+            await asyncio.sleep(0.01)
+        return await self.flush("rpc")
 
     def setup(self, worker):
         """
@@ -57,14 +260,93 @@ class MofkaWorkerPlugin(WorkerPlugin):
         """
         # XXX
         self.worker = worker
+        self.worker.handlers["mofka_flush"] = self.mofka_flush
+        self.worker.handlers["mofka_set_sampling"] = self.set_sampling
+        self.metrics.instance = str(worker.name)
+        self.metrics.register()
+        pc = PeriodicCallback(self.check_flush, 100)
+        self.worker.periodic_callbacks["mofka-flush"] = pc
+        pc.start()
+        pc = PeriodicCallback(self.report_sampling, self.sampling_report_interval * 1000)
+        self.worker.periodic_callbacks["mofka-sampling-report"] = pc
+        pc.start()
+        if self.spool is not None:
+            pc = PeriodicCallback(self.replay_spool, 100)
+            self.worker.periodic_callbacks["mofka-spool-replay"] = pc
+            pc.start()
+        self.incoming = LogTail(worker.transfer_incoming_log, "transfer_incoming_log")
+        self.outgoing = LogTail(worker.transfer_outgoing_log, "transfer_outgoing_log")
+        pc = PeriodicCallback(self.tail_transfers, self.transfer_interval * 1000)
+        self.worker.periodic_callbacks["mofka-transfer-tail"] = pc
+        pc.start()
+        if self.telemetry_interval > 0:
+            self.telemetry = WorkerTelemetry(worker, self.telemetry_batch)
+            pc = PeriodicCallback(self.sample_telemetry, self.telemetry_interval * 1000)
+            self.worker.periodic_callbacks["mofka-telemetry"] = pc
+            pc.start()
+        if self.memory_events:
+            self.spills = SpillRecorder(worker, self.push_spill)
+            self.spills.install()
+            self.thresholds = MemoryThresholds(worker)
+            pc = PeriodicCallback(self.check_memory, self.memory_check_interval * 1000)
+            self.worker.periodic_callbacks["mofka-memory"] = pc
+            pc.start()
+
+    def sample_telemetry(self):
+        """Sample the worker resources, and push the samples once a batch is complete"""
+        samples = self.telemetry.sample()
+        if samples:
+            self.push_batch("worker_telemetry", samples)
+
+    def push_spill(self, record):
+        """SpillRecorder callback"""
+        self.push("worker_spill", record)
+
+    def check_memory(self):
+        """Push a memory_threshold event when the memory level of the worker changed"""
+        record = self.thresholds.check()
+        if record is not None:
+            self.push("memory_threshold", record)
+
+    def tail_transfers(self):
+        """Push the transfers logged by the worker since the previous call"""
+        now = time.time()
+        for tail, kind in ((self.incoming, "incoming_transfer"), (self.outgoing, "outgoing_transfer")):
+            for entry in tail.new_entries():
+                # the log entries belong to the worker, push copies
+                self.push("worker_transfer",
+                          dict(entry, type=kind, called_from=self.worker.name, time=now, keys=str(entry["keys"])))
 
     def teardown(self, worker):
         """Run when the worker to which the plugin is attached is closed, or
         when the plugin is removed."""
-        try:
-            f = self.producer.push({"action": "remove_worker", "time" : str(time.time())})
-        except Exception as Argument:
-            logging.exception("Exception while calling remove_worker method when sending")
+        self.tail_transfers()
+        if self.spills is not None:
+            self.spills.uninstall()
+        if self.telemetry is not None and self.telemetry.samples:
+            self.push_batch("worker_telemetry", self.telemetry.take())
+        self.report_sampling()
+        self.push("remove_worker", {"worker" : self.worker.address, "time" : time.time()})
+        if self.producer is None:
+            # give a connection in progress a chance to deliver the kept events
+            self.connection.wait(10.0)
+            self.connected()
+        if self.producer is not None:
+            unflushed, self.unflushed = self.unflushed, []
+            try:
+                self.producer.flush()
+            except Exception as Argument:
+                logging.exception("Exception while flushing the Mofka producer")
+                if self.spool is not None:
+                    spool_unflushed(self.spool, self.encoder, unflushed)
+        if self.spool is not None:
+            if self.replaying:
+                # a replay is waiting for its flush, the events left are replayed by python -m mofkadask.spool
+                self.spool.close()
+            else:
+                replay_all(self.spool, self.encoder, self.producer)
+        self.metrics.unregister()
+        logging.info("Mofka worker %s plugin metrics: %s", self.worker.name, self.metrics.summary())
 
         # del self.producer
         # del self.topic
@@ -72,6 +354,7 @@ class MofkaWorkerPlugin(WorkerPlugin):
         # del self.client
         # del self.engine
 
+    @timed("transition")
     def transition(
         self,
         key,
@@ -87,15 +370,6 @@ class MofkaWorkerPlugin(WorkerPlugin):
 
         Whenever a task changes its state, this method will be called.
 
-        To force the buffer to flush, submit a task with the key "flush-mofka-buffer" as shown below:
-        -----
-        def no_op():
-            return None
-            
-        client.submit(no_op, key="flush-mofka-buffer")
-        ----
-
-        
         .. warning::
 
             This is an advanced feature and the transition mechanism and details
@@ -112,54 +386,14 @@ class MofkaWorkerPlugin(WorkerPlugin):
         kwargs :
             More options passed when transitioning
         """
-        try:
-            f = self.producer.push({"action": "worker_transition", 
-                            "key"            : str(key),
-                            "start"          : str(start),
-                            "finish"         : str(finish),
-                            "called_from"    : str(self.worker.name),
-                            "time"           : str(time.time())})
-           
-        except Exception as Argument:
-            logging.exception("Exception while calling transition method when sending")
-            traceback.print_exc()
-
-        l = self.commin
-        l2 = len(self.worker.transfer_incoming_log)
-        if l2 > l:
-            data = list(self.worker.transfer_incoming_log)[l-1:]
-            _ = [e.update({"type": "incoming_transfer", "called_from": self.worker.name, "time": time.time(), "keys": str(e["keys"])}) for e in data]
-            self.commin = len(self.worker.transfer_incoming_log)
-            for d in data:
-                try:
-                    dd = str(d).encode("utf-8")
-                    combo = {"action": "worker_transfer"} | d
-                    f = self.producer.push(combo)
-                except Exception as Argument:
-                    logging.exception("Exception while calling transition method when sending", combo)
-                    traceback.print_exc()
-
-
-        l = self.commout
-        l2 = len(self.worker.transfer_outgoing_log)
-        if l2 > l:
-            data = list(self.worker.transfer_outgoing_log)[l-1:]
-            _ = [e.update({"type": "outgoing_transfer", "called_from": self.worker.name, "time": time.time(), "keys" : str(e["keys"])}) for e in data]
-            self.commout = len(self.worker.transfer_outgoing_log)
-            for d in data:
-                try:
-                    dd = str(d).encode("utf-8")
-                    combo = {"action": "worker_transfer"} | d
-                    f = self.producer.push(combo)
-                except Exception as Argument:
-                    logging.exception("Exception while calling transition method when sending", str(combo))
-                    traceback.print_exc()
-        
-        # on custom key, force buffer to flush
-        if "flush-mofka-buffer" == str(key):            
-            logging.info("Mofka worker %s started flush", self.worker.name)
-            self.producer.flush()
-            logging.info("Mofka worker %s completed flush", self.worker.name)
+        if self.sampling.rules and not self.sampling.keep(key_split(key), start, finish, self.worker.address):
+            return
+        self.push("worker_transition",
+                  {"key"            : str(key),
+                   "start"          : start,
+                   "finish"         : finish,
+                   "called_from"    : self.worker.name,
+                   "time"           : time.time()})
 
 
 @click.command()
@@ -171,7 +405,82 @@ class MofkaWorkerPlugin(WorkerPlugin):
                type=str,
                default="mofka.json",
                help="Mofka group file path")
+@click.option('--flush-events',
+               type=int,
+               default=1000,
+               help="Flush the producer after this many events, 0 to disable")
+@click.option('--flush-interval',
+               type=float,
+               default=1.0,
+               help="Flush the producer when events are older than this many seconds, 0 to disable")
+@click.option('--flush-on-idle/--no-flush-on-idle',
+               default=True,
+               help="Flush the producer as soon as no task is executing")
+@click.option('--pending-size',
+               type=int,
+               default=65536,
+               help="Maximum number of events kept until the plugin is connected to Mofka, the oldest are dropped beyond")
+@click.option('--partitions',
+               type=int,
+               default=1,
+               help="Number of partitions of the Dask topic, when this component creates it")
+@click.option('--partition-by',
+               type=click.Choice(STRATEGIES),
+               default="worker",
+               help="Route events to the topic partitions by worker, task key or action")
+@click.option('--topic-layout',
+               type=click.Choice(LAYOUTS),
+               default="single",
+               help="Push all the events to the Dask topic (single) or every event class to its own topic (per-class)")
+@click.option('--transfer-interval',
+               type=float,
+               default=1.0,
+               help="Seconds between two reads of the worker transfer logs")
+@click.option('--telemetry-interval',
+               type=float,
+               default=0.25,
+               help="Seconds between two resource samples of the worker, 0 to disable")
+@click.option('--telemetry-batch',
+               type=int,
+               default=20,
+               help="Number of resource samples pushed together")
+@click.option('--memory-events/--no-memory-events',
+               default=True,
+               help="Push spill, unspill and memory threshold events")
+@click.option('--memory-check-interval',
+               type=float,
+               default=0.1,
+               help="Seconds between two checks of the memory thresholds of the worker")
+@click.option('--spool-dir',
+               type=str,
+               default=None,
+               help="Directory where events are spooled while Mofka is slow or unavailable, no spool by default")
+@click.option('--spool-threshold',
+               type=int,
+               default=100000,
+               help="Number of events pushed during a flush from which events are spooled")
+@click.option('--spool-segment-size',
+               type=int,
+               default=64 << 20,
+               help="Size in bytes of the spool segment files")
+@click.option('--sampling-rules',
+               type=str,
+               default=None,
+               help="JSON list of transition sampling rules, or path to a JSON file holding them")
+@click.option('--sampling-report-interval',
+               type=float,
+               default=5.0,
+               help="Seconds between two reports of the number of transitions suppressed by sampling")
 
-async def dask_setup(worker, mofka_protocol, group_file):
-    plugin = MofkaWorkerPlugin(worker, mofka_protocol, group_file)
+async def dask_setup(worker, mofka_protocol, group_file, flush_events, flush_interval, flush_on_idle,
+                     partitions, partition_by, topic_layout,
+                     transfer_interval, telemetry_interval, telemetry_batch, memory_events,
+                     memory_check_interval, pending_size, spool_dir, spool_threshold, spool_segment_size,
+                     sampling_rules, sampling_report_interval):
+    plugin = MofkaWorkerPlugin(worker, mofka_protocol, group_file,
+                               flush_events, flush_interval, flush_on_idle,
+                               partitions, partition_by, topic_layout,
+                               transfer_interval, telemetry_interval, telemetry_batch, memory_events,
+                               memory_check_interval, pending_size, spool_dir, spool_threshold,
+                               spool_segment_size, sampling_rules, sampling_report_interval)
     await worker.plugin_add(plugin)
\ No newline at end of file
@@ -1,6 +1,8 @@
 import os
 import sys
 import time
+import threading
+import subprocess
 
 from pymargo.core import Engine
 from pymargo.core import client as client_mode
@@ -8,21 +10,46 @@ import mochi.mofka.client as mofka
 
 import logging
 
+import numpy as np
 import pandas as pd
 import click
+
+# make the mofkadask helpers importable when run from nonBlockingPlugins/
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mofkadask.arrays import ACTION as ARRAY_ACTION, ArrayAssemblers
+from mofkadask.columns import TABLES, TableBuilder
+from mofkadask.encoding import FORMAT, EventDecoder, decode_frame
+from mofkadask.graph import GraphAssembler
+from mofkadask.ingest import IngestPipeline
+from mofkadask.memory import spill_by_prefix
+from mofkadask.merge import STOP_MARKER, member_dir, merge_group
 import traceback
 import json
+from mofkadask.partitioning import open_topic
+from mofkadask.rolling import GROUPS as ROLLING_GROUPS, STATE as ROLLING_STATE, RollingStats, serve as serve_stats
+from mofkadask.sink import FORMATS as SINK_FORMATS, Sink
+from mofkadask.topics import EVENT_CLASSES, LAYOUTS, topic_names
 
 def my_data_selector(metadata, descriptor):
     return descriptor
 
+def subscribed_data_selector(actions):
+    """Data selector that does not fetch the data of the events of other actions"""
+    def data_selector(metadata, descriptor):
+        if isinstance(metadata, str):
+            metadata = json.loads(metadata)
+        return descriptor if metadata["action"] in actions else None
+    return data_selector
+
 def my_data_broker(metadata, descriptor):
     data = bytearray(descriptor.size)
     return [data]
 
 class MofkaConsumer():
 
-    def __init__(self, mofka_protocol, group_file):
+    def __init__(self, mofka_protocol, group_file, partitions=1, topic_layout="single", subscribe=None,
+                 array_topic=None, batch_size=256, pull_depth=8, decoders=2, sink=None, group_size=1, group_rank=0,
+                 group_dir=None, stats_window=60.0, stats_port=None):
         logging.basicConfig(filename="MofkaConsumer.log",
                             format='%(asctime)s %(message)s',
                             datefmt='%m/%d/%Y %I:%M:%S %p',
@@ -33,111 +60,259 @@ class MofkaConsumer():
         self.engine = Engine(mofka_protocol, use_progress_thread=True)
         self.driver = mofka.MofkaDriver(group_file, self.engine)
         topic_name = "Dask"
-        if not self.driver.topic_exists(topic_name):
-            logging.info("Mofka topic %s is created by MofkaPlugin", topic_name)
-            self.driver.create_topic(topic_name)
-            self.driver.add_memory_partition(topic_name, 0)
 
-        self.topic = self.driver.open_topic(topic_name)
+        # event classes to consume, lifecycle events are always needed to know when to stop
+        classes = list(EVENT_CLASSES) if subscribe is None else list(subscribe)
+        if "lifecycle" not in classes:
+            classes.append("lifecycle")
+        self.actions = {"dictionary_delta"}.union(*(EVENT_CLASSES[c] for c in classes))
+        if topic_layout == "single" and subscribe is not None:
+            # the single topic holds every class, skip fetching the data of the others
+            data_selector = subscribed_data_selector(self.actions)
+        else:
+            data_selector = my_data_selector
 
-        # Create a consumer
+        # Create a consumer per topic, or one consumer per partition pulled by its own thread.
+        # In a consumer group the (topic, partition) pairs are dealt to the members in turn
         consumer_name = "Dask_consumer"
-        self.consumer = self.topic.consumer(name=consumer_name,
-                                batch_size=1,
-                                data_broker=my_data_broker,
-                                data_selector=my_data_selector)
-        logger.info("Mofka consumer %s is created", consumer_name)
-
-        self.scheduler_transition_rec = pd.DataFrame()
-        self.worker_transition_rec = pd.DataFrame()
-        self.worker_transfer_rec = pd.DataFrame()
-        self.client_rec = pd.DataFrame()
-        self.worker_rec = pd.DataFrame()
-        self.graph_rec = pd.DataFrame()
+        self.consumers = []
+        slot = 0
+        for name in sorted(set(topic_names(topic_name, topic_layout, classes).values())):
+            topic, npartitions = open_topic(self.driver, name, partitions)
+            owned = [p for p in range(npartitions) if (slot + p) % group_size == group_rank]
+            slot += npartitions
+            if not owned:
+                continue
+            if npartitions == 1:
+                self.consumers.append(topic.consumer(name=consumer_name,
+                                        batch_size=batch_size,
+                                        data_broker=my_data_broker,
+                                        data_selector=data_selector))
+            else:
+                self.consumers.extend(topic.consumer(name=f"{consumer_name}_{p}",
+                                        batch_size=batch_size,
+                                        data_broker=my_data_broker,
+                                        data_selector=data_selector,
+                                        targets=[p])
+                                      for p in owned)
+            logger.info("Mofka consumer %s is created for topic %s (%d of %d partitions)", consumer_name, name,
+                        len(owned), npartitions)
+
+        # arrays published by the tasks with mofkadask.arrays, rebuilt in place by the data broker
+        self.arrays = ArrayAssemblers()
+        self.array_consumer = None
+        if array_topic and group_rank == 0:
+            topic, _ = open_topic(self.driver, array_topic)
+            self.array_consumer = topic.consumer(name="Dask_array_consumer",
+                                        batch_size=1,
+                                        data_broker=self.arrays.broker,
+                                        data_selector=my_data_selector)
+            logger.info("Mofka consumer Dask_array_consumer is created for topic %s", array_topic)
+
+        # one columnar table per CSV file, see mofkadask.columns.TABLES
+        self.tables = {}
+        self.decoder = EventDecoder()
+        # submitted graphs, rebuilt from their CSR chunks and indexed by graph id
+        self.graphs = GraphAssembler()
+        # the tables are appended by the aggregation thread of the ingest pipeline
+        self.lock = threading.Lock()
         self.stop = False
+        self.batch_size = batch_size
+        self.pull_depth = pull_depth
+        self.ndecoders = decoders
+        self.ingest_stats = None
+        # member of a consumer group: its tables go to <group_dir>/member-<rank>, and the member
+        # seeing the end of the workflow tells the others with a marker file
+        self.group_dir = group_dir
+        self.output_dir = member_dir(group_dir, group_rank) if group_dir else "."
+        os.makedirs(self.output_dir, exist_ok=True)
+        # rolling statistics per prefix and per worker, queryable over HTTP while the workflow runs
+        self.rolling = RollingStats(stats_window, labels=self.label) if stats_window else None
+        self.stats_server = serve_stats(self.rolling, stats_port) if self.rolling is not None and stats_port else None
+        # streaming Parquet/Arrow sink of the tables, the tables are written to CSV at teardown without it
+        self.sink = sink
 
     def append_event_data(self, metadata , data):
 
-        if metadata["action"] == "scheduler_transition":
-            if self.scheduler_transition_rec.empty:
-                self.scheduler_transition_rec = pd.DataFrame.from_records([data])
-            else:
-                self.scheduler_transition_rec = pd.concat([self.scheduler_transition_rec,
-                                                 pd.DataFrame.from_records([data])],
-                                                 ignore_index=True)
+        if metadata["action"] == "scheduler_transition" and self.rolling is not None:
+            self.rolling.add_transitions(data, self.decoder.codes)
 
-        if metadata["action"] == "worker_transition":
-            if self.worker_transition_rec.empty:
-                self.worker_transition_rec = pd.DataFrame.from_records([data])
-            else:
-                self.worker_transition_rec = pd.concat([self.worker_transition_rec,
-                                                 pd.DataFrame.from_records([data])],
-                                                 ignore_index=True)
+        name = TABLES.get(metadata["action"])
+        if name is not None:
+            table = self.tables.get(name)
+            if table is None:
+                table = self.tables[name] = TableBuilder()
+            table.append(data)
 
-        if metadata["action"] == "worker_transfer":
-            if self.worker_transfer_rec.empty:
-                self.worker_transfer_rec = pd.DataFrame.from_records([data])
-            else:
-                self.worker_transfer_rec = pd.concat([self.worker_transfer_rec,
-                                                 pd.DataFrame.from_records([data])],
-                                                 ignore_index=True)
+        elif metadata["action"] == "close" or metadata["action"] == "before_close" : self.stop = True
 
-        elif metadata["action"] == "update_graph":
-            if self.graph_rec.empty:
-                self.graph_rec = pd.DataFrame.from_records([data])
-            else:
-                self.graph_rec = pd.concat([self.graph_rec,
-                                            pd.DataFrame.from_records([data])],
-                                            ignore_index=True)
+    def label(self, key):
+        """Name of a dictionary code of the decoder, other keys are already names"""
+        if isinstance(key, int) and 0 <= key < len(self.decoder.categories):
+            return self.decoder.categories[key]
+        return key
 
-        elif metadata["action"] == "remove_worker" or metadata["action"] == "add_worker" :
-            if self.worker_rec.empty:
-                self.worker_rec = pd.DataFrame.from_records([data])
-            else:
-                self.worker_rec = pd.concat([self.worker_rec,
-                                             pd.DataFrame.from_records([data])],
-                                             ignore_index=True)
+    def table(self, name):
+        """DataFrame of the events appended to table ``name`` (since its last write to the sink), empty if none"""
+        table = self.tables.get(name)
+        return table.frame() if table is not None else pd.DataFrame()
 
+    def decode_events(self, events):
+        """
+        Decode a batch of pulled events into columns.
 
-        elif metadata["action"] == "add_client" or metadata["action"] == "remove_client":
-            if self.client_rec.empty:
-                self.client_rec = pd.DataFrame.from_records([data])
-            else:
-                self.client_rec = pd.concat([self.client_rec,
-                                             pd.DataFrame.from_records([data])],
-                                             ignore_index=True)
+        Binary frames are decoded together, concatenating the columns of all the frames
+        of the same action. Dictionary encoded columns hold codes into
+        ``self.decoder.categories``. Events pushed by older plugins, which carry all
+        their fields in the metadata, are still accepted.
 
-        elif metadata["action"] == "remove_client" or metadata["action"] == "close" or metadata["action"] == "before_close" : self.stop = True
+        Returns
+        -------
+            A dict mapping every action to a dict of columns.
+        """
+        return self.merge_events(self.parse_events(events))
 
+    def parse_events(self, events):
+        """
+        Stateless part of ``decode_events``, run by the decoder threads on every
+        pulled batch: parses the metadata and decodes the binary frames.
 
-    def get_data(self):
-        while not (self.stop):
-            f = self.consumer.pull()
-            event = f.wait()
-            
+        Returns
+        -------
+            The graph chunks, the decoded frames as (source, action, columns)
+            triples, and the columns of the events of older plugins by action.
+        """
+        graphs = []
+        frames = []
+        batch = {}
+        for event in events:
             try:
-                
                 metadata = json.loads(event.metadata)
-                """
-                To avoid needing to rewrite append_event_data, the modified metadata, 
-                which was updated to include all fields formerly in the data payload, 
-                is passed as if it were the data field
-                """
-                self.append_event_data(metadata, metadata)
-            except:
-                print("Data failure: ", metadata, flush=True)
+                if metadata["action"] not in self.actions:
+                    # not subscribed, its data was not fetched
+                    continue
+                if metadata["action"] == "graph_chunk":
+                    graphs.append(event.data[0])
+                elif metadata.get("format") == FORMAT:
+                    # dictionaries are per topic and partition
+                    frames.append(((metadata["source"], metadata.get("topic"), metadata.get("partition")),
+                                   *decode_frame(event.data[0])))
+                else:
+                    columns = batch.setdefault(metadata.pop("action"), {})
+                    for name, value in metadata.items():
+                        columns.setdefault(name, []).append(value)
+            except Exception:
+                print("data failure: ", event.metadata, flush=True)
                 traceback.print_exc()
-                print("-------------------------")
-            finally:
-                pass
+        return graphs, frames, batch
+
+    def merge_events(self, parsed):
+        """Ordered part of ``decode_events``: adds the graph chunks and applies the producer dictionaries"""
+        graphs, frames, batch = parsed
+        for chunk in graphs:
+            self.graphs.add(chunk)
+        batch.update(self.decoder.apply(frames))
+        return batch
+
+    def ingest(self, parsed):
+        """Append a parsed batch to the tables, run by the aggregation thread in pulling order"""
+        try:
+            with self.lock:
+                for action, columns in self.merge_events(parsed).items():
+                    self.append_event_data({"action": action}, columns)
+                if self.sink is not None:
+                    self.write_tables()
+        except:
+            print("data failure in a batch of", sum(len(part) for part in parsed[:2]), "events", flush=True)
+            traceback.print_exc()
+
+    def write_tables(self, force=False):
+        """Hand the tables that are large or old enough to the sink, and start them over"""
+        for name, table in list(self.tables.items()):
+            if force or self.sink.due(name, len(table)):
+                self.sink.write(name, self.decoder.categorical(table.frame()))
+                self.tables[name] = TableBuilder()
+
+    def get_data(self):
+        """Pull, decode and append the events of all the topics and partitions until the end of the workflow"""
+        if self.array_consumer is not None:
+            threading.Thread(target=self.read_arrays, daemon=True).start()
+        pipeline = IngestPipeline(self.consumers, self.parse_events, self.ingest, lambda: self.stop,
+                                  batch_size=self.batch_size, depth=self.pull_depth, decoders=self.ndecoders)
+        pipeline.start()
+        while not self.stop:
+            time.sleep(0.1)
+            if self.group_dir and os.path.exists(os.path.join(self.group_dir, STOP_MARKER)):
+                self.stop = True
+            if self.sink is not None:
+                with self.lock:
+                    self.write_tables()
+        if self.group_dir:
+            open(os.path.join(self.group_dir, STOP_MARKER), "a").close()
+        # give the other partitions a moment to deliver their last events
+        self.ingest_stats = pipeline.close(1.0)
+
+    def read_arrays(self):
+        """Rebuild the published arrays, each one is saved to <name>.npy once all its chunks arrived"""
+        while not (self.stop):
+            event = self.array_consumer.pull().wait()
+            metadata = json.loads(event.metadata)
+            if metadata.get("action") != ARRAY_ACTION:
+                continue
+            assembler = self.arrays.add(metadata, event.data[0])
+            if assembler.complete:
+                np.save(f"{assembler.name}.npy", assembler.array)
+                logging.info("Array %s of %s %s rebuilt from %d chunks (%d in place)", assembler.name,
+                             assembler.array.shape, assembler.array.dtype, len(assembler.chunks),
+                             assembler.in_place)
+
+    def output(self, filename):
+        return os.path.join(self.output_dir, filename)
+
+    def rolling_tables(self):
+        """Last window of the rolling statistics, per prefix and per worker"""
+        if self.stats_server is not None:
+            self.stats_server.shutdown()
+        if self.rolling is None:
+            return {}
+        logging.info("Rolling statistics of %d transitions, %d too late for their window", self.rolling.events,
+                     self.rolling.late)
+        if self.group_dir:
+            # the statistics of a member only cover its partitions, merge_group merges their buckets
+            self.rolling.save(self.output(ROLLING_STATE))
+        return {f"rolling_{by}": self.rolling.frame(by) for by in ROLLING_GROUPS}
 
     def teardown(self):
-        self.scheduler_transition_rec.to_csv("scheduler_transition.csv")
-        self.worker_transition_rec.to_csv("worker_transition.csv")
-        self.worker_transfer_rec.to_csv("worker_transfer.csv")
-        self.client_rec.to_csv("client.csv")
-        self.worker_rec.to_csv("worker.csv")
-        self.graph_rec.to_csv("graph.csv")
+        for assembler in self.arrays.arrays.values():
+            if not assembler.complete:
+                logging.warning("Array %s is incomplete, %d of %d bytes received", assembler.name,
+                                assembler.received, assembler.array.nbytes)
+        if self.sink is not None:
+            with self.lock:
+                self.write_tables(force=True)
+            for name, frame in self.rolling_tables().items():
+                self.sink.write(name, frame)
+            self.sink.close()
+            self.sink.write("spill_by_prefix", spill_by_prefix(self.sink.read("worker_spill")))
+            self.sink.close()
+            return
+        self.decoder.categorical(self.table("scheduler_transition")).to_csv(self.output("scheduler_transition.csv"))
+        self.decoder.categorical(self.table("worker_transition")).to_csv(self.output("worker_transition.csv"))
+        self.decoder.categorical(self.table("worker_transfer")).to_csv(self.output("worker_transfer.csv"))
+        self.decoder.categorical(self.table("client")).to_csv(self.output("client.csv"))
+        self.decoder.categorical(self.table("worker")).to_csv(self.output("worker.csv"))
+        self.decoder.categorical(self.table("graph")).to_csv(self.output("graph.csv"))
+        self.decoder.categorical(self.table("worker_telemetry")).to_csv(self.output("worker_telemetry.csv"))
+        spills = self.decoder.categorical(self.table("worker_spill"))
+        spills.to_csv(self.output("worker_spill.csv"))
+        spill_by_prefix(spills).to_csv(self.output("spill_by_prefix.csv"))
+        for name, frame in self.rolling_tables().items():
+            frame.to_csv(self.output(f"{name}.csv"))
+        self.decoder.categorical(self.table("memory_threshold")).to_csv(self.output("memory_threshold.csv"))
+        self.decoder.categorical(self.table("sampling")).to_csv(self.output("sampling.csv"))
+        self.decoder.categorical(self.table("transition_summary")).to_csv(self.output("transition_summary.csv"))
+        self.decoder.categorical(self.table("latency_histogram")).to_csv(self.output("latency_histogram.csv"))
+        self.decoder.categorical(self.table("stall_report")).to_csv(self.output("stall_report.csv"))
 
 @click.command()
 @click.option('--mofka-protocol',
@@ -148,10 +323,115 @@ class MofkaConsumer():
                type=str,
                default="mofka.json",
                help="Mofka group file path")
-def main(mofka_protocol, group_file):
+@click.option('--partitions',
+               type=int,
+               default=1,
+               help="Number of partitions of the Dask topics, when the consumer creates them. "
+                    "Every partition is read by its own thread")
+@click.option('--topic-layout',
+               type=click.Choice(LAYOUTS),
+               default="single",
+               help="Topic layout the plugins were started with")
+@click.option('--subscribe',
+               type=str,
+               default=None,
+               help=f"Comma separated event classes to consume, among {', '.join(EVENT_CLASSES)} (default all)")
+@click.option('--array-topic',
+               type=str,
+               default=None,
+               help="Topic of the arrays published from the tasks with mofkadask.arrays, rebuilt to <name>.npy")
+@click.option('--batch-size',
+               type=int,
+               default=256,
+               help="Maximum number of events pulled and decoded together")
+@click.option('--pull-depth',
+               type=int,
+               default=8,
+               help="Number of pulls kept in flight per topic or partition")
+@click.option('--decoders',
+               type=int,
+               default=2,
+               help="Number of threads decoding the pulled batches")
+@click.option('--sink-dir',
+               type=str,
+               default=None,
+               help="Directory where the tables are streamed to Parquet or Arrow files while the workflow runs, "
+                    "instead of CSV files at the end. In a consumer group, directory of the merged tables")
+@click.option('--sink-format',
+               type=click.Choice(tuple(SINK_FORMATS)),
+               default="parquet",
+               help="Format of the files of --sink-dir")
+@click.option('--sink-rows',
+               type=int,
+               default=65536,
+               help="Number of rows from which a table is written to its file")
+@click.option('--sink-interval',
+               type=float,
+               default=10.0,
+               help="Seconds after which a table is written to its file")
+@click.option('--sink-file-size',
+               type=int,
+               default=256 << 20,
+               help="Size in bytes from which the files of a table are rolled")
+@click.option('--group-size',
+               type=int,
+               default=1,
+               help="Number of consumer processes sharing the partitions of the topics")
+@click.option('--group-rank',
+               type=int,
+               default=None,
+               help="Rank of this consumer in the group. Without it, the whole group is started on this node and "
+                    "its tables are merged at the end")
+@click.option('--group-dir',
+               type=str,
+               default="group",
+               help="Directory of the tables of the group members, on a file system shared by their nodes")
+@click.option('--lateness',
+               type=float,
+               default=1.0,
+               help="Maximum delay in seconds of an event behind the events pulled before it, "
+                    "for the time-ordered merge of the group tables")
+@click.option('--stats-window',
+               type=float,
+               default=60.0,
+               help="Seconds of the sliding window of the rolling statistics per prefix and worker, 0 to disable them")
+@click.option('--stats-port',
+               type=int,
+               default=None,
+               help="Port serving the rolling statistics while the workflow runs, on /stats?by=prefix|worker")
+def main(mofka_protocol, group_file, partitions, topic_layout, subscribe, array_topic, batch_size, pull_depth,
+         decoders, sink_dir, sink_format, sink_rows, sink_interval, sink_file_size, group_size, group_rank, group_dir,
+         lateness, stats_window, stats_port):
     t0 = time.time()
-    consumer = MofkaConsumer(mofka_protocol, group_file)
+    if group_size > 1 and group_rank is None:
+        # start every member of the group here, then merge their tables
+        os.makedirs(group_dir, exist_ok=True)
+        if os.path.exists(os.path.join(group_dir, STOP_MARKER)):
+            os.remove(os.path.join(group_dir, STOP_MARKER))
+        members = [subprocess.Popen([sys.executable, os.path.abspath(__file__)] + sys.argv[1:] +
+                                    ["--group-rank", str(rank)])
+                   for rank in range(group_size)]
+        for member in members:
+            member.wait()
+        merge_group(group_dir, sink_dir or ".", lateness)
+        print(f"\n\nTotal time taken  = {time.time()-t0:.2f}s", flush=True)
+        return
+    subscribe = subscribe.split(",") if subscribe else None
+    if group_size > 1:
+        output_dir = member_dir(group_dir, group_rank)
+        # the members of a local group serve their statistics on consecutive ports
+        stats_port = stats_port + group_rank if stats_port else None
+        sink = Sink(output_dir, sink_format, sink_rows, sink_interval, sink_file_size) if sink_dir else None
+    else:
+        group_dir = None
+        sink = Sink(sink_dir, sink_format, sink_rows, sink_interval, sink_file_size) if sink_dir else None
+    consumer = MofkaConsumer(mofka_protocol, group_file, partitions, topic_layout, subscribe, array_topic,
+                             batch_size, pull_depth, decoders, sink, group_size, group_rank or 0, group_dir,
+                             stats_window, stats_port)
     consumer.get_data()
+    stats = consumer.ingest_stats
+    print(f"\n\nIngested {stats['events']} events at {stats['events/s']:.0f} events/s "
+          f"(peak {stats['peak']:.0f}, {stats['batch size']:.1f} events per batch)", flush=True)
     consumer.teardown()
     print(f"\n\nTotal time taken  = {time.time()-t0:.2f}s", flush=True)
 
@@ -5,83 +5,228 @@ import time
 import click
 import logging
 
-from pymargo.core import Engine
-import mochi.mofka.client as mofka
 from typing import Any
 
+from tornado.ioloop import PeriodicCallback
 from distributed.diagnostics.plugin import SchedulerPlugin
 
+# make the mofkadask helpers importable when the plugin is preloaded from plugins/
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mofkadask.emitter import BatchingEmitter, OVERFLOW_POLICIES
+from mofkadask.spool import Spool, spool_name
+from mofkadask.sampling import SamplingPolicy
+from mofkadask.aggregation import WindowAggregator
+from mofkadask.latency import LatencyTracker, LatencyHistograms
+from mofkadask.partitioning import STRATEGIES
+from mofkadask.metrics import PluginMetrics, timed
+from mofkadask.loopmonitor import LoopMonitor
+from mofkadask.topics import LAYOUTS
+from mofkadask.connection import MofkaConnection
+
+MODES = ("raw", "aggregate", "both")
+
 class MofkaSchedulerPlugin(SchedulerPlugin):
     """
     MofkaSchedulerPlugin couples Dask distributed witj Mofka through the Scheduler.
     This plugin pushes information about the progress and state transition of Dask
     tasks in the scheduler, adding/removing clients/workers.
+
+    Events are not pushed from the scheduler event loop: every hook only enqueues
+    its event into a BatchingEmitter whose drain thread pushes them in batches.
+
+    Task transitions go through a SamplingPolicy first. Its rules can be replaced
+    at runtime with the ``mofka_set_sampling`` scheduler RPC, and the number of
+    suppressed transitions is pushed periodically as ``sampling_stats`` events.
+
+    In ``aggregate`` mode, transitions are not pushed one by one: they are aggregated
+    per task prefix and worker over windows of ``window`` seconds, and only the
+    ``transition_summary`` records of every window are pushed. ``both`` does both.
+
+    Task transitions carry the scheduler queue, dispatch and exec latencies of the
+    tasks that finish computing (see LatencyTracker). With ``latency_histograms``
+    their per task prefix histograms are also pushed every ``window`` seconds.
+
+    A LoopMonitor measures the scheduler event loop lag and attributes the stalls
+    to the events whose ``emit`` was running, ``stall_report`` events are pushed
+    every ``stall_report_interval`` seconds.
+
+    The plugin connects to Mofka in the background (see MofkaConnection), the
+    events emitted meanwhile wait in the emitter buffer.
+
+    With ``spool_dir``, the events are written to a local Spool when Mofka falls
+    behind (the buffer is more than ``spool_threshold`` full) or when their push
+    fails, and replayed by the drain thread once Mofka keeps up again.
+
+    The ``mofka_flush`` scheduler RPC waits until every event emitted so far by
+    the scheduler and the workers is pushed and their producers are flushed.
     """
-    def __init__(self, scheduler, mofka_protocol, group_file):
+    def __init__(self, scheduler, mofka_protocol, group_file,
+                 buffer_size=65536, batch_size=1024, overflow_policy="block", sample_every=10,
+                 sampling_rules=None, sampling_report_interval=5.0, mode="raw", window=1.0,
+                 partitions=1, partition_by="worker", topic_layout="single",
+                 latency_histograms=False, stall_threshold=50.0, stall_report_interval=5.0,
+                 spool_dir=None, spool_threshold=0.5, spool_segment_size=64 << 20):
         logging.basicConfig(filename="MofkaSchedulerPlugin.log",
                             format='%(asctime)s %(message)s',
                             datefmt='%m/%d/%Y %I:%M:%S %p',
                             filemode='w')
         logger = logging.getLogger()
         logger.setLevel(logging.INFO)
-        # create mofka client
         self.scheduler = scheduler
-        self.engine = Engine(mofka_protocol, use_progress_thread=True)
-        self.driver = mofka.MofkaDriver(group_file, self.engine)
-
-        # create a topic
-        topic_name = "Dask"
-        if not self.driver.topic_exists(topic_name):
-            logging.info("Mofka topic %s is created by MofkaPlugin", topic_name)
-            self.driver.create_topic(topic_name)
-            self.driver.add_memory_partition(topic_name, 0)
-
-        self.topic = self.driver.open_topic(topic_name)
-
-        # create a producer
-        producer_name = "Dask_scheduler_producer"
-        batchsize = mofka.AdaptiveBatchSize
-        thread_pool = mofka.ThreadPool(1)
-        ordering = mofka.Ordering.Strict
-        self.producer = self.topic.producer(producer_name, batchsize, thread_pool, ordering)
-        logging.info("Mofka producer %s is created", producer_name)
+        # connect to mofka in the background, the emitter buffers the events until then
+        self.connection = MofkaConnection(mofka_protocol, group_file, "Dask_scheduler_producer",
+                                          topic_layout=topic_layout, partitions=partitions,
+                                          partition_by=partition_by)
+
+        # self-instrumentation, exported on the scheduler /metrics endpoint
+        self.metrics = PluginMetrics("scheduler", scheduler.id)
+        # event loop lag, in seconds, 0 disables the monitor
+        self.monitor = LoopMonitor(stall_threshold / 1e3) if stall_threshold > 0 else None
+        self.stall_report_interval = stall_report_interval
+
+        self.spool = Spool(spool_dir, spool_name("scheduler"), spool_segment_size) if spool_dir else None
+        # events are pushed by the emitter drain thread, never by the scheduler
+        self.emitter = BatchingEmitter(None,
+                                       capacity=buffer_size,
+                                       batch_size=batch_size,
+                                       overflow=overflow_policy,
+                                       sample_every=sample_every,
+                                       name="mofka-scheduler-emitter",
+                                       metrics=self.metrics,
+                                       monitor=self.monitor,
+                                       connect=self.connection.connect,
+                                       spool=self.spool,
+                                       spool_threshold=spool_threshold)
+
+        self.sampling = SamplingPolicy.from_config(sampling_rules)
+        self.sampling_report_interval = sampling_report_interval
+        self.scheduler.handlers["mofka_set_sampling"] = self.set_sampling
+        self.scheduler.handlers["mofka_flush"] = self.mofka_flush
+
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode {mode!r}, expected one of {MODES}")
+        self.raw = mode in ("raw", "both")
+        self.aggregator = WindowAggregator() if mode in ("aggregate", "both") else None
+        self.window = window
+        self.latency = LatencyTracker()
+        self.latency_histograms = LatencyHistograms() if latency_histograms else None
+
+        self.metrics.gauge("queue_depth", "Events buffered in the emitter", lambda: self.emitter.queued)
+        self.metrics.gauge("dropped_events", "Events dropped by the emitter overflow policy",
+                           lambda: self.emitter.dropped)
+        if self.spool is not None:
+            self.metrics.gauge("spooled_events", "Events waiting in the local spool",
+                               lambda: len(self.spool))
+        if self.monitor is not None:
+            self.metrics.gauge("event_loop_lag_seconds", "Lag of the last event loop monitor tick",
+                               lambda: self.monitor.last_lag)
+        self.metrics.register()
 
     async def start(self, scheduler):
         """Run when the scheduler starts up
 
         This runs at the end of the Scheduler startup process
         """
-        restart = str({"time" : time.time()}).encode("utf-8")
-        try:
-            f = self.producer.push({"action": "restart"}, restart)
-            f.wait()
-        except Exception as Argument:
-            logging.exception("Exception while calling restart method when sending", str(restart))
+        self.emitter.emit("restart", {"time" : time.time()})
+        pc = PeriodicCallback(self.report_sampling, self.sampling_report_interval * 1000)
+        self.scheduler.periodic_callbacks["mofka-sampling-report"] = pc
+        pc.start()
+        if self.aggregator is not None:
+            pc = PeriodicCallback(self.flush_window, self.window * 1000)
+            self.scheduler.periodic_callbacks["mofka-window-flush"] = pc
+            pc.start()
+        if self.latency_histograms is not None:
+            pc = PeriodicCallback(self.flush_latency_histograms, self.window * 1000)
+            self.scheduler.periodic_callbacks["mofka-latency-flush"] = pc
+            pc.start()
+        if self.monitor is not None:
+            pc = PeriodicCallback(self.monitor.tick, self.monitor.interval * 1000)
+            self.scheduler.periodic_callbacks["mofka-loop-monitor"] = pc
+            pc.start()
+            pc = PeriodicCallback(self.report_stalls, self.stall_report_interval * 1000)
+            self.scheduler.periodic_callbacks["mofka-stall-report"] = pc
+            pc.start()
 
     async def before_close(self):
         """Runs prior to any Scheduler shutdown logic"""
-        before_close = str({"time" : time.time()}).encode("utf-8")
-        try:
-            f = self.producer.push({"action": "before_close"}, before_close)
-            f.wait()
-        except Exception as Argument:
-            logging.exception("Exception while calling before_close method when sending", str(before_close))
+        self.report_sampling()
+        self.flush_window()
+        self.flush_latency_histograms()
+        self.report_stalls()
+        self.emitter.emit("before_close", {"time" : time.time()})
+
+    def report_sampling(self):
+        """Push the number of transitions suppressed by sampling since the last report"""
+        for record in self.sampling.report("scheduler"):
+            self.emitter.emit("sampling_stats", record)
+
+    def flush_window(self):
+        """Push the transition summaries of the current window"""
+        if self.aggregator is None:
+            return
+        for record in self.aggregator.flush():
+            self.emitter.emit("transition_summary", record)
+
+    def report_stalls(self):
+        """Push the event loop stalls since the last report and the actions they are attributed to"""
+        if self.monitor is None:
+            return
+        for record in self.monitor.report("scheduler"):
+            self.emitter.emit("stall_report", record)
+
+    def flush_latency_histograms(self):
+        """Push the latency histograms of the current window"""
+        if self.latency_histograms is None:
+            return
+        for record in self.latency_histograms.flush():
+            self.emitter.emit("latency_histogram", record)
+
+    async def set_sampling(self, rules=None):
+        """
+        Scheduler RPC handler replacing the sampling rules of the scheduler and of
+        the workers running MofkaWorkerPlugin, for instance from a client::
+
+            client.sync(client.scheduler.mofka_set_sampling, rules=[{"finish": "erred"}, ...])
+
+        An empty list of rules keeps every transition.
+        """
+        rules = rules or []
+        self.report_sampling()
+        self.sampling.set_rules(rules)
+        logging.info("Mofka sampling rules set to %s", rules)
+        workers = await self.scheduler.broadcast(msg={"op": "mofka_set_sampling", "rules": rules},
+                                                 on_error="ignore")
+        return {"scheduler": self.sampling.to_dict(), "workers": workers}
+
+    async def mofka_flush(self):
+        """
+        Scheduler RPC handler flushing the emitters of the scheduler and of the
+        workers running MofkaWorkerPlugin, for instance from a client before it
+        shuts the cluster down::
+
+            client.sync(client.scheduler.mofka_flush)
+
+        Returns
+        -------
+            The flush latency in seconds of the scheduler and of every worker.
+        """
+        t0 = time.time()
+        await self.scheduler.loop.run_in_executor(None, self.emitter.flush)
+        latency = time.time() - t0
+        logging.info("Mofka scheduler emitter flushed in %.3fs", latency)
+        workers = await self.scheduler.broadcast(msg={"op": "mofka_flush"}, on_error="ignore")
+        return {"scheduler": latency, "workers": workers}
 
     async def close(self):
         """Run when the scheduler closes down
 
         This runs at the beginning of the Scheduler shutdown process, but after
-        workers have been asked to shut down gracefully
+        workers have been asked to shut down gracefully. The remaining buffered
+        events are drained and the producer is flushed, so this is allowed to block.
         """
-        # close = str({"time" : time.time()}).encode("utf-8")
-        # f = self.producer.push({"action": "close"}, close)
-        # f.wait()
-        # self.producer.flush()
-        # del self.producer
-        # del self.topic
-        # del self.service
-        # del self.client
-        # del self.engine
+        self.emitter.close()
+        self.metrics.unregister()
+        logging.info("Mofka scheduler plugin metrics: %s", self.metrics.summary())
 
     def update_graph(
         self,
@@ -124,27 +269,19 @@ class MofkaSchedulerPlugin(SchedulerPlugin):
                 It is recommended to allow plugins to accept more parameters to
                 ensure future compatibility.
         """
-        update_graph = str({"client": client,
-                            "keys": keys,
-                            "dependencies": dependencies,
-                            "time": time.time()
-                           }).encode("utf-8")
-        try:
-            f = self.producer.push({"action": "update_graph"}, update_graph)
-            f.wait()
-        except Exception as Argument:
-            logging.exception("Exception while calling update_graph method when sending", str(update_graph))
+        # the graph is turned into CSR chunks by the emitter drain thread,
+        # the scheduler does not modify keys and dependencies once they are passed here
+        self.emitter.emit("update_graph", {"client": client,
+                                           "keys": keys,
+                                           "dependencies": dependencies,
+                                           "time": time.time()
+                                          })
 
     def restart(self, scheduler):
         """Run when the scheduler restarts itself"""
-        # XXX
-        restrat = str({"time" : time.time()}).encode("utf-8")
-        try:
-            f = self.producer.push({"action": "restrat"}, restart)
-            f.wait()
-        except Exception as Argument:
-            logging.exception("Exception while calling restart method when sending", str(restart))
+        self.emitter.emit("restart", {"time" : time.time()})
 
+    @timed("transition")
     def transition(
         self,
         key,
@@ -199,26 +336,51 @@ class MofkaSchedulerPlugin(SchedulerPlugin):
         if kwargs.get("worker"):
             worker = kwargs["worker"]
 
-        transition_data =  str({"key"            : str(key),
-                                "thread"         : thread,
-                                "worker"         : worker,
-                                "prefix"         : self.scheduler.tasks[key].prefix.name,
-                                "group"          : self.scheduler.tasks[key].group.name,
-                                "start"          : start,
-                                "finish"         : finish,
-                                "stimulus_id"    : stimulus_id,
-                                "called_from"    : self.scheduler.address,
-                                "begins"         : begins,
-                                "ends"           : ends,
-                                "duration"       : duration,
-                                "size"           : size,
-                                "time"           : time.time()
-                               }).encode("utf-8")
-        try:
-            f = self.producer.push({"action": "scheduler_transition"}, transition_data)
-            f.wait()
-        except Exception as Argument:
-            logging.exception("Exception while calling transition method when sending", str(transition_data))
+        ts = self.scheduler.tasks[key]
+        now = time.time()
+        queue_latency = dispatch_latency = exec_latency = None
+        if start == "processing" and finish in ("memory", "erred"):
+            begin = end = None
+            for ss in kwargs.get("startstops") or ():
+                if ss["action"] == "compute":
+                    # worker clock to scheduler clock
+                    ws = self.scheduler.workers.get(worker)
+                    delay = ws.time_delay if ws is not None else 0
+                    begin = ss["start"] + delay
+                    end = ss["stop"] + delay
+            queue_latency, dispatch_latency, exec_latency = self.latency.finished(key, begin, end)
+            if self.latency_histograms is not None:
+                self.latency_histograms.add(ts.prefix.name, queue_latency, dispatch_latency, exec_latency)
+        else:
+            self.latency.transition(key, start, finish, now)
+
+        if self.aggregator is not None:
+            self.aggregator.add(ts.prefix.name, worker, start, finish, duration, size)
+            if not self.raw:
+                return
+
+        if not self.sampling.keep(ts.prefix.name, start, finish, worker):
+            return
+
+        self.emitter.emit("scheduler_transition",
+                          {"key"            : str(key),
+                           "thread"         : thread,
+                           "worker"         : worker,
+                           "prefix"         : ts.prefix.name,
+                           "group"          : ts.group.name,
+                           "start"          : start,
+                           "finish"         : finish,
+                           "stimulus_id"    : stimulus_id,
+                           "called_from"    : self.scheduler.address,
+                           "begins"         : begins,
+                           "ends"           : ends,
+                           "duration"       : duration,
+                           "size"           : size,
+                           "time"           : now,
+                           "queue_latency"  : queue_latency,
+                           "dispatch_latency" : dispatch_latency,
+                           "exec_latency"   : exec_latency,
+                          })
 
 
     def add_worker(self, scheduler, worker: str):
@@ -235,12 +397,7 @@ class MofkaSchedulerPlugin(SchedulerPlugin):
             ``SchedulerPlugin.add_worker`` hooks and the ordering may be subject
             to change without deprecation cycle.
         """
-        add_worker = str({"worker" : worker, "time" : time.time()}).encode("utf-8")
-        try:
-            f = self.producer.push({"action": "add_worker"}, add_worker)
-            f.wait()
-        except Exception as Argument:
-            logging.exception("Exception while calling add_worker method when sending", str(add_worker))
+        self.emitter.emit("add_worker", {"worker" : worker, "time" : time.time()})
 
     def remove_worker(
         self, scheduler, worker: str, stimulus_id: str, **kwargs):
@@ -257,47 +414,23 @@ class MofkaSchedulerPlugin(SchedulerPlugin):
             ``SchedulerPlugin.remove_worker`` hooks and the ordering may be subject
             to change without deprecation cycle.
         """
-        rm_worker = str({"worker" : worker, "stimulus_id" : stimulus_id,
-                         "time" : time.time()
-                        }).encode("utf-8")
-        try:
-            f = self.producer.push({"action": "remove_worker"}, rm_worker)
-            f.wait()
-        except Exception as Argument:
-            logging.exception("Exception while calling remove_worker method when sending", str(rm_worker))
+        self.emitter.emit("remove_worker", {"worker" : worker, "stimulus_id" : stimulus_id,
+                                            "time" : time.time()
+                                           })
 
     def add_client(self, scheduler, client: str):
         """Run when a new client connects"""
-        add_client = str({"client" : client,
-                          "time" : time.time()
-                        }).encode("utf-8")
-        try:
-            f = self.producer.push({"action": "add_client"}, add_client)
-            f.wait()
-        except Exception as Argument:
-            logging.exception("Exception while calling add_client method when sending", str(add_client))
+        self.emitter.emit("add_client", {"client" : client, "time" : time.time()})
 
     def remove_client(self, scheduler, client: str):
         """Run when a client disconnects"""
-        rm_client = str({"client" : client, "time" : time.time()}).encode("utf-8")
-        try:
-            f = self.producer.push({"action": "remove_client"}, rm_client)
-            f.wait()
-        except Exception as Argument:
-            logging.exception("Exception while calling remove client method when sending", str(rm_client))
+        self.emitter.emit("remove_client", {"client" : client, "time" : time.time()})
 
     def log_event(self, topic: str, msg: Any):
         """Run when an event is logged"""
-        log_event = {"topic" : topic, "message": msg, "time": time.time()}
-        try:
-            f = self.producer.push({"action": "log_event"}, str(log_event).encode("utf-8"))
-            f.wait()
-        except Exception as Argument:
-            logging.exception("Exception while calling log_event method when sending", str(log_event))
+        self.emitter.emit("log_event", {"topic" : topic, "message": msg, "time": time.time()})
 
     # TODO It maybe interesting to add to SchedulerPlugin inetface support for other methods.
-    # def send_task_to_worker(self, worker: str, ts: TaskState, duration: float = -1):
-    # def handle_task_finished(self, ...):
     # def other_handlers(...)
 
 
@@ -310,7 +443,82 @@ class MofkaSchedulerPlugin(SchedulerPlugin):
                type=str,
                default="mofka.json",
                help="Mofka group file path")
-
-def dask_setup(scheduler, mofka_protocol, group_file):
-    plugin = MofkaSchedulerPlugin(scheduler, mofka_protocol, group_file)
+@click.option('--buffer-size',
+               type=int,
+               default=65536,
+               help="Number of events buffered between the scheduler and the Mofka producer")
+@click.option('--batch-size',
+               type=int,
+               default=1024,
+               help="Maximum number of events pushed per batch by the drain thread")
+@click.option('--overflow-policy',
+               type=click.Choice(OVERFLOW_POLICIES),
+               default="block",
+               help="What to do with new events when the buffer is full")
+@click.option('--sample-every',
+               type=int,
+               default=10,
+               help="Keep one event out of this many when the buffer is full and the overflow policy is sample")
+@click.option('--sampling-rules',
+               type=str,
+               default=None,
+               help="JSON list of transition sampling rules, or path to a JSON file holding them")
+@click.option('--sampling-report-interval',
+               type=float,
+               default=5.0,
+               help="Seconds between two reports of the number of transitions suppressed by sampling")
+@click.option('--mode',
+               type=click.Choice(MODES),
+               default="raw",
+               help="Push every transition (raw), per-window summaries (aggregate) or both")
+@click.option('--window',
+               type=float,
+               default=1.0,
+               help="Length in seconds of the aggregation windows")
+@click.option('--partitions',
+               type=int,
+               default=1,
+               help="Number of partitions of the Dask topic, when this component creates it")
+@click.option('--partition-by',
+               type=click.Choice(STRATEGIES),
+               default="worker",
+               help="Route events to the topic partitions by worker, task key or action")
+@click.option('--topic-layout',
+               type=click.Choice(LAYOUTS),
+               default="single",
+               help="Push all the events to the Dask topic (single) or every event class to its own topic (per-class)")
+@click.option('--latency-histograms/--no-latency-histograms',
+               default=False,
+               help="Push per task prefix histograms of the queue, dispatch and exec latencies every window")
+@click.option('--stall-threshold',
+               type=float,
+               default=50.0,
+               help="Event loop lag in milliseconds from which the loop is considered stalled, 0 to disable the monitor")
+@click.option('--stall-report-interval',
+               type=float,
+               default=5.0,
+               help="Seconds between two event loop stall reports")
+@click.option('--spool-dir',
+               type=str,
+               default=None,
+               help="Directory where events are spooled while Mofka is slow or unavailable, no spool by default")
+@click.option('--spool-threshold',
+               type=float,
+               default=0.5,
+               help="Fraction of the buffer from which events are spooled")
+@click.option('--spool-segment-size',
+               type=int,
+               default=64 << 20,
+               help="Size in bytes of the spool segment files")
+
+def dask_setup(scheduler, mofka_protocol, group_file, buffer_size, batch_size, overflow_policy, sample_every,
+               sampling_rules, sampling_report_interval, mode, window, partitions, partition_by, topic_layout,
+               latency_histograms, stall_threshold, stall_report_interval,
+               spool_dir, spool_threshold, spool_segment_size):
+    plugin = MofkaSchedulerPlugin(scheduler, mofka_protocol, group_file,
+                                  buffer_size, batch_size, overflow_policy, sample_every,
+                                  sampling_rules, sampling_report_interval, mode, window,
+                                  partitions, partition_by, topic_layout,
+                                  latency_histograms, stall_threshold, stall_report_interval,
+                                  spool_dir, spool_threshold, spool_segment_size)
     scheduler.add_plugin(plugin)
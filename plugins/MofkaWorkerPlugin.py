@@ -5,49 +5,116 @@ import time
 import click
 import logging
 
-from pymargo.core import Engine
-import mochi.mofka.client as mofka
 from typing import Any
 
+from dask.utils import key_split
+from tornado.ioloop import PeriodicCallback
 from distributed.diagnostics.plugin import WorkerPlugin
 
+# make the mofkadask helpers importable when the plugin is preloaded from plugins/
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mofkadask.emitter import BatchingEmitter, OVERFLOW_POLICIES
+from mofkadask.spool import Spool, spool_name
+from mofkadask.sampling import SamplingPolicy
+from mofkadask.partitioning import STRATEGIES
+from mofkadask.metrics import PluginMetrics, timed
+from mofkadask.tail import LogTail
+from mofkadask.telemetry import WorkerTelemetry
+from mofkadask.memory import MemoryThresholds, SpillRecorder
+from mofkadask.shmring import AgentEmitter
+from mofkadask.topics import LAYOUTS
+from mofkadask.connection import MofkaConnection
+
 class MofkaWorkerPlugin(WorkerPlugin):
     """
     MofkaWorkerPlugin is a plugin that couples Dask distributed to Mofka through the worker.
     This plugin pushes information about the progress and state transition of Dask tasks in
     the worker.
+
+    Events are not pushed from the worker event loop: every hook only enqueues
+    its event into a BatchingEmitter whose drain thread pushes them in batches.
+
+    Task transitions go through a SamplingPolicy first, whose rules are replaced
+    by the scheduler ``mofka_set_sampling`` RPC. The scheduler ``mofka_flush`` RPC
+    flushes the emitter of every worker.
+
+    Transfers are not looked for on every transition: a periodic callback tails
+    the worker transfer logs every ``transfer_interval`` seconds.
+
+    Every ``telemetry_interval`` seconds, the worker CPU, memory, spilled bytes,
+    task queues and transfer counters are sampled, and pushed by batches of
+    ``telemetry_batch`` samples as ``worker_telemetry`` events.
+
+    With ``memory_events``, every spill and unspill of the worker is pushed as a
+    ``worker_spill`` event, and every change of its memory level (target, spill and
+    pause thresholds of the memory manager) as a ``memory_threshold`` event.
+
+    The plugin connects to Mofka in the background (see MofkaConnection), the
+    events emitted meanwhile wait in the emitter buffer.
+
+    With ``agent``, the worker does not connect to Mofka: events go through a
+    shared memory ring to the ``mofkadask.agent`` of that name on the node, which
+    pushes the events of all the workers of the node with one producer.
+
+    With ``spool_dir``, the events are written to a local Spool when Mofka falls
+    behind or when their push fails, and replayed once Mofka keeps up again (see
+    MofkaSchedulerPlugin). With ``agent``, the agent spools the events instead.
     """
-    def __init__(self, worker, mofka_protocol, group_file):
+    def __init__(self, worker, mofka_protocol, group_file,
+                 buffer_size=65536, batch_size=1024, overflow_policy="block", sample_every=10,
+                 sampling_rules=None, sampling_report_interval=5.0,
+                 partitions=1, partition_by="worker", topic_layout="single", transfer_interval=1.0,
+                 telemetry_interval=0.25, telemetry_batch=20, memory_events=True, memory_check_interval=0.1,
+                 agent=None, agent_ring_size=16 << 20,
+                 spool_dir=None, spool_threshold=0.5, spool_segment_size=64 << 20):
         logging.basicConfig(filename="MofkaWorkerPlugin.log",
                             format='%(asctime)s %(message)s',
                             datefmt='%m/%d/%Y %I:%M:%S %p',
                             filemode='w')
         logger = logging.getLogger()
         logger.setLevel(logging.INFO)
-        # create mofka client
         self.worker = worker
-        self.commin = 0
-        self.commout = 0
-        self.engine = Engine(mofka_protocol, use_progress_thread=True)
-        self.driver = mofka.MofkaDriver(group_file, self.engine)
-
-        # create a topic
-        topic_name = "Dask"
-        if not self.driver.topic_exists(topic_name):
-            logging.info("Mofka topic %s is created by MofkaPlugin", topic_name)
-            self.driver.create_topic(topic_name)
-            self.driver.add_memory_partition(topic_name, 0)
+        # self-instrumentation, exported on the worker /metrics endpoint
+        self.metrics = PluginMetrics("worker", worker.id)
 
-        self.topic = self.driver.open_topic(topic_name)
+        if agent:
+            # the node agent pushes the events of all the workers of the node
+            self.emitter = AgentEmitter(agent, agent_ring_size, overflow_policy)
+        else:
+            self.emitter = self.create_emitter(mofka_protocol, group_file, buffer_size, batch_size,
+                                               overflow_policy, sample_every, partitions, partition_by,
+                                               topic_layout, spool_dir, spool_threshold, spool_segment_size)
 
-        # create a producer
-        producer_name = "Dask_worker_producer"
-        batchsize = mofka.AdaptiveBatchSize
-        thread_pool = mofka.ThreadPool(1)
-        ordering = mofka.Ordering.Strict
-        self.producer = self.topic.producer(producer_name, batchsize, thread_pool, ordering)
-        logging.info("Mofka producer %s is created", producer_name)
+        self.sampling = SamplingPolicy.from_config(sampling_rules)
+        self.sampling_report_interval = sampling_report_interval
+        self.transfer_interval = transfer_interval
+        self.telemetry_interval = telemetry_interval
+        self.telemetry_batch = telemetry_batch
+        self.telemetry = None
+        self.memory_events = memory_events
+        self.memory_check_interval = memory_check_interval
+        self.spills = None
+        self.thresholds = None
 
+    def create_emitter(self, mofka_protocol, group_file, buffer_size, batch_size, overflow_policy,
+                       sample_every, partitions, partition_by, topic_layout, spool_dir=None, spool_threshold=0.5,
+                       spool_segment_size=64 << 20):
+        """Create the emitter pushing the events of this worker, connected to Mofka in the background"""
+        self.connection = MofkaConnection(mofka_protocol, group_file, "Dask_worker_producer",
+                                          topic_layout=topic_layout, partitions=partitions,
+                                          partition_by=partition_by)
+        spool = Spool(spool_dir, spool_name("worker"), spool_segment_size) if spool_dir else None
+        # events are pushed by the emitter drain thread, never by the worker
+        return BatchingEmitter(None,
+                               capacity=buffer_size,
+                               batch_size=batch_size,
+                               overflow=overflow_policy,
+                               sample_every=sample_every,
+                               name="mofka-worker-emitter",
+                               metrics=self.metrics,
+                               connect=self.connection.connect,
+                               spool=spool,
+                               spool_threshold=spool_threshold)
 
     def setup(self, worker):
         """
@@ -57,23 +124,96 @@ class MofkaWorkerPlugin(WorkerPlugin):
         """
         # XXX
         self.worker = worker
+        worker.handlers["mofka_set_sampling"] = self.set_sampling
+        worker.handlers["mofka_flush"] = self.mofka_flush
+        self.metrics.instance = str(worker.name)
+        self.metrics.gauge("queue_depth", "Events buffered in the emitter", lambda: self.emitter.queued)
+        self.metrics.gauge("dropped_events", "Events dropped by the emitter overflow policy",
+                           lambda: self.emitter.dropped)
+        self.metrics.register()
+        pc = PeriodicCallback(self.report_sampling, self.sampling_report_interval * 1000)
+        worker.periodic_callbacks["mofka-sampling-report"] = pc
+        pc.start()
+        self.incoming = LogTail(worker.transfer_incoming_log, "transfer_incoming_log")
+        self.outgoing = LogTail(worker.transfer_outgoing_log, "transfer_outgoing_log")
+        pc = PeriodicCallback(self.tail_transfers, self.transfer_interval * 1000)
+        worker.periodic_callbacks["mofka-transfer-tail"] = pc
+        pc.start()
+        if self.telemetry_interval > 0:
+            self.telemetry = WorkerTelemetry(worker, self.telemetry_batch)
+            pc = PeriodicCallback(self.sample_telemetry, self.telemetry_interval * 1000)
+            worker.periodic_callbacks["mofka-telemetry"] = pc
+            pc.start()
+        if self.memory_events:
+            self.spills = SpillRecorder(worker, self.push_spill)
+            self.spills.install()
+            self.thresholds = MemoryThresholds(worker)
+            pc = PeriodicCallback(self.check_memory, self.memory_check_interval * 1000)
+            worker.periodic_callbacks["mofka-memory"] = pc
+            pc.start()
+
+    def report_sampling(self):
+        """Push the number of transitions suppressed by sampling since the last report"""
+        for record in self.sampling.report(self.worker.name):
+            self.emitter.emit("sampling_stats", record)
+
+    def set_sampling(self, rules=None):
+        """Worker RPC handler replacing the sampling rules, called by the scheduler plugin"""
+        self.report_sampling()
+        self.sampling.set_rules(rules or [])
+        logging.info("Mofka sampling rules set to %s", rules)
+        return self.sampling.to_dict()
+
+    async def mofka_flush(self):
+        """Worker RPC handler flushing the emitter, returns the flush latency in seconds"""
+        t0 = time.time()
+        await self.worker.loop.run_in_executor(None, self.emitter.flush)
+        latency = time.time() - t0
+        logging.info("Mofka worker %s emitter flushed in %.3fs", self.worker.name, latency)
+        return latency
+
+    def sample_telemetry(self):
+        """Sample the worker resources, and push the samples once a batch is complete"""
+        samples = self.telemetry.sample()
+        # consecutive events of the same action are pushed in one frame
+        for sample in samples or ():
+            self.emitter.emit("worker_telemetry", sample)
+
+    def push_spill(self, record):
+        """SpillRecorder callback"""
+        self.emitter.emit("worker_spill", record)
+
+    def check_memory(self):
+        """Push a memory_threshold event when the memory level of the worker changed"""
+        record = self.thresholds.check()
+        if record is not None:
+            self.emitter.emit("memory_threshold", record)
+
+    def tail_transfers(self):
+        """Push the transfers logged by the worker since the previous call"""
+        now = time.time()
+        for tail, kind in ((self.incoming, "incoming_transfer"), (self.outgoing, "outgoing_transfer")):
+            for entry in tail.new_entries():
+                # the log entries belong to the worker, push copies
+                self.emitter.emit("worker_transfer",
+                                  dict(entry, type=kind, called_from=self.worker.name, time=now, keys=str(entry["keys"])))
 
     def teardown(self, worker):
         """Run when the worker to which the plugin is attached is closed, or
         when the plugin is removed."""
-        teardown = {"time" : time.time()}
-        try:
-            f = self.producer.push({"action": "remove_worker"}, str(teardown).encode("utf-8"))
-            f.wait()
-        except Exception as Argument:
-            logging.exception("Exception while calling remove_worker method when sending", str(teardown))
-
-        del self.producer
-        del self.topic
-        del self.service
-        del self.client
-        del self.engine
+        self.report_sampling()
+        self.tail_transfers()
+        if self.spills is not None:
+            self.spills.uninstall()
+        if self.telemetry is not None:
+            for sample in self.telemetry.take():
+                self.emitter.emit("worker_telemetry", sample)
+        self.emitter.emit("remove_worker", {"worker" : self.worker.address, "time" : time.time()})
+        self.emitter.close()
+        self.metrics.unregister()
+        logging.info("Mofka worker %s plugin metrics: %s", self.worker.name, self.metrics.summary())
 
+    @timed("transition")
     def transition(
         self,
         key,
@@ -106,46 +246,14 @@ class MofkaWorkerPlugin(WorkerPlugin):
             More options passed when transitioning
         """
 
-        transition_data = str({ "key"            : str(key),
-                            "start"          : start,
-                            "finish"         : finish,
-                            "called_from"    : self.worker.name,
-                            "time"           : time.time()
-                            }).encode("utf-8")
-        try:
-            f = self.producer.push({"action": "worker_transition"}, transition_data)
-            f.wait()
-        except Exception as Argument:
-            logging.exception("Exception while calling transition method when sending", str(transition_data))
-
-        l = self.commin
-        l2 = len(self.worker.transfer_incoming_log)
-        if l2 > l:
-            data = list(self.worker.transfer_incoming_log)[l-1:]
-            _ = [e.update({"type": "incoming_transfer", "called_from": self.worker.name, "time": time.time(), "keys": str(e["keys"])}) for e in data]
-            self.commin = len(self.worker.transfer_incoming_log)
-            for d in data:
-                try:
-                    dd = str(d).encode("utf-8")
-                    f = self.producer.push({"action": "worker_transfer"}, dd)
-                    f.wait()
-                except Exception as Argument:
-                    logging.exception("Exception while calling transition method when sending", str(d))
-
-
-        l = self.commout
-        l2 = len(self.worker.transfer_outgoing_log)
-        if l2 > l:
-            data = list(self.worker.transfer_outgoing_log)[l-1:]
-            _ = [e.update({"type": "outgoing_transfer", "called_from": self.worker.name, "time": time.time(), "keys" : str(e["keys"])}) for e in data]
-            self.commout = len(self.worker.transfer_outgoing_log)
-            for d in data:
-                try:
-                    dd = str(d).encode("utf-8")
-                    f = self.producer.push({"action": "worker_transfer"}, dd)
-                    f.wait()
-                except Exception as Argument:
-                    logging.exception("Exception while calling transition method when sending", str(d))
+        if not self.sampling.rules or self.sampling.keep(key_split(key), start, finish, self.worker.address):
+            self.emitter.emit("worker_transition",
+                              {"key"            : str(key),
+                               "start"          : start,
+                               "finish"         : finish,
+                               "called_from"    : self.worker.name,
+                               "time"           : time.time()
+                              })
 
 
 @click.command()
@@ -157,7 +265,92 @@ class MofkaWorkerPlugin(WorkerPlugin):
                type=str,
                default="mofka.json",
                help="Mofka group file path")
+@click.option('--buffer-size',
+               type=int,
+               default=65536,
+               help="Number of events buffered between the worker and the Mofka producer")
+@click.option('--batch-size',
+               type=int,
+               default=1024,
+               help="Maximum number of events pushed per batch by the drain thread")
+@click.option('--overflow-policy',
+               type=click.Choice(OVERFLOW_POLICIES),
+               default="block",
+               help="What to do with new events when the buffer is full")
+@click.option('--sample-every',
+               type=int,
+               default=10,
+               help="Keep one event out of this many when the buffer is full and the overflow policy is sample")
+@click.option('--sampling-rules',
+               type=str,
+               default=None,
+               help="JSON list of transition sampling rules, or path to a JSON file holding them")
+@click.option('--sampling-report-interval',
+               type=float,
+               default=5.0,
+               help="Seconds between two reports of the number of transitions suppressed by sampling")
+@click.option('--partitions',
+               type=int,
+               default=1,
+               help="Number of partitions of the Dask topic, when this component creates it")
+@click.option('--partition-by',
+               type=click.Choice(STRATEGIES),
+               default="worker",
+               help="Route events to the topic partitions by worker, task key or action")
+@click.option('--topic-layout',
+               type=click.Choice(LAYOUTS),
+               default="single",
+               help="Push all the events to the Dask topic (single) or every event class to its own topic (per-class)")
+@click.option('--transfer-interval',
+               type=float,
+               default=1.0,
+               help="Seconds between two reads of the worker transfer logs")
+@click.option('--telemetry-interval',
+               type=float,
+               default=0.25,
+               help="Seconds between two resource samples of the worker, 0 to disable")
+@click.option('--telemetry-batch',
+               type=int,
+               default=20,
+               help="Number of resource samples pushed together")
+@click.option('--memory-events/--no-memory-events',
+               default=True,
+               help="Push spill, unspill and memory threshold events")
+@click.option('--memory-check-interval',
+               type=float,
+               default=0.1,
+               help="Seconds between two checks of the memory thresholds of the worker")
+@click.option('--agent',
+               type=str,
+               default=None,
+               help="Hand the events to the node agent of this name (python -m mofkadask.agent) "
+                    "instead of connecting to Mofka")
+@click.option('--agent-ring-size',
+               type=int,
+               default=16 << 20,
+               help="Size in bytes of the shared memory ring between the worker and the agent")
+@click.option('--spool-dir',
+               type=str,
+               default=None,
+               help="Directory where events are spooled while Mofka is slow or unavailable, no spool by default")
+@click.option('--spool-threshold',
+               type=float,
+               default=0.5,
+               help="Fraction of the buffer from which events are spooled")
+@click.option('--spool-segment-size',
+               type=int,
+               default=64 << 20,
+               help="Size in bytes of the spool segment files")
 
-async def dask_setup(worker, mofka_protocol, group_file):
-    plugin = MofkaWorkerPlugin(worker, mofka_protocol, group_file)
+async def dask_setup(worker, mofka_protocol, group_file, buffer_size, batch_size, overflow_policy, sample_every,
+                     sampling_rules, sampling_report_interval, partitions, partition_by, topic_layout,
+                     transfer_interval, telemetry_interval, telemetry_batch, memory_events,
+                     memory_check_interval, agent, agent_ring_size, spool_dir, spool_threshold,
+                     spool_segment_size):
+    plugin = MofkaWorkerPlugin(worker, mofka_protocol, group_file,
+                               buffer_size, batch_size, overflow_policy, sample_every,
+                               sampling_rules, sampling_report_interval, partitions, partition_by, topic_layout,
+                               transfer_interval, telemetry_interval, telemetry_batch, memory_events,
+                               memory_check_interval, agent, agent_ring_size, spool_dir, spool_threshold,
+                               spool_segment_size)
     await worker.plugin_add(plugin)
@@ -1,16 +1,16 @@
 import time
 import sys
 
-from pymargo.core import Engine
-from pymargo.core import server as server_mode
-import mochi.mofka.client as mofka
-
 from distributed import Client
 import dask
 
 import dask.array as da
 import click
 import h5py
+
+from mofkadask.arrays import publish_block
+from mofkadask.pool import producer as task_producer
+
 file = "array.h5"
 
 def add(a, b):
@@ -21,28 +21,19 @@ def mul(a, b):
 
 def mofkatask(a, b, mofka_protocol, group_file):
     "example of ceating a mofka Task"
-    engine = Engine(mofka_protocol, use_progress_thread=True)
-
-    engine = Engine(mofka_protocol, use_progress_thread=True)
-    driver = mofka.MofkaDriver(group_file, engine)
-    topic_name = "Numerics"
-    if not driver.topic_exists(topic_name):
-        driver.create_topic(topic_name)
-        driver.add_memory_partition(topic_name, 0)
-
-    topic = driver.open_topic(topic_name)
-
-    # create a producer
-    batchsize = mofka.AdaptiveBatchSize
-    thread_pool = mofka.ThreadPool(1)
-    ordering = mofka.Ordering.Strict
-    producer = topic.producer("my_producer", batchsize, thread_pool, ordering)
+    # the producer of the worker process is created by the first task and reused by the next ones,
+    # it is flushed when the worker closes
+    producer = task_producer(mofka_protocol, group_file, "Numerics")
     r = a + b
     f = producer.push({"action": "get_result"}, r.to_bytes(8, byteorder='big'))
     f.wait()
-    producer.flush()
     return r
 
+def publishtask(block, mofka_protocol, group_file, block_info=None):
+    "example of publishing the chunks of a Dask array from the tasks, without pickling them"
+    producer = task_producer(mofka_protocol, group_file, "Numerics")
+    return publish_block(producer, block, block_info, name="a")
+
 @click.command()
 @click.option('--scheduler-file',
                 type=str,
@@ -56,8 +47,11 @@ def mofkatask(a, b, mofka_protocol, group_file):
                type=str,
                default="mofka.json",
                help="Mofka group file path")
+@click.option('--publish/--no-publish',
+               default=False,
+               help="Publish the chunks of the input array to the Numerics topic from the tasks")
 
-def main(scheduler_file, mofka_protocol, group_file):
+def main(scheduler_file, mofka_protocol, group_file, publish):
     t0 = time.time()
     # Create a Dask Client
     c = Client(scheduler_file=scheduler_file)
@@ -66,6 +60,9 @@ def main(scheduler_file, mofka_protocol, group_file):
     f = h5py.File(file)
     a = da.from_array(f["/array"]).rechunk((1, 1000, 1000))
     b = da.random.random((10, 1000, 1000), chunks=(1, 1000, 1000))
+    if publish:
+        # rebuilt by the consumer started with --array-topic Numerics
+        a = a.map_blocks(publishtask, mofka_protocol, group_file, dtype=a.dtype)
     a = add(a, b)
     m = mul(a, b)
     k = m.max() - a.min() * m.max() - m.min()*a
@@ -86,6 +83,9 @@ def main(scheduler_file, mofka_protocol, group_file):
     To push data from the dask client to mofka uncomment the following lines
     """
     """
+    from pymargo.core import Engine
+    import mochi.mofka.client as mofka
+
     engine = Engine(mofka_protocol, use_progress_thread=True)
     client = mofka.Client(engine)
     service = client.connect(group_file)
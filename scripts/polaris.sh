@@ -19,6 +19,8 @@ CONFIGFILE=config.json
 DCONFIGFILE=config.txt
 PROTOCOL=cxi
 NDEPTH=32
+# name of the node-local Mofka agent shared by the workers of a node, empty to connect every worker to Mofka
+AGENT=
 
 export DXT_ENABLE_IO_TRACE=1
 export DARSHAN_LOG_DIR_PATH=$PBS_O_WORKDIR
@@ -52,11 +54,8 @@ echo Creating Mofka Server
 
 mpiexec  -n 1 --ppn 1 -d ${NDEPTH} --hostfile MofkaServerNode bedrock $PROTOCOL -c $CONFIGFILE 1>>bedrock.o 2>>bedrock.e &
 
-# Wait for the GROUPFILE to be created
-while ! [ -f $GROUPFILE ]; do
-    sleep 1
-    echo -n .
-done
+# The plugins connect to Mofka in the background once the GROUPFILE exists,
+# Dask does not wait for the Mofka server to start
 
 
 echo launching Scheduler
@@ -80,13 +79,32 @@ client_pid=$!
 # Launch Dask workers in the rest of the allocated nodes
 echo Scheduler booted, Client connected, launching workers
 
-DARSHAN_ENABLE_NONMPI=1 DARSHAN_CONFIG_PATH="config.txt" LD_PRELOAD="/home/agueroudji/spack/opt/spack/linux-sles15-zen3/gcc-11.2.0/darshan-runtime-dask-a3mpgplad6blsmn4vgvsce6mexozglja/lib/libdarshan.so" mpiexec -n 12 --ppn 2 -d 16  --hostfile WorkerNodes --exclusive --cpu-bind depth dask worker --scheduler-file=$SCHEFILE --preload MofkaWorkerPlugin.py  --mofka-protocol=$PROTOCOL  --group-file=$GROUPFILE 1>> worker.o  2>> worker.e  &
+WORKER_AGENT=
+if [ -n "$AGENT" ]; then
+    echo launching one Mofka agent per worker node
+    nworkernodes=$(wc -l WorkerNodes | awk '{print $1}')
+    mpiexec -n ${nworkernodes} --ppn 1 --hostfile WorkerNodes `which python` -m mofkadask.agent --name $AGENT --mofka-protocol=$PROTOCOL --group-file=$GROUPFILE 1>> agent.o 2>> agent.e &
+    agent_pid=$!
+    WORKER_AGENT="--agent=$AGENT"
+fi
+
+DARSHAN_ENABLE_NONMPI=1 DARSHAN_CONFIG_PATH="config.txt" LD_PRELOAD="/home/agueroudji/spack/opt/spack/linux-sles15-zen3/gcc-11.2.0/darshan-runtime-dask-a3mpgplad6blsmn4vgvsce6mexozglja/lib/libdarshan.so" mpiexec -n 12 --ppn 2 -d 16  --hostfile WorkerNodes --exclusive --cpu-bind depth dask worker --scheduler-file=$SCHEFILE --preload MofkaWorkerPlugin.py  --mofka-protocol=$PROTOCOL  --group-file=$GROUPFILE $WORKER_AGENT 1>> worker.o  2>> worker.e  &
 
-# Connect the Mofka consumer client
+# Connect the Mofka consumer client, it needs the GROUPFILE right away
+while ! [ -f $GROUPFILE ]; do
+    sleep 1
+    echo -n .
+done
 echo Connect Mofka consumer client
 mpiexec  -n 1 --ppn 1  -d ${NDEPTH} --hostfile ConsumerNode --exclusive --cpu-bind depth  `which python` consumer.py --mofka-protocol=$PROTOCOL  --group-file=$GROUPFILE 1>> consumer.o 2>> consumer.e
 consumer_pid=$!
 
+# Stop the agents while Mofka is up, they push the events left in their rings and flush on SIGTERM
+if [ -n "$AGENT" ]; then
+    kill -TERM $agent_pid
+    wait $agent_pid
+fi
+
 #echo Stopping bedrock
 mpiexec -n 1 --ppn 1 bedrock-shutdown $PROTOCOL -s $GROUPFILE 1> bedrock-shutdown.out 2> bedrock-shutdown.err
 rm -rf __pycache__ 2024*
@@ -0,0 +1,51 @@
+import numpy as np
+
+from mofkadask.encoding import (HEADER, MAGIC, BinaryEncoder, EventDecoder, StringDictionary, _GRAPH_V2,
+                                _encode_column, encode_frame)
+
+
+def legacy_graph_frames(client, keys, dependencies, time):
+    """dictionary delta and version 2 update_graph frame, holding the keys and dependencies of the graph"""
+    dictionary = StringDictionary()
+    record = {"client": client, "keys": str(set(keys)), "dependencies": str(dict(dependencies)), "time": time}
+    out = [HEADER.pack(MAGIC, 2, 4, 1)]
+    for name, kind in _GRAPH_V2:
+        _encode_column(kind, [record[name]], out, dictionary)
+    return [("legacy", encode_frame("dictionary_delta", dictionary.delta())), ("legacy", b"".join(out))]
+
+
+def current_graph_frames(client, keys, dependencies, time):
+    encoder = BinaryEncoder("current")
+    events = encoder("update_graph", [{"client": client, "keys": keys, "dependencies": dependencies,
+                                       "time": time}])
+    return [("current", data) for metadata, data in events if metadata["action"] != "graph_chunk"]
+
+
+def decode_graphs(frames):
+    decoder = EventDecoder()
+    columns = decoder.decode(frames)["update_graph"]
+    return decoder, columns
+
+
+def test_mixed_version_update_graph():
+    dependencies = {"a": [], "b": ["a"], "c": ["a", "b"]}
+    legacy = legacy_graph_frames("old-client", ["c"], dependencies, 1.0)
+    current = current_graph_frames("new-client", ["c"], dependencies, 2.0)
+    for frames, order in ((legacy + current, [0, 1]), (current + legacy, [1, 0])):
+        decoder, columns = decode_graphs(frames)
+        assert "keys" not in columns and "dependencies" not in columns
+        assert [decoder.categories[code] for code in columns["client"][order]] == ["old-client", "new-client"]
+        assert columns["time"][order].tolist() == [1.0, 2.0]
+        for name in ("ntasks", "nkeys", "nwanted", "nedges"):
+            # the legacy graph is summarized like the chunked one
+            assert columns[name][order[0]] == columns[name][order[1]], name
+        assert columns["nchunks"][order].tolist() == [0, 1]
+        assert columns["graph_id"][order[0]] is None
+
+
+def test_unparsable_legacy_graph():
+    frames = legacy_graph_frames("client", ["x"], {}, 1.0)
+    # keys that are not literals, as str(set) of objects
+    frames[1] = ("legacy", frames[1][1].replace(b"{'x'}", b"{<x>}"))
+    decoder, columns = decode_graphs(frames + current_graph_frames("client", ["a"], {"a": []}, 2.0))
+    assert np.isnan(columns["ntasks"][0]) and columns["ntasks"][1] == 1